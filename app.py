@@ -2,22 +2,29 @@ import os
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, session, redirect, url_for, jsonify, send_file
+from flask import Flask, render_template, request, session, redirect, url_for, jsonify, send_file, Response
 from flask_session import Session
-from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 import pandas as pd
 import openpyxl
 from openpyxl.utils import get_column_letter
 from datetime import datetime, timedelta
 from io import BytesIO
-import tempfile, zipfile
+import zipfile
 import threading
 import os
 import shutil
 import json
+import time
+import uuid
+from modules.job_store import JobStore, ThrottledProgress
+from modules.job_queue import JobQueue, JobWorker, JobInterrupted
+from modules.upload_store import UploadStore, UploadTooLarge
+from modules.sender_accounts import SenderAccountStore
+from modules.contact_registry import ContactListRegistry
+from modules.email_template import EmailTemplate, validate_templates
+from modules.credential_manager import credentials_to_dict, credentials_from_dict
 
 load_dotenv()
 
@@ -39,7 +46,8 @@ SESSION_DIR = os.path.join(os.path.dirname(__file__), 'flask_session')
 os.makedirs(SESSION_DIR, exist_ok=True)
 
 # ✅ FIX: Job storage folder (persistent)
-JOB_STORAGE_DIR = os.path.join(os.path.dirname(__file__), 'job_storage')
+# Web & worker.py phải dùng chung thư mục này (cùng máy, hoặc cùng volume khi chạy process riêng)
+JOB_STORAGE_DIR = os.environ.get('JOB_STORAGE_DIR', os.path.join(os.path.dirname(__file__), 'job_storage'))
 os.makedirs(JOB_STORAGE_DIR, exist_ok=True)
 
 STATE_STORE = {}
@@ -56,7 +64,28 @@ CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 REDIRECT_URI = os.environ.get('REDIRECT_URI', 'http://localhost:5000/oauth2callback')
 
-UPLOAD_FOLDERS = {}
+# Kho file upload dùng chung giữa các worker (dedup theo nội dung, tự dọn theo TTL / quota)
+UPLOAD_STORE = UploadStore(os.environ.get('UPLOAD_STORE_DIR', os.path.join(os.path.dirname(__file__), 'upload_store')))
+
+# Số thread gửi email song song cho mỗi job & quota Gmail (units/giây/user)
+SEND_MAX_WORKERS = int(os.environ.get('SEND_MAX_WORKERS', 4))
+GMAIL_QUOTA_UNITS_PER_SEC = int(os.environ.get('GMAIL_QUOTA_UNITS_PER_SEC', 250))
+# > 1: gom nhiều email vào 1 Gmail batch request (0 = gửi từng email)
+GMAIL_BATCH_SIZE = int(os.environ.get('GMAIL_BATCH_SIZE', 0))
+# Số lần gửi lại khi Gmail trả 429/5xx (backoff + jitter)
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 5))
+# File ZIP kết quả tách file (và job) được giữ bao nhiêu giờ sau khi job kết thúc
+SPLIT_RESULT_TTL_HOURS = float(os.environ.get('SPLIT_RESULT_TTL_HOURS', 24))
+# Job "processing" không cập nhật tiến độ quá số giây này → coi như worker đã chết, cho phép resume
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 300))
+# SSE tiến độ: gửi heartbeat sau bao nhiêu giây không có thay đổi, tối đa bao lâu / 1 kết nối
+PROGRESS_STREAM_HEARTBEAT = int(os.environ.get('PROGRESS_STREAM_HEARTBEAT', 15))
+PROGRESS_STREAM_MAX_SECONDS = int(os.environ.get('PROGRESS_STREAM_MAX_SECONDS', 600))
+# Mỗi stream SSE giữ 1 thread gunicorn suốt thời gian mở → giới hạn số stream / process
+# (mặc định 8 = nửa số thread của mỗi worker trong Procfile: --threads 16), stream thừa trả 503
+# và trình duyệt quay về polling /check_status
+PROGRESS_STREAM_MAX_CLIENTS = int(os.environ.get('PROGRESS_STREAM_MAX_CLIENTS', 8))
+PROGRESS_STREAM_SLOTS = threading.BoundedSemaphore(max(1, PROGRESS_STREAM_MAX_CLIENTS))
 
 if not CLIENT_ID or not CLIENT_SECRET:
     print("⚠️ WARNING: GOOGLE_CLIENT_ID or GOOGLE_CLIENT_SECRET not set!")
@@ -64,14 +93,30 @@ else:
     print("✅ OAuth Config Loaded Successfully")
 
 # ✅ FIX: Job Status Helper Functions
+# Trạng thái job lưu trong SQLite (job_storage/jobs.sqlite3), dùng chung giữa các worker
+JOB_STORE = JobStore(os.path.join(JOB_STORAGE_DIR, 'jobs.sqlite3'))
+# Hàng đợi job gửi email / tách file, chạy bởi worker process riêng (worker.py)
+JOB_QUEUE = JobQueue(os.path.join(JOB_STORAGE_DIR, 'jobs.sqlite3'))
+# Tài khoản Gmail dùng để gửi (pool nhiều tài khoản / 1 user), credentials chỉ lưu phía server
+SENDER_ACCOUNTS = SenderAccountStore(os.path.join(JOB_STORAGE_DIR, 'jobs.sqlite3'))
+# Danh sách email đã upload (snapshot đã parse, theo hash nội dung) → job gửi không phải đọc lại Excel
+CONTACT_LISTS = ContactListRegistry(os.path.join(JOB_STORAGE_DIR, 'contact_lists'))
+
+def sender_credentials(owner, email, creds_dict):
+    """Credentials cho job gửi: token mới được refresh thì lưu lại ngay vào SENDER_ACCOUNTS"""
+    def save_token(credentials):
+        SENDER_ACCOUNTS.save(owner, email, credentials_to_dict(credentials))
+    return credentials_from_dict(creds_dict, on_refresh=save_token)
+
 def save_job_status(job_id, status_dict):
-    """Lưu job status vào file"""
-    job_file = os.path.join(JOB_STORAGE_DIR, f"{job_id}.json")
-    with open(job_file, 'w', encoding='utf-8') as f:
-        json.dump(status_dict, f)
+    """Lưu job status"""
+    JOB_STORE.save(job_id, status_dict)
 
 def load_job_status(job_id):
-    """Tải job status từ file"""
+    """Tải job status (job cũ lưu dạng file JSON vẫn đọc được)"""
+    status = JOB_STORE.load(job_id)
+    if status is not None:
+        return status
     job_file = os.path.join(JOB_STORAGE_DIR, f"{job_id}.json")
     if not os.path.exists(job_file):
         return None
@@ -81,24 +126,61 @@ def load_job_status(job_id):
     except:
         return None
 
-def update_job_progress(job_id, current, total):
-    """Cập nhật tiến độ job"""
-    status = load_job_status(job_id)
-    if status:
-        status['progress'] = current
-        status['total'] = total
-        save_job_status(job_id, status)
+def job_progress_callback(job_id):
+    """progress_callback cho job nền: gộp cập nhật, tối đa JOB_PROGRESS_UPDATES_PER_SEC lần/giây"""
+    return ThrottledProgress(JOB_STORE, job_id)
+
+def get_job_checkpoint_path(job_id):
+    """File checkpoint (các Mã ID đã gửi) của job gửi email"""
+    return os.path.join(JOB_STORAGE_DIR, f"{job_id}_sent.jsonl")
+
+def is_job_resumable(job_id, status):
+    """Job gửi email bị dừng giữa chừng (failed, hoặc processing nhưng worker đã chết)"""
+    if not status or status.get('type') != 'email' or 'params' not in status:
+        return False
+    if status['status'] == 'failed':
+        return True
+    if status['status'] == 'processing':
+        # Job còn trong hàng đợi / đang chạy: worker tự chạy lại nếu bị mất (requeue_stale)
+        queued = JOB_QUEUE.get(job_id)
+        if queued and queued['state'] in ('queued', 'running'):
+            return False
+        updated_at = status.get('updated_at')
+        if not updated_at:
+            return False
+        return datetime.now() - datetime.fromisoformat(updated_at) > timedelta(seconds=JOB_STALE_SECONDS)
+    return False
+
+def get_job_log_path(job_id):
+    """File log CSV của job (được ghi dần trong lúc gửi)"""
+    return os.path.join(JOB_STORAGE_DIR, f"{job_id}_log.csv")
+
+def get_split_zip_path(job_id):
+    """Đường dẫn file ZIP kết quả của job tách file"""
+    return os.path.join(JOB_STORAGE_DIR, f"{job_id}.zip")
+
+def current_user_key():
+    """Chủ của job tách file: email đã đăng nhập, chưa đăng nhập thì id ngẫu nhiên lưu trong session"""
+    if session.get('user_email'):
+        return session['user_email']
+    if 'anonymous_id' not in session:
+        session['anonymous_id'] = uuid.uuid4().hex
+    return session['anonymous_id']
 
-def save_job_log(job_id, log_buffer):
-    """Lưu log buffer vào file"""
-    log_file = os.path.join(JOB_STORAGE_DIR, f"{job_id}_log.csv")
-    log_buffer.seek(0)
-    with open(log_file, 'wb') as f:
-        f.write(log_buffer.read())
+def cleanup_split_jobs():
+    """Xóa job tách file đã kết thúc quá SPLIT_RESULT_TTL_HOURS (file ZIP, file gốc, status, hàng đợi)"""
+    job_ids = JOB_QUEUE.finished_before('split', SPLIT_RESULT_TTL_HOURS * 3600)
+    for job_id in job_ids:
+        for path in (get_split_zip_path(job_id), os.path.join(JOB_STORAGE_DIR, f"{job_id}_upload.xlsx")):
+            if os.path.exists(path):
+                os.remove(path)
+        JOB_STORE.delete(job_id)
+        JOB_QUEUE.delete(job_id)
+    return len(job_ids)
 
 def load_job_log(job_id):
     """Tải log từ file"""
-    log_file = os.path.join(JOB_STORAGE_DIR, f"{job_id}_log.csv")
+    log_file = get_job_log_path(job_id)
     if os.path.exists(log_file):
         return log_file
     return None
@@ -108,6 +190,17 @@ def make_session_permanent():
     session.permanent = True
     app.permanent_session_lifetime = timedelta(hours=24)
 
+@app.before_request
+def sync_session_credentials():
+    """Token được worker refresh (lưu trong SENDER_ACCOUNTS) → cập nhật lại vào session"""
+    user_email = session.get('user_email')
+    if not user_email or 'credentials' not in session:
+        return
+    stored = SENDER_ACCOUNTS.get_credentials(user_email, user_email)
+    if stored and stored.get('token') != session['credentials'].get('token'):
+        session['credentials'] = stored
+        session.modified = True
+
 @app.route('/auth/login')
 def oauth_login():
     try:
@@ -135,6 +228,8 @@ def oauth_login():
         
         session['oauth_state'] = state
         session['oauth_state_time'] = datetime.now().isoformat()
+        # ?add_sender=1: đăng nhập thêm 1 tài khoản gửi (giữ nguyên tài khoản đang đăng nhập)
+        session['oauth_add_sender'] = bool(request.args.get('add_sender')) and 'user_email' in session
         STATE_STORE[state] = {
             'timestamp': datetime.now().isoformat(),
             'session_id': request.cookies.get('gmail_oauth_session', 'new')
@@ -197,21 +292,26 @@ def oauth_callback():
         
         print(f"✅ Tokens received from Google")
         
-        service = build('gmail', 'v1', credentials=credentials)
-        profile = service.users().getProfile(userId='me').execute()
+        from modules.gmail_service import gmail_services
+        with gmail_services.service(credentials) as service:
+            profile = service.users().getProfile(userId='me').execute()
         user_email = profile.get('emailAddress', '')
         
         print(f"✅ User email: {user_email}")
         
-        session['credentials'] = {
-            'token': credentials.token,
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
-        }
+        if session.pop('oauth_add_sender', False) and session.get('user_email'):
+            SENDER_ACCOUNTS.save(session['user_email'], user_email, credentials_to_dict(credentials))
+            session['oauth_state'] = None
+            session.modified = True
+            if state_from_google in STATE_STORE:
+                del STATE_STORE[state_from_google]
+            print(f"✅ Sender account added: {user_email} (owner: {session['user_email']})\n")
+            return redirect(url_for('index'))
+        
+        session['credentials'] = credentials_to_dict(credentials)
         session['user_email'] = user_email
+        # Tài khoản đăng nhập cũng là 1 tài khoản trong pool gửi của chính user đó
+        SENDER_ACCOUNTS.save(user_email, user_email, session['credentials'])
         session['oauth_state'] = None
         session.modified = True
         
@@ -235,6 +335,28 @@ def oauth_logout():
     session.clear()
     return redirect(url_for('index'))
 
+@app.route('/sender_accounts', methods=['GET'])
+def list_sender_accounts():
+    """Các tài khoản gửi của user (quota đã dùng / còn lại hôm nay)"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Please login with Gmail first'}), 401
+    return jsonify({
+        'primary': session['user_email'],
+        'accounts': SENDER_ACCOUNTS.list(session['user_email'])
+    })
+
+@app.route('/sender_accounts/remove', methods=['POST'])
+def remove_sender_account():
+    if 'user_email' not in session:
+        return jsonify({'error': 'Please login with Gmail first'}), 401
+    email = (request.get_json(silent=True) or request.form).get('email', '')
+    if email == session['user_email']:
+        return jsonify({'error': 'Cannot remove the logged-in account'}), 400
+    if not SENDER_ACCOUNTS.remove(session['user_email'], email):
+        return jsonify({'error': 'Sender account not found'}), 404
+    print(f"✅ Sender account removed: {email} (owner: {session['user_email']})")
+    return jsonify({'success': True})
+
 @app.route('/')
 def index():
     user_email = session.get('user_email')
@@ -267,6 +389,133 @@ def split_route():
         traceback.print_exc()
         return str(e), 500
 
+@app.route('/start_split', methods=['POST'])
+def start_split_route():
+    """Tách file Excel chạy nền: trả về job_id ngay, theo dõi qua /check_status/<job_id>"""
+    try:
+        from modules.excel_splitter import read_split_options, SplitError
+        
+        file = request.files.get('file')
+        if not file:
+            return jsonify({'error': 'Missing required fields!'}), 400
+        
+        try:
+            options = read_split_options(request.form, file.filename)
+        except SplitError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        removed = cleanup_split_jobs()
+        if removed:
+            print(f"🧹 Split: removed {removed} old job(s)")
+        
+        job_id = f"split_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        owner = current_user_key()
+        
+        # File gốc lưu trong job_storage, worker đọc lại khi chạy job
+        upload_path = os.path.join(JOB_STORAGE_DIR, f"{job_id}_upload.xlsx")
+        file.save(upload_path)
+        
+        save_job_status(job_id, {
+            'status': 'processing',
+            'type': 'split',
+            'progress': 0,
+            'total': 0,
+            'download_name': options['download_name'],
+            'owner': owner
+        })
+        
+        JOB_QUEUE.enqueue(job_id, 'split', owner, {
+            'upload_path': upload_path,
+            'options': options
+        })
+        
+        return jsonify({
+            'job_id': job_id,
+            'message': 'Splitting file...'
+        })
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+def save_job_result(job_id, claim, state, error=None, warning=None):
+    """
+    Ghi kết quả cuối của job (warning: job xong nhưng kết quả có hạn chế user cần biết);
+    bỏ qua nếu job đã bị lấy lại (lần chạy mới ghi kết quả của nó)
+    """
+    if not claim.is_current():
+        print(f"⚠️ Job {job_id} was taken over - not saving status '{state}'")
+        return False
+    status = load_job_status(job_id) or {}
+    status['status'] = state
+    if error is not None:
+        status['error'] = error
+    if warning is not None:
+        status['warning'] = warning
+    save_job_status(job_id, status)
+    return True
+
+def run_split_job(job_id, payload, claim):
+    """Chạy job tách file (gọi từ worker)"""
+    from modules.excel_splitter import split_excel_to_file, SplitError
+    
+    progress = job_progress_callback(job_id)
+    try:
+        with open(payload['upload_path'], 'rb') as f:
+            file_bytes = f.read()
+        result = split_excel_to_file(
+            file_bytes,
+            payload['options'],
+            get_split_zip_path(job_id),
+            progress_callback=progress
+        )
+        del file_bytes
+        progress.flush()
+        
+        save_job_result(job_id, claim, 'completed', warning=result['warning'])
+        print(f"✅ [Split] Job {job_id} completed")
+    except SplitError as e:
+        # Lỗi do file / tùy chọn của user: job failed, không cần traceback
+        progress.flush()
+        save_job_result(job_id, claim, 'failed', str(e))
+        print(f"❌ [Split] Job {job_id} failed: {str(e)}")
+        return 'failed'
+    except Exception as e:
+        progress.flush()
+        save_job_result(job_id, claim, 'failed', str(e))
+        raise
+    finally:
+        # Job đã bị worker khác lấy lại thì file gốc là của lần chạy đó
+        if claim.is_current() and os.path.exists(payload['upload_path']):
+            os.remove(payload['upload_path'])
+
+@app.route('/download_split/<job_id>', methods=['GET'])
+def download_split(job_id):
+    status = load_job_status(job_id)
+    if not status or status.get('type') != 'split':
+        return "Job not found", 404
+    
+    # Chỉ người tạo job tải được (job_id lộ ra cũng không tải được file của người khác)
+    queued = JOB_QUEUE.get(job_id)
+    owner = status.get('owner') or (queued['user_key'] if queued else None)
+    if not owner or owner != current_user_key():
+        return "Job not found", 404
+    
+    if status['status'] != 'completed':
+        return "Job not completed yet", 400
+    
+    zip_path = get_split_zip_path(job_id)
+    if not os.path.exists(zip_path):
+        return "No file available", 404
+    
+    return send_file(
+        zip_path,
+        as_attachment=True,
+        download_name=status.get('download_name', f"{job_id}.zip"),
+        mimetype='application/zip'
+    )
+
 @app.route('/upload_folder', methods=['POST'])
 def upload_folder():
     try:
@@ -274,25 +523,233 @@ def upload_folder():
         if not files:
             return jsonify({'error': 'No files'}), 400
         
-        session_id = session.sid or 'temp'
-        temp_dir = tempfile.mkdtemp()
-        UPLOAD_FOLDERS[session_id] = temp_dir
+        removed = UPLOAD_STORE.cleanup()
+        if removed:
+            print(f"🧹 Upload store: removed {len(removed)} old folder(s)")
+        
+        folder_id = UPLOAD_STORE.create_folder(session.get('user_email') or session.sid)
         
+        file_count = 0
         for file in files:
             if file.filename.endswith('.xlsx'):
-                file.save(os.path.join(temp_dir, file.filename))
-        
-        file_count = len(os.listdir(temp_dir))
+                UPLOAD_STORE.add_file(folder_id, file.filename, file.stream)
+                file_count += 1
+            elif file.filename.lower().endswith('.zip'):
+                file_count += len(UPLOAD_STORE.add_zip(folder_id, file.stream))
         
         return jsonify({
             'success': True,
-            'folder_id': session_id,
+            'folder_id': folder_id,
             'file_count': file_count
         })
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# ==========================================
+# UPLOAD THEO TỪNG PHẦN (CHUNK) - file lớn / nhiều file, gửi song song, resume được
+# 1. POST /upload_folder/start                     → folder_id
+# 2. POST /upload_folder/<folder_id>/files         {filename, size, sha256?} → upload_id + các phần đã nhận
+# 3. PUT  /upload_chunk/<upload_id>/<index>        body = nội dung phần (application/octet-stream)
+# 4. POST /upload_chunk/<upload_id>/complete       → lưu file vào thư mục (.zip: giải nén .xlsx)
+# ==========================================
+
+@app.route('/upload_folder/start', methods=['POST'])
+def start_chunked_upload():
+    try:
+        removed = UPLOAD_STORE.cleanup()
+        if removed:
+            print(f"🧹 Upload store: removed {len(removed)} old folder(s)")
+        
+        folder_id = UPLOAD_STORE.create_folder(session.get('user_email') or session.sid)
+        return jsonify({'success': True, 'folder_id': folder_id})
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload_folder/<folder_id>/files', methods=['POST'])
+def begin_chunked_file(folder_id):
+    try:
+        data = request.get_json(silent=True) or {}
+        filename = data.get('filename') or ''
+        if not filename.endswith('.xlsx') and not filename.lower().endswith('.zip'):
+            return jsonify({'error': 'Only .xlsx or .zip files are accepted'}), 400
+        
+        result = UPLOAD_STORE.begin_upload(folder_id, filename, data.get('size', 0), data.get('sha256'))
+        return jsonify(dict(result, success=True))
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload_chunk/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    try:
+        # Đọc thẳng body request (không qua multipart) → không bị spool cả file trước khi xử lý
+        received = UPLOAD_STORE.write_chunk(upload_id, index, request.stream)
+        return jsonify({'success': True, 'received': received})
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload_chunk/<upload_id>', methods=['GET'])
+def upload_chunk_status(upload_id):
+    try:
+        return jsonify(UPLOAD_STORE.upload_status(upload_id))
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+
+@app.route('/upload_chunk/<upload_id>/complete', methods=['POST'])
+def complete_chunked_file(upload_id):
+    try:
+        added = UPLOAD_STORE.complete_upload(upload_id)
+        return jsonify({'success': True, 'files': added, 'file_count': len(added)})
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/contact_lists', methods=['GET', 'POST'])
+def contact_lists():
+    """GET: các danh sách email đã upload của user; POST: upload danh sách mới (chỉ đọc header, job đọc dữ liệu)"""
+    try:
+        if 'user_email' not in session:
+            return jsonify({'error': 'Please login with Gmail first'}), 401
+        
+        if request.method == 'GET':
+            return jsonify({'contact_lists': CONTACT_LISTS.list(session['user_email'])})
+        
+        email_file = request.files.get('email_file')
+        if not email_file or not email_file.filename.lower().endswith(('.xlsx', '.xls')):
+            return jsonify({'error': 'Only Excel files are accepted'}), 400
+        
+        removed = CONTACT_LISTS.cleanup()
+        if removed:
+            print(f"🧹 Contact lists: removed {removed} old list(s)")
+        
+        info = CONTACT_LISTS.register(session['user_email'], email_file.filename, email_file.stream)
+        return jsonify(dict(info, success=True))
     except Exception as e:
         print(f"❌ Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/contact_lists/<list_id>/remove', methods=['POST'])
+def remove_contact_list(list_id):
+    if 'user_email' not in session:
+        return jsonify({'error': 'Please login with Gmail first'}), 401
+    if not CONTACT_LISTS.remove(session['user_email'], list_id):
+        return jsonify({'error': 'Contact list not found'}), 404
+    return jsonify({'success': True})
+
+def run_send_job(job_id, payload, claim):
+    """
+    Chạy job gửi email (gọi từ worker), ghi checkpoint từng ID đã gửi
+    Worker dừng giữa chừng → JobInterrupted (job trả lại hàng đợi, chạy tiếp từ checkpoint)
+    """
+    params = payload['params']
+    owner = params['sender_email']
+    # Token mới nhất (đã được refresh ở job khác) lưu trong SENDER_ACCOUNTS, payload chỉ là bản lúc enqueue
+    creds_dict = SENDER_ACCOUNTS.get_credentials(owner, owner) or payload['credentials']
+    
+    from modules.send_pipeline import PipelineStopped
+    
+    progress = job_progress_callback(job_id)
+    finished = False
+    try:
+        from modules.email_sender_oauth import send_emails_oauth
+        from modules.send_checkpoint import SendCheckpoint
+        
+        credentials = sender_credentials(owner, owner, creds_dict)
+        
+        # Gửi bằng nhiều tài khoản: credentials đọc từ SENDER_ACCOUNTS (refresh riêng từng tài khoản)
+        senders = None
+        if params.get('sender_accounts') and params['sender_accounts'] != [owner]:
+            senders = []
+            for email in params['sender_accounts']:
+                account_creds = SENDER_ACCOUNTS.get_credentials(owner, email)
+                if account_creds is None:
+                    print(f"⚠️ [Send Emails] Sender account removed: {email}")
+                    continue
+                senders.append({
+                    'email': email,
+                    'credentials': sender_credentials(owner, email, account_creds),
+                    'remaining': SENDER_ACCOUNTS.remaining(owner, email)
+                })
+            if not senders:
+                raise RuntimeError("Các tài khoản gửi đã chọn không còn tồn tại")
+        
+        # Danh sách email đã upload: đọc các cột cần dùng trong job (snapshot dùng lại cho job sau);
+        # job cũ vẫn đọc email_file_path
+        load_contacts = None
+        if params.get('contact_list_id'):
+            load_contacts = lambda columns: CONTACT_LISTS.load(owner, params['contact_list_id'], columns)
+        
+        send_emails_oauth(
+            credentials=credentials,
+            sender_email=params['sender_email'],
+            sender_name=params['sender_name'],
+            excel_folder=params['excel_folder'],
+            email_file_path=params.get('email_file_path'),
+            load_contacts=load_contacts,
+            ref_col=params['ref_col'],
+            name_col=params['name_col'],
+            email_col=params['email_col'],
+            cc_col=params['cc_col'],
+            selected_col_for_match=params['ref_col'],
+            subject_template=params['subject'],
+            body_template=params['body'],
+            body_html=params.get('body_html', False),
+            start_row=params['start_row'],
+            end_row=params['end_row'],
+            progress_callback=progress,
+            max_workers=SEND_MAX_WORKERS,
+            quota_units_per_sec=GMAIL_QUOTA_UNITS_PER_SEC,
+            batch_size=GMAIL_BATCH_SIZE,
+            max_retries=SEND_MAX_RETRIES,
+            checkpoint=SendCheckpoint(get_job_checkpoint_path(job_id)),
+            log_path=get_job_log_path(job_id), # Log ghi dần vào job_storage
+            senders=senders,
+            on_sent=SENDER_ACCOUNTS.record_sent,
+            should_stop=claim.stop_requested
+        )
+        
+        progress.flush()
+        
+        # ✅ FIX: Cập nhật status thành completed
+        finished = save_job_result(job_id, claim, 'completed')
+        print(f"✅ [Send Emails] Completed")
+    except PipelineStopped:
+        # Status giữ 'processing': worker khác chạy tiếp từ checkpoint
+        progress.flush()
+        raise JobInterrupted("worker stopping")
+    except Exception as e:
+        progress.flush()
+        finished = save_job_result(job_id, claim, 'failed', str(e))
+        print(f"❌ [Send Emails] Failed: {str(e)}")
+        raise
+    finally:
+        # Job chưa xong (trả lại hàng đợi / đã bị lấy lại) vẫn cần giữ file đính kèm
+        if finished and params.get('folder_id'):
+            UPLOAD_STORE.unpin(params['folder_id'])
+
 @app.route('/send_emails', methods=['POST'])
 def send_emails_route():
     try:
@@ -304,12 +761,14 @@ def send_emails_route():
         
         print(f"\n🔵 [Send Emails] Started by: {session['user_email']}")
         
-        job_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Hậu tố ngẫu nhiên: 2 user gửi cùng 1 giây không dùng chung job / checkpoint / log
+        job_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
         sender_name = request.form.get('sender_name', 'System')
         sender_email = session['user_email']
         
         folder_id = request.form.get('folder_id')
         email_file = request.files.get('email_file')
+        contact_list_id = request.form.get('contact_list_id')
         
         ref_col = request.form['ref_col']
         name_col = request.form.get('name_col')
@@ -317,85 +776,81 @@ def send_emails_route():
         cc_col = request.form.get('cc_col')
         subject = request.form['subject']
         body = request.form['body']
+        body_html = request.form.get('body_html') in ('1', 'true', 'on')
         
         start_row_email = int(request.form.get('start_row_email', 2))
         end_row_email = int(request.form.get('end_row_email', 99999))
         
-        if not email_file or folder_id not in UPLOAD_FOLDERS:
+        extract_folder = UPLOAD_STORE.get_folder(folder_id)
+        if not (email_file or contact_list_id) or not extract_folder:
             return jsonify({'error': 'Missing folder or email file'}), 400
+        if contact_list_id and not email_file and CONTACT_LISTS.get(sender_email, contact_list_id) is None:
+            return jsonify({'error': 'Contact list not found - please upload the email file again'}), 404
+        
+        # Tài khoản gửi (pool): chỉ nhận tài khoản user đã thêm
+        sender_accounts = []
+        for value in request.form.getlist('sender_accounts'):
+            for email in value.split(','):
+                email = email.strip()
+                if email and email not in sender_accounts:
+                    sender_accounts.append(email)
+        unknown = [email for email in sender_accounts if SENDER_ACCOUNTS.get_credentials(sender_email, email) is None]
+        if unknown:
+            return jsonify({'error': f"Unknown sender account(s): {', '.join(unknown)}"}), 400
         
-        extract_folder = UPLOAD_FOLDERS[folder_id]
+        # File email gửi kèm: lưu file vào CONTACT_LISTS & đọc header (job đọc dữ liệu; job sau / resume dùng lại bằng id)
+        if email_file:
+            contact_list = CONTACT_LISTS.register(sender_email, email_file.filename, email_file.stream)
+            contact_list_id = contact_list['list_id']
+        else:
+            contact_list = CONTACT_LISTS.get(sender_email, contact_list_id)
         
-        temp_dir = tempfile.mkdtemp()
-        excel_email_path = os.path.join(temp_dir, "emails.xlsx")
-        email_file.save(excel_email_path)
+        # Kiểm tra biến trong mẫu email với các cột của file email ngay (không đợi tới lúc job chạy)
+        try:
+            validate_templates([EmailTemplate(subject), EmailTemplate(body)], contact_list['columns'])
+        except ValueError as e:
+            return jsonify({'error': str(e), 'contact_list_id': contact_list_id}), 400
+        
+        # Tham số job được lưu cùng status để có thể resume sau khi worker bị restart
+        params = {
+            'sender_email': sender_email,
+            'sender_name': sender_name,
+            'folder_id': folder_id,
+            'sender_accounts': sender_accounts,
+            'excel_folder': extract_folder,
+            'contact_list_id': contact_list_id,
+            'ref_col': ref_col,
+            'name_col': name_col,
+            'email_col': email_col,
+            'cc_col': cc_col,
+            'subject': subject,
+            'body': body,
+            'body_html': body_html,
+            'start_row': start_row_email,
+            'end_row': end_row_email
+        }
         
         # ✅ FIX: Lưu job status vào file thay vì memory
         initial_status = {
             'status': 'processing',
+            'type': 'email',
             'progress': 0,
             'total': 0,
-            'log_buffer': None
+            'log_buffer': None,
+            'updated_at': datetime.now().isoformat(),
+            'params': params
         }
         save_job_status(job_id, initial_status)
         
-        creds_dict = session['credentials'].copy()
-        
-        def send_in_background():
-            try:
-                from modules.email_sender_oauth import send_emails_oauth
-                
-                credentials = Credentials(
-                    token=creds_dict['token'],
-                    refresh_token=creds_dict['refresh_token'],
-                    token_uri=creds_dict['token_uri'],
-                    client_id=creds_dict['client_id'],
-                    client_secret=creds_dict['client_secret'],
-                    scopes=creds_dict['scopes']
-                )
-                
-                log_buffer = send_emails_oauth(
-                    credentials=credentials,
-                    sender_email=sender_email,
-                    sender_name=sender_name,
-                    excel_folder=extract_folder,
-                    email_file_path=excel_email_path,
-                    ref_col=ref_col,
-                    name_col=name_col,
-                    email_col=email_col,
-                    cc_col=cc_col,
-                    selected_col_for_match=ref_col,
-                    subject_template=subject,
-                    body_template=body,
-                    start_row=start_row_email,
-                    end_row=end_row_email,
-                    progress_callback=lambda current, total: update_job_progress(job_id, current, total)
-                )
-                
-                # ✅ FIX: Lưu log vào file
-                save_job_log(job_id, log_buffer)
-                
-                # ✅ FIX: Cập nhật status thành completed
-                status = load_job_status(job_id)
-                status['status'] = 'completed'
-                status['log_buffer'] = None  # Không lưu BytesIO trong JSON
-                save_job_status(job_id, status)
-                
-                print(f"✅ [Send Emails] Completed")
-            except Exception as e:
-                status = load_job_status(job_id)
-                status['status'] = 'failed'
-                status['error'] = str(e)
-                save_job_status(job_id, status)
-                print(f"❌ [Send Emails] Failed: {str(e)}")
-                import traceback
-                traceback.print_exc()
-        
-        thread = threading.Thread(target=send_in_background, daemon=True)
-        thread.start()
+        UPLOAD_STORE.pin(folder_id) # Không dọn file đính kèm khi job chưa chạy xong
+        JOB_QUEUE.enqueue(job_id, 'send', sender_email, {
+            'params': params,
+            'credentials': session['credentials'].copy()
+        })
         
         return jsonify({
             'job_id': job_id,
+            'contact_list_id': contact_list_id,
             'message': 'Processing emails...'
         })
     
@@ -405,6 +860,74 @@ def send_emails_route():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/resume_job/<job_id>', methods=['POST'])
+def resume_job(job_id):
+    """Chạy tiếp job gửi email bị dừng giữa chừng: chỉ gửi các ID chưa có trong checkpoint"""
+    try:
+        if 'user_email' not in session or 'credentials' not in session:
+            return jsonify({'error': 'Please login with Gmail first'}), 401
+        
+        status = load_job_status(job_id)
+        if not status or status.get('type') != 'email':
+            return jsonify({'error': 'Job not found'}), 404
+        
+        params = status.get('params') or {}
+        if params.get('sender_email') != session['user_email']:
+            return jsonify({'error': 'Job belongs to another account'}), 403
+        
+        if not is_job_resumable(job_id, status):
+            return jsonify({'error': f"Job is {status['status']} - cannot resume"}), 409
+        
+        if params.get('contact_list_id'):
+            contacts_available = CONTACT_LISTS.get(params['sender_email'], params['contact_list_id']) is not None
+        else:
+            contacts_available = os.path.exists(params.get('email_file_path') or '')
+        if not UPLOAD_STORE.get_folder(params.get('folder_id')) or not contacts_available:
+            return jsonify({'error': 'Uploaded files are no longer available - please send again'}), 410
+        
+        print(f"\n🔵 [Resume Job] {job_id} by: {session['user_email']}")
+        
+        status['status'] = 'processing'
+        status['error'] = None
+        status['updated_at'] = datetime.now().isoformat()
+        status['resumed'] = status.get('resumed', 0) + 1
+        save_job_status(job_id, status)
+        
+        payload = {
+            'params': params,
+            'credentials': session['credentials'].copy()
+        }
+        if JOB_QUEUE.get(job_id) is None:
+            JOB_QUEUE.enqueue(job_id, 'send', session['user_email'], payload) # Job tạo trước khi có hàng đợi
+        elif not JOB_QUEUE.requeue(job_id, session['user_email'], payload):
+            return jsonify({'error': 'Job is already queued or running'}), 409
+        UPLOAD_STORE.pin(params['folder_id'])
+        
+        return jsonify({
+            'job_id': job_id,
+            'message': 'Resuming emails...'
+        })
+    except Exception as e:
+        print(f"❌ [Resume Job] Error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+def build_status_payload(job_id, status):
+    """Dữ liệu tiến độ trả cho client (dùng chung cho /check_status và /progress_stream)"""
+    stats = status.get('stats') or {}
+    return {
+        'status': status['status'],
+        'progress': status.get('progress', 0),
+        'total': status.get('total', 0),
+        'error': status.get('error'),
+        'warning': status.get('warning'),
+        'resumable': is_job_resumable(job_id, status),
+        'counts': stats.get('counts'),
+        'accounts': stats.get('accounts'),
+        'eta_seconds': stats.get('eta_seconds')
+    }
+
 @app.route('/check_status/<job_id>', methods=['GET'])
 def check_status(job_id):
     # ✅ FIX: Load từ file thay vì memory
@@ -412,33 +935,115 @@ def check_status(job_id):
     if not status:
         return jsonify({'error': 'Job not found'}), 404
     
-    return jsonify({
-        'status': status['status'],
-        'progress': status.get('progress', 0),
-        'total': status.get('total', 0)
-    })
+    return jsonify(build_status_payload(job_id, status))
+
+@app.route('/progress_stream/<job_id>', methods=['GET'])
+def progress_stream(job_id):
+    """
+    Server-Sent Events: đẩy tiến độ job mỗi khi có thay đổi (thay cho polling /check_status)
+    Stream đóng khi job kết thúc; quá PROGRESS_STREAM_MAX_SECONDS thì đóng để trình duyệt tự kết nối lại
+    Đã đủ PROGRESS_STREAM_MAX_CLIENTS stream trong process → 503, client dùng polling /check_status
+    """
+    if JOB_STORE.get_version(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if not PROGRESS_STREAM_SLOTS.acquire(blocking=False):
+        return jsonify({'error': 'Too many progress streams - use /check_status'}), 503
+    released = []
+    def release_slot():
+        if not released:
+            released.append(True)
+            PROGRESS_STREAM_SLOTS.release()
+    
+    def generate():
+        version = None
+        started = time.monotonic()
+        last_sent = started
+        yield "retry: 2000\n\n"
+        while time.monotonic() - started < PROGRESS_STREAM_MAX_SECONDS:
+            # Chỉ thức dậy khi job thay đổi hoặc tới lúc gửi heartbeat
+            wait = max(0.1, PROGRESS_STREAM_HEARTBEAT - (time.monotonic() - last_sent))
+            new_version = JOB_STORE.wait_for_change(job_id, version, timeout=wait)
+            if new_version is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+                return
+            if new_version != version:
+                version = new_version
+                status = load_job_status(job_id)
+                payload = build_status_payload(job_id, status)
+                yield f"data: {json.dumps(payload)}\n\n"
+                last_sent = time.monotonic()
+                if payload['status'] != 'processing' or payload['resumable']:
+                    return
+            elif time.monotonic() - last_sent >= PROGRESS_STREAM_HEARTBEAT:
+                # Lâu không có thay đổi: kiểm tra worker chạy job còn sống không
+                status = load_job_status(job_id)
+                if is_job_resumable(job_id, status):
+                    yield f"data: {json.dumps(build_status_payload(job_id, status))}\n\n"
+                    return
+                yield ": heartbeat\n\n" # Giữ kết nối qua proxy
+                last_sent = time.monotonic()
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(release_slot) # Trả slot khi stream đóng (job xong / client ngắt kết nối)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/download_log/<job_id>', methods=['GET'])
 def download_log(job_id):
     # ✅ FIX: Load log từ file thay vì memory
     status = load_job_status(job_id)
-    if not status:
+    if not status or (status.get('params') or {}).get('sender_email') != session.get('user_email'):
         return "Job not found", 404
     
-    if status['status'] != 'completed':
-        return "Job not completed yet", 400
-    
     log_file = load_job_log(job_id)
     if not log_file:
         return "No log available", 404
     
-    filename = f"email_log_{job_id}.csv"
+    # Job chưa xong (đang chạy / lỗi giữa chừng) → tải log dở dang
+    completed = status['status'] == 'completed'
+    filename = f"email_log_{job_id}.csv" if completed else f"email_log_{job_id}_partial.csv"
     return send_file(
         log_file, 
         as_attachment=True, 
         download_name=filename, 
-        mimetype="text/csv"
+        mimetype="text/csv",
+        etag=completed,
+        max_age=0
     )
 
+def create_job_worker(concurrency=None):
+    """Worker chạy các job trong JOB_QUEUE (dùng cho worker.py và chế độ chạy local)"""
+    handlers = {
+        'send': run_send_job,
+        'split': run_split_job
+    }
+    if concurrency is None:
+        return JobWorker(JOB_QUEUE, handlers)
+    return JobWorker(JOB_QUEUE, handlers, concurrency=concurrency)
+
+# Số slot worker chạy ngay trong web process (0 = chỉ chạy bằng worker.py riêng)
+JOB_EMBEDDED_WORKERS = int(os.environ.get('JOB_EMBEDDED_WORKERS', 0))
+EMBEDDED_WORKER = []
+EMBEDDED_WORKER_LOCK = threading.Lock()
+
+@app.before_request
+def start_embedded_worker():
+    """
+    JOB_EMBEDDED_WORKERS > 0: chạy worker trong web process, khi nhận request đầu tiên — không chạy lúc
+    import (process con của pool tách file import lại __main__ / app.py, không được tự chạy worker)
+    """
+    if JOB_EMBEDDED_WORKERS <= 0 or EMBEDDED_WORKER:
+        return
+    with EMBEDDED_WORKER_LOCK:
+        if not EMBEDDED_WORKER:
+            worker = create_job_worker(JOB_EMBEDDED_WORKERS)
+            worker.start()
+            EMBEDDED_WORKER.append(worker)
+
 if __name__ == '__main__':
+    # Chạy local (python app.py) không cần worker.py: tự chạy 1 worker trong process
+    if JOB_EMBEDDED_WORKERS <= 0 and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        create_job_worker(1).start()
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Benchmark gửi email song song với fake Gmail API (chạy local, không gửi thật)
+
+Cách chạy (từ thư mục gốc repo):
+    python benchmarks/bench_send_concurrency.py --emails 200 --latency 0.2
+    python benchmarks/bench_send_concurrency.py --emails 200 --latency 0.2 --batch-size 50
+    python benchmarks/bench_send_concurrency.py --emails 200 --latency 0.2 --max-concurrent 4 --error-rate 0.05
+
+Fake server giả lập độ trễ của messages.send, in ra throughput theo số worker.
+--max-concurrent / --error-rate: giả lập Gmail trả 429 (quá nhiều request đồng thời) và 5xx ngẫu nhiên.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive như Gmail thật
+    latency = 0.2
+    max_concurrent = 0 # > 0: quá số request đồng thời này thì trả 429
+    error_rate = 0.0 # Tỉ lệ request trả 503 ngẫu nhiên
+    in_flight = 0
+    counters = {'requests': 0, '429': 0, '503': 0, 'connections': 0}
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with FakeGmailHandler.lock:
+            FakeGmailHandler.counters['connections'] += 1
+
+    def pick_status(self):
+        """Trạng thái giả lập cho 1 request (hoặc 1 request con trong batch)"""
+        cls = FakeGmailHandler
+        with cls.lock:
+            cls.counters['requests'] += 1
+            if cls.max_concurrent and cls.in_flight > cls.max_concurrent:
+                cls.counters['429'] += 1
+                return 429
+            if random.random() < cls.error_rate:
+                cls.counters['503'] += 1
+                return 503
+        return 200
+
+    def do_POST(self):
+        cls = FakeGmailHandler
+        length = int(self.headers.get('Content-Length', 0))
+        request_body = self.rfile.read(length)
+        with cls.lock:
+            cls.in_flight += 1
+        try:
+            time.sleep(self.latency)
+            self.respond(request_body)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def respond(self, request_body):
+        status = 200
+        if self.path.startswith('/batch/'):
+            # Trả về multipart/mixed, mỗi Content-ID 1 response (thành công hoặc lỗi giả lập)
+            boundary = 'batch_' + uuid.uuid4().hex
+            parts = []
+            for content_id in re.findall(rb'Content-ID: <(.+?)>', request_body):
+                part_status = self.pick_status()
+                parts.append(
+                    f"--{boundary}\r\nContent-Type: application/http\r\n"
+                    f"Content-ID: <response-{content_id.decode()}>\r\n\r\n"
+                    f"HTTP/1.1 {part_status} {self.responses[part_status][0]}\r\n"
+                    f"Content-Type: application/json\r\n\r\n"
+                    f"{json.dumps(self.fake_body(part_status))}\r\n"
+                )
+            payload = (''.join(parts) + f"--{boundary}--\r\n").encode()
+            content_type = f'multipart/mixed; boundary={boundary}'
+        else:
+            status = self.pick_status()
+            payload = json.dumps(self.fake_body(status)).encode()
+            content_type = 'application/json'
+
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    @staticmethod
+    def fake_body(status):
+        if status == 429:
+            return {'error': {'code': 429, 'message': 'Too many concurrent requests for user',
+                              'errors': [{'reason': 'rateLimitExceeded'}]}}
+        if status != 200:
+            return {'error': {'code': status, 'message': 'Backend Error', 'errors': [{'reason': 'backendError'}]}}
+        return {'id': uuid.uuid4().hex[:16], 'threadId': uuid.uuid4().hex[:16]}
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_gmail(latency, max_concurrent=0, error_rate=0.0):
+    FakeGmailHandler.latency = latency
+    FakeGmailHandler.max_concurrent = max_concurrent
+    FakeGmailHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGmailHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def prepare_inputs(work_dir, n_emails, attachment_kb):
+    import pandas as pd
+
+    folder = os.path.join(work_dir, 'files')
+    os.makedirs(folder, exist_ok=True)
+    payload = os.urandom(attachment_kb * 1024)
+    rows = []
+    for i in range(n_emails):
+        code = f"S{i:05d}"
+        with open(os.path.join(folder, f"{code}-NPP {i}.xlsx"), 'wb') as f:
+            f.write(payload)
+        rows.append({'Ma': code, 'Ten': f"NPP {i}", 'Email': f"npp{i}@example.com"})
+
+    email_file = os.path.join(work_dir, 'emails.xlsx')
+    pd.DataFrame(rows).to_excel(email_file, index=False)
+    return folder, email_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2, help='Độ trễ giả lập mỗi request (giây)')
+    parser.add_argument('--attachment-kb', type=int, default=20)
+    parser.add_argument('--workers', default='1,2,4,8,16')
+    parser.add_argument('--batch-size', type=int, default=0, help='> 1 để benchmark chế độ Gmail batch')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='Fake server trả 429 khi vượt số request đồng thời')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Tỉ lệ request fake server trả 503')
+    parser.add_argument('--max-retries', type=int, default=5)
+    args = parser.parse_args()
+
+    server = start_fake_gmail(args.latency, args.max_concurrent, args.error_rate)
+    os.environ['GMAIL_API_ENDPOINT'] = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    import pandas as pd
+    from google.oauth2.credentials import Credentials
+    from modules import email_sender_oauth
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        folder, email_file = prepare_inputs(work_dir, args.emails, args.attachment_kb)
+        credentials = Credentials(token='fake-token')
+
+        results = []
+        for workers in [int(w) for w in args.workers.split(',')]:
+            FakeGmailHandler.counters = {'requests': 0, '429': 0, '503': 0, 'connections': 0}
+            t0 = time.perf_counter()
+            log_buffer = email_sender_oauth.send_emails_oauth(
+                credentials=credentials,
+                sender_email='bench@example.com',
+                sender_name='Bench',
+                excel_folder=folder,
+                email_file_path=email_file,
+                ref_col='Ma',
+                name_col='Ten',
+                email_col='Email',
+                subject_template='Báo cáo - {ten_npp}',
+                body_template='Kính gửi {ten_npp}',
+                start_row=1,
+                max_workers=workers,
+                batch_size=args.batch_size,
+                quota_units_per_sec=0,  # Không giới hạn quota khi benchmark
+                max_retries=args.max_retries
+            )
+            elapsed = time.perf_counter() - t0
+            failed = int((pd.read_csv(log_buffer)['Status'] != 'Success').sum())
+            results.append((workers, elapsed, failed, dict(FakeGmailHandler.counters)))
+
+    server.shutdown()
+
+    print(f"\n📊 {args.emails} emails, latency {args.latency}s/request, batch size {args.batch_size or '-'}")
+    print(f"{'workers':>8} {'seconds':>10} {'emails/s':>10} {'failed':>8} {'requests':>9} {'429':>6} {'503':>6} {'new conns':>10}")
+    for workers, elapsed, failed, counters in results:
+        print(f"{workers:>8} {elapsed:>10.2f} {args.emails / elapsed:>10.1f} {failed:>8} "
+              f"{counters['requests']:>9} {counters['429']:>6} {counters['503']:>6} {counters['connections']:>10}")
+
+
+if __name__ == '__main__':
+    main()
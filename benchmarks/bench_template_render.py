@@ -0,0 +1,107 @@
+"""
+Benchmark render tiêu đề / nội dung email (không gửi, chỉ đo thời gian tạo nội dung)
+
+Cách chạy (từ thư mục gốc repo):
+    python benchmarks/bench_template_render.py
+    python benchmarks/bench_template_render.py --renders 10000 --body-kb 4
+
+So sánh cho cùng 1 mẫu email:
+- replace: chuỗi .replace() như trước (chỉ có {ma_npp}, {ten_npp})
+- re.sub: tìm biến bằng regex mỗi lần render (cách làm "chưa biên dịch" cho nhiều biến)
+- EmailTemplate: biên dịch 1 lần / job (plain & HTML), mẫu có thêm cột của file email & biến có sẵn
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.email_template import EmailTemplate, format_value, PLACEHOLDER_RE
+
+SUBJECT = "Báo cáo tháng - {ten_npp} ({ma_npp})"
+BODY_HEAD = "Kính gửi {ten_npp},\n\nXin gửi báo cáo của Mã {ma_npp} kèm theo.\n"
+RICH_FIELDS = "Khu vực: {Khu vực} - Doanh số: {Doanh số} - Ngày chốt: {Ngày chốt}\nĐính kèm {so_file} file: {ds_file}\n"
+
+
+def make_contexts(n):
+    from datetime import datetime
+    return [
+        {
+            'ma_npp': f"S{i:05d}",
+            'ten_npp': f"Công ty TNHH <Số {i}> & Cộng sự",
+            'email': f"npp{i}@example.com",
+            'so_file': 2,
+            'ds_file': f"S{i:05d}-A.xlsx, S{i:05d}-B.xlsx",
+            'ngay': '01/01/2025',
+            'Khu vực': f"Miền {('Bắc', 'Trung', 'Nam')[i % 3]}",
+            'Doanh số': 1234567.0 + i,
+            'Ngày chốt': datetime(2025, 1, 31),
+        }
+        for i in range(n)
+    ]
+
+
+def render_replace(subject, body, context):
+    code, name = context['ma_npp'], str(context['ten_npp'])
+    return (subject.replace("{ma_npp}", code).replace("{ten_npp}", name),
+            body.replace("{ma_npp}", code).replace("{ten_npp}", name))
+
+
+def render_regex(subject, body, context):
+    def sub(match):
+        if match.group(1) is None:
+            return match.group(0)[0]
+        return format_value(context.get(match.group(1).strip()))
+    return PLACEHOLDER_RE.sub(sub, subject), PLACEHOLDER_RE.sub(sub, body)
+
+
+def timed(label, renders, fn):
+    t0 = time.perf_counter()
+    for context in renders:
+        fn(context)
+    elapsed = time.perf_counter() - t0
+    return label, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--renders', type=int, default=10000)
+    parser.add_argument('--body-kb', type=int, default=2, help='Độ dài nội dung email (KB)')
+    args = parser.parse_args()
+
+    filler = "Nội dung chi tiết của báo cáo tháng này. " * 64
+    filler = filler * max(1, args.body_kb * 1024 // len(filler.encode('utf-8')))
+    body = BODY_HEAD + filler + "\nTrân trọng!"
+    rich_body = BODY_HEAD + RICH_FIELDS + filler + "\nTrân trọng!"
+    contexts = make_contexts(args.renders)
+
+    t0 = time.perf_counter()
+    subject_tpl = EmailTemplate(SUBJECT)
+    body_tpl = EmailTemplate(body)
+    rich_tpl = EmailTemplate(rich_body)
+    html_tpl = EmailTemplate(rich_body.replace("\n", "<br>\n"), html=True)
+    compile_ms = (time.perf_counter() - t0) * 1000
+
+    # Kết quả giống nhau với các biến cũ
+    assert render_replace(SUBJECT, body, contexts[0]) == (subject_tpl.render(contexts[0]), body_tpl.render(contexts[0]))
+    assert render_regex(SUBJECT, rich_body, contexts[0])[1] == rich_tpl.render(contexts[0])
+
+    results = [
+        timed("replace (2 biến)", contexts, lambda c: render_replace(SUBJECT, body, c)),
+        timed("EmailTemplate (2 biến)", contexts, lambda c: (subject_tpl.render(c), body_tpl.render(c))),
+        timed("re.sub (9 biến)", contexts, lambda c: render_regex(SUBJECT, rich_body, c)),
+        timed("EmailTemplate (9 biến)", contexts, lambda c: (subject_tpl.render(c), rich_tpl.render(c))),
+        timed("EmailTemplate HTML (9 biến)", contexts, lambda c: (subject_tpl.render(c), html_tpl.render(c))),
+    ]
+
+    print(f"\n📊 {args.renders} renders, body {len(rich_body.encode('utf-8')) / 1024:.1f} KB, "
+          f"compile 4 templates {compile_ms:.2f} ms")
+    print(f"{'method':>30} {'total ms':>10} {'µs/render':>10} {'renders/s':>12}")
+    for label, elapsed in results:
+        print(f"{label:>30} {elapsed * 1000:>10.1f} {elapsed / args.renders * 1e6:>10.2f} "
+              f"{args.renders / elapsed:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import OrderedDict
+from email.mime.base import MIMEBase
+from email import encoders
+
+# Dung lượng tối đa (MB) cho cache file đính kèm đã encode base64 (dùng chung cả process)
+ATTACHMENT_CACHE_MB = int(os.environ.get('ATTACHMENT_CACHE_MB', 64))
+
+
+class AttachmentCache:
+    """
+    LRU cache file đính kèm đã encode base64 (phần nặng nhất khi tạo MIME)
+    - Key: (path, mtime, size) → file bị ghi đè/sửa sẽ tự encode lại
+    - Giới hạn tổng dung lượng (max_bytes), file quá lớn thì không cache
+    - Thread-safe cho nhiều worker gửi song song
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict() # key -> (filename, encoded_payload)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_encoded(self, path):
+        """Trả về (filename, payload base64) của file, encode 1 lần rồi dùng lại"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item
+            self.misses += 1
+
+        # Encode ngoài lock để các thread khác không phải chờ
+        with open(path, 'rb') as f:
+            part = MIMEBase('application', "octet-stream")
+            part.set_payload(f.read())
+        encoders.encode_base64(part)
+        item = (os.path.basename(path), part.get_payload())
+
+        item_size = len(item[1])
+        if item_size <= self.max_bytes:
+            with self._lock:
+                if key not in self._items:
+                    self._items[key] = item
+                    self._size += item_size
+                    # Bỏ các file ít dùng nhất cho tới khi đủ chỗ
+                    while self._size > self.max_bytes:
+                        _, (_, old_payload) = self._items.popitem(last=False)
+                        self._size -= len(old_payload)
+        return item
+
+    def create_part(self, path):
+        """Tạo MIME part mới (header riêng) dùng payload đã encode sẵn"""
+        filename, payload = self.get_encoded(path)
+        part = MIMEBase('application', "octet-stream")
+        part.set_payload(payload)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        return part
+
+
+# Cache dùng chung cho mọi job trong process
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_MB * 1024 * 1024)
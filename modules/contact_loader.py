@@ -0,0 +1,129 @@
+import os
+import hashlib
+import importlib.util
+import threading
+from collections import OrderedDict
+import pandas as pd
+from modules.email_template import column_label
+
+# Engine đọc file danh sách email: auto (calamine nếu đã cài python-calamine - nhanh hơn nhiều lần),
+# calamine, openpyxl
+EXCEL_ENGINE = os.environ.get('EXCEL_ENGINE', 'auto')
+# Số bảng danh sách email đã đọc giữ trong cache (job sau dùng lại nếu cùng file & cùng cột / dòng)
+CONTACT_CACHE_SIZE = int(os.environ.get('CONTACT_CACHE_SIZE', 8))
+
+
+def pick_engine(engine=None):
+    """Engine pandas dùng để đọc Excel"""
+    engine = (engine or EXCEL_ENGINE).lower()
+    if engine == 'auto':
+        return 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+    return engine
+
+
+def read_excel_table(path, engine=None, **kwargs):
+    """pd.read_excel bằng engine đã chọn; engine khác openpyxl bị lỗi thì đọc lại bằng openpyxl"""
+    engine = pick_engine(engine)
+    try:
+        return pd.read_excel(path, engine=engine, **kwargs)
+    except Exception as e:
+        if engine == 'openpyxl':
+            raise
+        print(f"⚠️ Excel engine '{engine}' failed ({e}) - retrying with openpyxl")
+        return pd.read_excel(path, engine='openpyxl', **kwargs)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContactTableCache:
+    """
+    LRU cache bảng danh sách email đã đọc (dùng chung cả process worker)
+    - Key: (SHA-256 nội dung file, các cột, dòng bắt đầu / kết thúc) → file upload lại với nội dung
+      khác thì đọc lại, file giống hệt (dù tên khác) thì không phải parse lại
+    - DataFrame trong cache dùng chung giữa các job: không được sửa
+    """
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            df = self._items.get(key)
+            if df is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return df
+
+    def put(self, key, df):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = df
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+contact_cache = ContactTableCache(CONTACT_CACHE_SIZE)
+
+
+def contact_usecols(columns):
+    """usecols cho pd.read_excel: chỉ đọc các cột trong columns (so khớp theo column_label)"""
+    wanted = set(column_label(col) for col in columns if col)
+    return lambda col: column_label(col) in wanted
+
+
+def read_contact_rows(path, columns, start_row=2, end_row=99999, engine=None):
+    """
+    Đọc danh sách email, chỉ các cột cần dùng (usecols) & chỉ khoảng dòng cần gửi
+    (skiprows / nrows: dừng đọc sau end_row) — kết quả giống
+    pd.read_excel(path)[...].iloc[start_row-1:end_row]
+    Cột so khớp theo column_label (header số / ngày vẫn khớp với biến {2024} trong template)
+    """
+    kwargs = {'usecols': contact_usecols(columns)}
+    if start_row >= 1 and end_row >= start_row - 1:
+        # Giữ dòng header (dòng 0 của file), bỏ start_row - 1 dòng dữ liệu đầu
+        kwargs['skiprows'] = range(1, start_row)
+        kwargs['nrows'] = end_row - (start_row - 1)
+        slice_rows = False
+    else:
+        slice_rows = True
+
+    df = read_excel_table(path, engine, **kwargs)
+    if slice_rows:
+        df = df.iloc[start_row - 1:end_row]
+    return df
+
+
+def load_contact_table(path, columns, start_row=2, end_row=99999, engine=None):
+    """
+    Như read_contact_rows, có cache theo hash nội dung file (dùng lại giữa các job)
+    Chỉ dùng cho job gửi kèm file email (job cũ, trước khi có ContactListRegistry);
+    job mới đọc từ snapshot bằng select_contact_rows
+    """
+    key = (file_sha256(path), tuple(col for col in columns if col), start_row, end_row)
+    df = contact_cache.get(key)
+    if df is not None:
+        print(f"📇 Email list cache hit ({len(df)} rows)")
+        return df
+    df = read_contact_rows(path, columns, start_row, end_row, engine)
+    contact_cache.put(key, df)
+    return df
+
+
+def select_contact_rows(df, columns, start_row=2, end_row=99999):
+    """Như read_contact_rows nhưng lấy từ bảng đã đọc sẵn (vd: snapshot trong ContactListRegistry)"""
+    wanted = set(column_label(col) for col in columns if col)
+    return df[[col for col in df.columns if column_label(col) in wanted]].iloc[start_row - 1:end_row]
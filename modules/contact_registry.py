@@ -0,0 +1,240 @@
+import os
+import json
+import hashlib
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from modules.contact_loader import read_excel_table, contact_usecols, ContactTableCache
+from modules.email_template import column_label
+
+# Danh sách email không dùng tới quá số ngày này thì bị xóa
+CONTACT_LIST_TTL_DAYS = float(os.environ.get('CONTACT_LIST_TTL_DAYS', 30))
+# Số snapshot đã load giữ trong bộ nhớ của mỗi process (job sau dùng lại, không đọc lại từ đĩa)
+CONTACT_SNAPSHOT_CACHE_SIZE = int(os.environ.get('CONTACT_SNAPSHOT_CACHE_SIZE', 4))
+
+# Đọc file upload theo từng khối 1 MB
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class ContactListRegistry:
+    """
+    Danh sách email (file Excel) upload 1 lần, dùng lại cho nhiều job gửi
+    - Khi upload (web request): chỉ lưu file gốc theo SHA-256 (sources/<hash>.xlsx) & đọc dòng header
+      (để kiểm tra mẫu email ngay) → file trùng nội dung (dù tên khác / user khác) chỉ lưu 1 lần
+    - Job (worker) load danh sách với các cột cần dùng → đọc Excel 1 lần với usecols, lưu snapshot
+      (DataFrame pickle) theo hash + các cột → snapshots/<hash>-<cột>.pkl; job sau cùng file & cùng cột
+      load snapshot (mili giây) thay vì parse lại Excel
+    - Index trong SQLite: mỗi user (owner) chỉ thấy / dùng được danh sách của mình
+    - Danh sách không dùng quá CONTACT_LIST_TTL_DAYS ngày bị xóa (file gốc & snapshot xóa khi không còn ai dùng)
+    """
+
+    def __init__(self, root, ttl_seconds=CONTACT_LIST_TTL_DAYS * 86400, cache_size=CONTACT_SNAPSHOT_CACHE_SIZE):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.source_dir = os.path.join(root, 'sources')
+        self.snapshot_dir = os.path.join(root, 'snapshots')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for path in (self.source_dir, self.snapshot_dir, self.tmp_dir):
+            os.makedirs(path, exist_ok=True)
+        self.cache = ContactTableCache(cache_size)
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS contact_lists ("
+            " list_id TEXT NOT NULL,"
+            " owner TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " rows INTEGER NOT NULL," # -1: chưa đọc hết file (chưa có job nào dùng)
+            " columns TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (list_id, owner))"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite3'), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _source_path(self, file_hash):
+        return os.path.join(self.source_dir, f"{file_hash}.xlsx")
+
+    def _snapshot_path(self, file_hash, columns=None):
+        """columns=None: snapshot đầy đủ (phiên bản trước, không còn file gốc)"""
+        if columns is None:
+            return os.path.join(self.snapshot_dir, f"{file_hash}.pkl")
+        key = hashlib.sha256(json.dumps(columns).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.snapshot_dir, f"{file_hash}-{key}.pkl")
+
+    def _available(self, file_hash):
+        return os.path.exists(self._source_path(file_hash)) or os.path.exists(self._snapshot_path(file_hash))
+
+    def _spool(self, stream):
+        """Ghi stream ra file tạm trong tmp/ → (đường dẫn, SHA-256)"""
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.xlsx')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(COPY_BLOCK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest()
+
+    def _write_snapshot(self, path, df):
+        """Ghi file tạm rồi rename: process khác không đọc dở"""
+        fd, temp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.pkl')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def register(self, owner, filename, stream):
+        """
+        Lưu danh sách email (stream file .xlsx) cho owner → thông tin danh sách
+        (list_id, filename, rows, columns). Chỉ đọc dòng header, không parse cả file
+        """
+        temp_path, file_hash = self._spool(stream)
+        source_path = self._source_path(file_hash)
+        try:
+            known = self._connect().execute(
+                "SELECT rows, columns FROM contact_lists WHERE hash = ? LIMIT 1", (file_hash,)
+            ).fetchone()
+            if known is not None and self._available(file_hash):
+                n_rows, columns = known[0], json.loads(known[1])
+            else:
+                header = read_excel_table(temp_path, nrows=0)
+                n_rows, columns = -1, [str(col) for col in header.columns]
+            if not os.path.exists(source_path):
+                os.replace(temp_path, source_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        list_id = f"cl_{file_hash[:32]}"
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO contact_lists (list_id, owner, filename, hash, rows, columns, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(list_id, owner) DO UPDATE SET filename = excluded.filename, last_used = excluded.last_used",
+            (list_id, owner, os.path.basename(filename or 'contacts.xlsx'), file_hash, n_rows, json.dumps(columns), now, now)
+        )
+        return self._info(list_id, os.path.basename(filename or 'contacts.xlsx'), n_rows, columns, now)
+
+    @staticmethod
+    def _info(list_id, filename, n_rows, columns, last_used):
+        return {
+            'list_id': list_id, 'filename': filename, 'rows': n_rows if n_rows >= 0 else None,
+            'columns': columns, 'last_used': last_used
+        }
+
+    def get(self, owner, list_id):
+        """Thông tin danh sách của owner (rows=None: chưa đọc), None nếu không có (hoặc file đã bị xóa)"""
+        row = self._connect().execute(
+            "SELECT filename, hash, rows, columns, last_used FROM contact_lists WHERE list_id = ? AND owner = ?",
+            (list_id, owner)
+        ).fetchone()
+        if row is None or not self._available(row[1]):
+            return None
+        return self._info(list_id, row[0], row[2], json.loads(row[3]), row[4])
+
+    def list(self, owner):
+        """Các danh sách của owner, dùng gần nhất trước"""
+        rows = self._connect().execute(
+            "SELECT list_id, filename, rows, columns, last_used FROM contact_lists WHERE owner = ? ORDER BY last_used DESC",
+            (owner,)
+        ).fetchall()
+        return [
+            self._info(list_id, filename, n_rows, json.loads(columns), last_used)
+            for list_id, filename, n_rows, columns, last_used in rows
+        ]
+
+    def _load_snapshot(self, file_hash, columns):
+        """Bảng chỉ gồm các cột columns: cache → snapshot trên đĩa → đọc file gốc (usecols) & lưu snapshot"""
+        key = (file_hash, tuple(columns))
+        df = self.cache.get(key)
+        if df is not None:
+            return df
+        path = self._snapshot_path(file_hash, columns)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                df = pickle.load(f)
+        elif os.path.exists(self._source_path(file_hash)):
+            t0 = time.perf_counter()
+            df = read_excel_table(self._source_path(file_hash), usecols=contact_usecols(columns))
+            self._write_snapshot(path, df)
+            print(f"📇 Contact list parsed: {len(df)} rows x {len(df.columns)} columns in {time.perf_counter() - t0:.2f}s")
+        else:
+            with open(self._snapshot_path(file_hash), 'rb') as f:
+                full = pickle.load(f)
+            wanted = set(columns)
+            df = full[[col for col in full.columns if column_label(col) in wanted]]
+        self.cache.put(key, df)
+        return df
+
+    def load(self, owner, list_id, columns):
+        """
+        DataFrame của danh sách, chỉ gồm các cột columns có trong file (dùng chung giữa các job: không được sửa)
+        KeyError nếu owner không có danh sách này / file đã bị xóa
+        """
+        row = self._connect().execute(
+            "SELECT hash FROM contact_lists WHERE list_id = ? AND owner = ?", (list_id, owner)
+        ).fetchone()
+        if row is None or not self._available(row[0]):
+            raise KeyError(f"Contact list not found: {list_id}")
+        columns = sorted(set(column_label(col) for col in columns if col))
+        t0 = time.perf_counter()
+        df = self._load_snapshot(row[0], columns)
+        self._connect().execute(
+            "UPDATE contact_lists SET last_used = ?, rows = ? WHERE list_id = ? AND owner = ?",
+            (time.time(), len(df), list_id, owner)
+        )
+        print(f"📇 Contact list {list_id} loaded: {len(df)} rows in {(time.perf_counter() - t0) * 1000:.1f}ms")
+        return df
+
+    def remove(self, owner, list_id):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT hash FROM contact_lists WHERE list_id = ? AND owner = ?", (list_id, owner)
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM contact_lists WHERE list_id = ? AND owner = ?", (list_id, owner))
+        self._remove_unused_files(row[0])
+        return True
+
+    def cleanup(self):
+        """Xóa danh sách không dùng quá TTL → số danh sách đã xóa"""
+        conn = self._connect()
+        expired = conn.execute(
+            "SELECT list_id, owner, hash FROM contact_lists WHERE last_used < ?", (time.time() - self.ttl_seconds,)
+        ).fetchall()
+        for list_id, owner, file_hash in expired:
+            conn.execute("DELETE FROM contact_lists WHERE list_id = ? AND owner = ?", (list_id, owner))
+            self._remove_unused_files(file_hash)
+        return len(expired)
+
+    def _remove_unused_files(self, file_hash):
+        """Xóa file gốc & mọi snapshot của file khi không còn danh sách nào dùng"""
+        if self._connect().execute("SELECT 1 FROM contact_lists WHERE hash = ? LIMIT 1", (file_hash,)).fetchone():
+            return
+        paths = [self._source_path(file_hash)] + [
+            os.path.join(self.snapshot_dir, name) for name in os.listdir(self.snapshot_dir)
+            if name == f"{file_hash}.pkl" or name.startswith(f"{file_hash}-")
+        ]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+# Refresh access token trước khi hết hạn bao nhiêu giây
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get('TOKEN_REFRESH_MARGIN_SECONDS', 300))
+# Token vừa được refresh trong khoảng này thì các thread khác không refresh lại nữa
+TOKEN_REFRESH_DEDUP_SECONDS = 10
+# Refresh nền bị lỗi → thử lại sau bao nhiêu giây
+TOKEN_REFRESH_RETRY_SECONDS = 30
+
+
+def utcnow():
+    # google-auth so sánh expiry dạng datetime UTC không có tzinfo
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class ManagedCredentials(Credentials):
+    """
+    Credentials OAuth dùng chung cho mọi thread gửi của 1 job
+    - refresh() được khóa: nhiều thread cùng gặp token hết hạn / 401 thì chỉ 1 thread gọi
+      token endpoint, các thread còn lại dùng luôn token mới
+    - start_auto_refresh(): thread nền refresh trước khi hết hạn TOKEN_REFRESH_MARGIN_SECONDS giây
+      → job chạy lâu không bị dừng vì token hết hạn giữa chừng
+    - on_refresh(credentials): gọi sau mỗi lần refresh thành công (vd: lưu token mới)
+    - Ghi lại số lần refresh & thời gian gọi token endpoint
+    """
+
+    def __init__(self, *args, on_refresh=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_refresh = on_refresh
+        self.refresh_count = 0
+        self.refresh_failures = 0
+        self.refresh_seconds_total = 0.0
+        self.refresh_seconds_max = 0.0
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, request):
+        stale_token = self.token
+        with self._refresh_lock:
+            # Thread khác vừa refresh xong trong lúc chờ lock → dùng token mới, không gọi lại
+            recently = self._last_refresh is not None and time.monotonic() - self._last_refresh < TOKEN_REFRESH_DEDUP_SECONDS
+            if self.token != stale_token or (recently and not self.needs_refresh()):
+                return
+            t0 = time.perf_counter()
+            try:
+                super().refresh(request)
+            except Exception:
+                self.refresh_failures += 1
+                raise
+            elapsed = time.perf_counter() - t0
+            self.refresh_count += 1
+            self.refresh_seconds_total += elapsed
+            self.refresh_seconds_max = max(self.refresh_seconds_max, elapsed)
+            self._last_refresh = time.monotonic()
+        print(f"🔑 Access token refreshed in {elapsed:.2f}s (expires {self.expiry.isoformat() if self.expiry else 'unknown'})")
+        if self.on_refresh:
+            try:
+                self.on_refresh(self)
+            except Exception as e:
+                print(f"⚠️ Cannot save refreshed token: {e}")
+
+    def needs_refresh(self, margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        """Token chưa có / không rõ hạn / sắp hết hạn trong margin giây"""
+        if not self.token or self.expiry is None:
+            return True
+        return utcnow() >= self.expiry - timedelta(seconds=margin)
+
+    def ensure_fresh(self):
+        """Refresh ngay nếu token sắp hết hạn (không có refresh_token thì bỏ qua)"""
+        if self.refresh_token and self.needs_refresh():
+            self.refresh(Request())
+        return self
+
+    def _auto_refresh_loop(self):
+        while True:
+            if self.expiry is None:
+                wait = TOKEN_REFRESH_RETRY_SECONDS
+            else:
+                wait = (self.expiry - timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS) - utcnow()).total_seconds()
+            if self._stop.wait(max(1.0, wait)):
+                return
+            try:
+                self.ensure_fresh()
+            except Exception as e:
+                print(f"⚠️ Background token refresh failed: {e}")
+                if self._stop.wait(TOKEN_REFRESH_RETRY_SECONDS):
+                    return
+
+    def start_auto_refresh(self):
+        """Chạy thread nền refresh token trước khi hết hạn (gọi stop_auto_refresh() khi xong job)"""
+        if not self.refresh_token or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._auto_refresh_loop, name="token-refresh", daemon=True)
+        self._thread.start()
+
+    def stop_auto_refresh(self):
+        self._stop.set()
+        self._thread = None
+
+    def summary(self):
+        avg = self.refresh_seconds_total / self.refresh_count if self.refresh_count else 0.0
+        return (f"{self.refresh_count} refreshes ({self.refresh_failures} failed), "
+                f"avg {avg:.2f}s, max {self.refresh_seconds_max:.2f}s")
+
+
+def credentials_to_dict(credentials):
+    """Credentials → dict (lưu session / job / tài khoản gửi)"""
+    return {
+        'token': credentials.token,
+        'refresh_token': credentials.refresh_token,
+        'token_uri': credentials.token_uri,
+        'client_id': credentials.client_id,
+        'client_secret': credentials.client_secret,
+        'scopes': credentials.scopes,
+        'expiry': credentials.expiry.isoformat() if credentials.expiry else None
+    }
+
+
+def credentials_from_dict(creds_dict, on_refresh=None):
+    """dict → ManagedCredentials (dict cũ không có 'expiry': refresh ngay lần đầu dùng)"""
+    expiry = creds_dict.get('expiry')
+    return ManagedCredentials(
+        token=creds_dict['token'],
+        refresh_token=creds_dict['refresh_token'],
+        token_uri=creds_dict['token_uri'],
+        client_id=creds_dict['client_id'],
+        client_secret=creds_dict['client_secret'],
+        scopes=creds_dict['scopes'],
+        expiry=datetime.fromisoformat(expiry) if expiry else None,
+        on_refresh=on_refresh
+    )
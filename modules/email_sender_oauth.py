@@ -1,16 +1,31 @@
 import os
 import pandas as pd
 from datetime import datetime
-from io import BytesIO
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
 from google.auth.transport.requests import Request
 import base64
+import threading
 from collections import defaultdict # Import thêm
+from modules.rate_limiter import GMAIL_SEND_QUOTA_COST
+from modules.attachment_cache import attachment_cache
+from modules.contact_loader import load_contact_table, select_contact_rows, contact_cache
+from modules.send_pipeline import run_send_pipeline
+from modules.job_log import open_job_log, open_memory_log, finish_memory_log, OrderedLogWriter
+from modules.gmail_service import gmail_services, GMAIL_API_ENDPOINT
+from modules.retry_policy import classify_error, get_retry_after, is_account_error
+from modules.sender_pool import SenderAccount, SenderPool
+from modules.credential_manager import ManagedCredentials
+from modules.email_template import EmailTemplate, validate_templates, column_label
+
+# Giới hạn batch request: Gmail khuyến nghị <= 50 request / batch (tối đa 100),
+# tổng payload bị giới hạn nên các email có file đính kèm lớn sẽ được tách batch
+GMAIL_BATCH_MAX_REQUESTS = 50
+GMAIL_BATCH_MAX_BYTES = 8 * 1024 * 1024
 
 # Hàm phụ trợ mới: Extract cả Mã và Tên từ tên file
 def extract_parts_from_filename(filename):
@@ -37,18 +52,46 @@ def extract_parts_from_filename(filename):
     return basename.strip(), None
 
 def refresh_access_token_if_needed(credentials):
-    """Làm mới access token nếu hết hạn"""
+    """
+    Làm mới access token nếu hết hạn
+    ManagedCredentials: refresh trước khi sắp hết hạn (có khóa, dùng chung giữa các thread)
+    """
+    if isinstance(credentials, ManagedCredentials):
+        return credentials.ensure_fresh()
     if credentials.expired and credentials.refresh_token:
         print("⚠️ Access token expired - Refreshing...")
         credentials.refresh(Request())
         print("✅ Access token refreshed")
     return credentials
 
-def create_message(sender, to, subject, body, attachments=None, cc=None):
+def make_log_row(code, name, email_to, email_cc, status, error):
+    """Tạo 1 dòng log (cột giống file CSV kết quả)"""
+    return {
+        "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "Code": code,
+        "Name": name,
+        "Email To": email_to,
+        "Email CC": email_cc,
+        "Status": status,
+        "Error": error
+    }
+
+def build_recipient_index(df_email, ref_col):
+    """
+    Tạo index Mã ID -> vị trí dòng trong danh sách email (1 lần / job)
+    Mã được chuẩn hoá (astype(str).strip()) giống lúc đối chiếu,
+    mỗi lần tra cứu sau đó là O(1) thay vì quét lại cả DataFrame.
+    """
+    keys = df_email[ref_col].astype(str).str.strip()
+    return keys.groupby(keys, sort=False).indices
+
+def create_message(sender, to, subject, body, attachments=None, cc=None, attachment_parts=None, html=False):
     """
     Tạo email message (MIME format)
     ✅ SỬA ĐỔI: Chấp nhận một danh sách attachments
     attachments là một list các tuple: [(filename, file_bytes_io), ...]
+    attachment_parts: list MIME part đã encode sẵn (từ attachment_cache)
+    html: nội dung email dạng HTML
     """
     message = MIMEMultipart()
     message['From'] = sender
@@ -59,7 +102,7 @@ def create_message(sender, to, subject, body, attachments=None, cc=None):
         message['Cc'] = cc
     
     # Thêm nội dung email
-    message.attach(MIMEText(body, 'plain', 'utf-8'))
+    message.attach(MIMEText(body, 'html' if html else 'plain', 'utf-8'))
     
     # Xử lý attachments
     if attachments:
@@ -71,38 +114,171 @@ def create_message(sender, to, subject, body, attachments=None, cc=None):
             encoders.encode_base64(part)
             part.add_header('Content-Disposition', 'attachment', filename=filename)
             message.attach(part)
+    
+    for part in attachment_parts or []:
+        message.attach(part)
 
     # Chuyển message thành format base64 cho Gmail API
     raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
     return {'raw': raw}
 
+def build_email_message(sender, to, subject, body, attachment_paths=None, cc=None, html=False):
+    """
+    Tạo message {'raw': ...} cho Gmail API
+    File đính kèm lấy từ attachment_cache (file dùng lại nhiều lần chỉ encode base64 1 lần)
+    """
+    attachment_parts = [attachment_cache.create_part(path) for path in attachment_paths or []]
+    
+    return create_message(
+        sender, to, subject, body, 
+        cc=cc,
+        attachment_parts=attachment_parts, # Gửi list attachments
+        html=html
+    )
+
 def send_email_oauth(service, sender, to, subject, body, attachment_paths=None, cc=None):
     """
     Gửi email qua Gmail API
     ✅ SỬA ĐỔI: Chấp nhận một danh sách các đường dẫn file (attachment_paths)
     """
     try:
-        attachments = []
-        if attachment_paths:
-            for path in attachment_paths:
-                file_name = os.path.basename(path)
-                with open(path, 'rb') as f:
-                    file_bytes = BytesIO(f.read())
-                attachments.append((file_name, file_bytes))
-        
-        message = create_message(
-            sender, to, subject, body, 
-            attachments=attachments, # Gửi list attachments
-            cc=cc
-        )
-        
-        service.users().messages().send(userId='me', body=message).execute()
-        return True, ""
-    except HttpError as error:
-        error_message = f'An error occurred: {error}'
-        return False, error_message
+        message = build_email_message(sender, to, subject, body, attachment_paths, cc)
     except Exception as e:
         return False, str(e)
+    success, error, _ = send_message_oauth(service, message)
+    return success, error
+
+def format_send_error(error):
+    """Nội dung lỗi ghi vào log"""
+    if isinstance(error, HttpError):
+        return f'An error occurred: {error}'
+    return str(error)
+
+def send_message_oauth(service, message, retry_policy=None, before_attempt=None, on_error=None):
+    """
+    Gửi 1 message đã tạo sẵn ({'raw': ...}) qua Gmail API
+    - retry_policy: retry lỗi 429/5xx (backoff + jitter), None = không retry
+    - before_attempt: gọi trước mỗi lần gửi (vd: lấy quota từ rate limiter)
+    - on_error(exception): gọi khi gửi thất bại (vd: kiểm tra lỗi do tài khoản gửi)
+    Trả về (success, error, message_id)
+    """
+    try:
+        request = service.users().messages().send(userId='me', body=message)
+        if retry_policy:
+            response = retry_policy.call(request.execute, before_attempt)
+        else:
+            if before_attempt:
+                before_attempt()
+            response = request.execute()
+        return True, "", (response or {}).get('id')
+    except Exception as e:
+        if on_error:
+            on_error(e)
+        return False, format_send_error(e), None
+
+def new_gmail_batch(service, callback):
+    """
+    Tạo BatchHttpRequest cho Gmail API
+    (batch URI lấy theo GMAIL_API_ENDPOINT nếu có, vì discovery doc luôn trỏ về googleapis.com)
+    """
+    if GMAIL_API_ENDPOINT:
+        batch_uri = GMAIL_API_ENDPOINT.rstrip('/') + '/batch/gmail/v1'
+        return BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+    return service.new_batch_http_request(callback=callback)
+
+def split_into_batches(items, max_requests=GMAIL_BATCH_MAX_REQUESTS, max_bytes=GMAIL_BATCH_MAX_BYTES):
+    """
+    Chia list (item, message) thành các batch
+    - Tối đa max_requests message / batch
+    - Tổng kích thước 'raw' không vượt max_bytes (message lớn hơn max_bytes đi riêng 1 batch)
+    """
+    batches = []
+    current = []
+    current_bytes = 0
+    for item, message in items:
+        size = len(message['raw'])
+        if current and (len(current) >= max_requests or current_bytes + size > max_bytes):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append((item, message))
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+def send_batch_oauth(service, items, rate_limiter=None, retry_policy=None, on_error=None):
+    """
+    Gửi 1 batch messages.send trong 1 HTTP request
+    items: list (key, message) -> trả về dict {key: (success, error, message_id)}
+    retry_policy: các request con bị 429/5xx (hoặc lỗi cả batch) được gửi lại trong batch mới
+    on_error(key, exception): gọi cho từng message gửi thất bại
+    """
+    outcomes = {}
+    pending = list(items)
+    attempt = 0
+    
+    while pending:
+        errors = {}
+        
+        def callback(request_id, response, exception):
+            if exception is None:
+                outcomes[request_id] = (True, "", (response or {}).get('id'))
+            else:
+                errors[request_id] = exception
+        
+        batch = new_gmail_batch(service, callback)
+        for key, message in pending:
+            if rate_limiter:
+                # Mỗi request con trong batch vẫn tính quota riêng
+                rate_limiter.acquire(GMAIL_SEND_QUOTA_COST)
+            batch.add(service.users().messages().send(userId='me', body=message), request_id=str(key))
+        
+        controller = retry_policy.controller if retry_policy else None
+        if controller:
+            controller.acquire()
+        try:
+            batch.execute()
+        except Exception as e:
+            # Lỗi cả batch (mạng, HTTP...) → các message chưa có kết quả dùng chung lỗi này
+            for key, _ in pending:
+                if str(key) not in outcomes:
+                    errors.setdefault(str(key), e)
+        finally:
+            if controller:
+                controller.release()
+        
+        retry_items = []
+        retry_error = None
+        for key, message in pending:
+            if str(key) in outcomes:
+                continue
+            error = errors.get(str(key))
+            if error is None:
+                outcomes[str(key)] = (False, "No response in batch", None)
+                continue
+            if retry_policy:
+                retry_policy.record_failure(error)
+                if retry_policy.should_retry(error, attempt):
+                    retry_items.append((key, message))
+                    if retry_error is None or get_retry_after(error) is not None:
+                        retry_error = error
+                    continue
+            outcomes[str(key)] = (False, format_send_error(error), None)
+            if on_error:
+                on_error(key, error)
+        
+        if retry_policy and len(retry_items) < len(pending):
+            retry_policy.record_success()
+        
+        if retry_items:
+            print(f"🔁 Retry {attempt + 1}/{retry_policy.max_retries}: {len(retry_items)}/{len(pending)} "
+                  f"messages in batch ({classify_error(retry_error)} error: {retry_error})")
+            retry_policy.wait_before_retry(attempt, retry_error)
+            attempt += 1
+        pending = retry_items
+    
+    return {key: outcomes.get(str(key), (False, "No response in batch", None)) for key, _ in items}
 
 
 def send_emails_oauth(
@@ -121,7 +297,19 @@ def send_emails_oauth(
     start_row=2,
     end_row=99999,
     progress_callback=None,
-    is_zip=None
+    is_zip=None,
+    max_workers=1,
+    quota_units_per_sec=None,
+    batch_size=0,
+    pipeline_queue_size=None,
+    checkpoint=None,
+    max_retries=5,
+    log_path=None,
+    senders=None,
+    on_sent=None,
+    load_contacts=None,
+    body_html=False,
+    should_stop=None
 ):
     """
     Gửi hàng loạt email
@@ -129,16 +317,71 @@ def send_emails_oauth(
     1. Quét và NHÓM file theo Mã ID.
     2. Lặp qua TỪNG NHÓM ID (thay vì từng file).
     3. Gửi 1 email duy nhất với NHIỀU file đính kèm cho mỗi ID.
+    4. Gửi song song bằng thread pool (max_workers), giới hạn tốc độ theo
+       quota Gmail (quota_units_per_sec).
+    5. batch_size > 1: gom nhiều email vào 1 Gmail batch request (BatchHttpRequest).
+    6. Tạo message (đọc file, encode MIME) chạy trước trong 1 thread riêng, song song với
+       lúc chờ Gmail API; pipeline_queue_size giới hạn số message chờ gửi trong bộ nhớ.
+    7. checkpoint (SendCheckpoint): ghi lại từng ID đã gửi; chạy lại cùng checkpoint
+       (resume sau khi worker bị kill) sẽ bỏ qua các ID đã gửi, không gửi trùng.
+    8. Lỗi 429/5xx được gửi lại tối đa max_retries lần (backoff + jitter, Retry-After);
+       khi bị rate limit, số request đồng thời của cả job tự giảm (AIMD) rồi tăng dần lại.
+    9. Log ghi dần từng dòng (theo thứ tự ID như lúc quét file, dòng gửi xong sớm chờ các dòng trước)
+       vào log_path → tải được log dở dang khi job đang chạy. Trả về log_path; không truyền log_path thì trả về BytesIO như cũ.
+    10. senders: list {'email', 'credentials', 'remaining'} → gửi bằng nhiều tài khoản (pool):
+       mỗi tài khoản có quota / retry riêng, ID được chia theo quota ngày còn lại & tỉ lệ lỗi;
+       tài khoản lỗi đăng nhập / hết quota ngày thì ID chuyển sang tài khoản khác.
+       Không truyền senders: chỉ gửi bằng credentials / sender_email như cũ.
+       on_sent(email): gọi sau mỗi email gửi thành công.
+    11. Credentials dạng ManagedCredentials được refresh nền trước khi hết hạn trong suốt job
+       (job chạy quá 1 giờ không bị lỗi token hết hạn).
+    12. load_contacts(columns): trả về DataFrame danh sách email chỉ gồm các cột cần dùng
+       (ContactListRegistry) → không đọc email_file_path nữa, chỉ lấy dòng start_row..end_row từ bảng này.
+    13. subject_template / body_template được biên dịch 1 lần (EmailTemplate): dùng được mọi cột
+       trong file email ({Tên cột}) & biến có sẵn ({ma_npp}, {ten_npp}, {so_file}, ...);
+       biến không có trong file email → báo lỗi trước khi gửi. body_html: nội dung dạng HTML.
+    14. should_stop() trả về True (worker đang dừng / job bị lấy lại): ngừng gửi tiếp, raise
+       PipelineStopped (các ID đã gửi có trong checkpoint, chạy lại sẽ gửi tiếp phần còn lại).
+    progress_callback(current, total, counts[, accounts]): counts = số ID success / failed / skipped;
+    accounts = tiến độ từng tài khoản (chỉ khi gửi bằng nhiều tài khoản).
     """
     
-    credentials = refresh_access_token_if_needed(credentials)
+    max_workers = max(1, int(max_workers or 1))
     
-    print("📧 Building Gmail service...")
-    service = build('gmail', 'v1', credentials=credentials)
+    # Tài khoản gửi: mỗi tài khoản refresh token riêng, tài khoản lỗi không làm hỏng cả job
+    multi_sender = bool(senders) and len(senders) > 1
+    if not senders:
+        senders = [{'email': sender_email, 'credentials': credentials}]
+    accounts = []
+    for item in senders:
+        account = SenderAccount(
+            item['email'], item['credentials'], item.get('remaining'),
+            max_workers=max_workers, quota_units_per_sec=quota_units_per_sec, max_retries=max_retries
+        )
+        try:
+            refresh_access_token_if_needed(account.credentials)
+        except Exception as e:
+            if not multi_sender:
+                raise
+            account.disabled_reason = f"Token refresh failed: {e}"
+            print(f"⚠️ Sender {account.email}: {account.disabled_reason}")
+        accounts.append(account)
+    pool = SenderPool(accounts, on_sent=on_sent)
+    if not any(account.available for account in accounts):
+        raise RuntimeError("Không có tài khoản gửi nào dùng được (lỗi đăng nhập / hết quota ngày)")
+    if multi_sender:
+        print(f"👥 Sender pool: {', '.join(account.email for account in accounts)}")
     
-    # Đọc danh sách email
-    df_email = pd.read_excel(email_file_path)
-    df_email = df_email.iloc[start_row-1:end_row] 
+    # Biên dịch mẫu email 1 lần cho cả job (các cột dùng trong mẫu cũng phải đọc từ file email)
+    subject_tpl = EmailTemplate(subject_template)
+    body_tpl = EmailTemplate(body_template, html=body_html)
+    
+    # Đọc danh sách email: chỉ các cột cần dùng & các dòng start_row..end_row (cache theo nội dung file)
+    contact_columns = [ref_col, email_col, cc_col, name_col] + subject_tpl.columns + body_tpl.columns
+    if load_contacts is not None:
+        df_email = select_contact_rows(load_contacts(contact_columns), contact_columns, start_row, end_row)
+    else:
+        df_email = load_contact_table(email_file_path, contact_columns, start_row, end_row)
     
     # Kiểm tra các cột
     print(f"🔍 Checking email list columns... (Ref: '{ref_col}', Name: '{name_col}')")
@@ -148,10 +391,26 @@ def send_emails_oauth(
         print(f"⚠️ Cảnh báo: Cột Tên '{name_col}' không tìm thấy. Tên sẽ được lấy từ tên file (nếu có).")
     if email_col not in df_email.columns:
         raise KeyError(f"Cột Email '{email_col}' không tìm thấy trong file email.")
+    validate_templates([subject_tpl, body_tpl], df_email.columns)
+    template_fields = set(subject_tpl.columns + body_tpl.columns)
+    template_columns = [col for col in df_email.columns if column_label(col) in template_fields]
         
     print("✅ Email list columns verified.")
     
-    logs = []
+    # Log ghi dần ra file (hoặc BytesIO nếu không có log_path), không giữ toàn bộ trong bộ nhớ
+    if log_path:
+        log = open_job_log(log_path)
+    else:
+        log, log_buffer = open_memory_log()
+    # Kết quả từng ID ghi theo thứ tự ID (không theo thứ tự gửi xong) → log thẳng hàng theo ID
+    ordered_log = OrderedLogWriter(log)
+    
+    def finish_log():
+        ordered_log.flush_pending()
+        if log_path:
+            log.close()
+            return log_path
+        return finish_memory_log(log, log_buffer)
     
     # ✅ BƯỚC 1: QUÉT VÀ NHÓM FILE THEO MÃ ID
     print("🔍 Scanning and grouping files by ID...")
@@ -160,16 +419,12 @@ def send_emails_oauth(
     
     if not all_files_in_folder:
         print("⚠️ Không tìm thấy file Excel nào để gửi.")
-        logs.append({
+        log.write({
             "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Code": "", "Name": "",
             "Email To": "", "Email CC": "", "Status": "Failed",
             "Error": "Không tìm thấy file Excel nào để gửi."
         })
-        df_log = pd.DataFrame([logs[0]])
-        output = BytesIO()
-        df_log.to_csv(output, index=False, encoding="utf-8-sig")
-        output.seek(0)
-        return output
+        return finish_log()
 
     for file in all_files_in_folder:
         try:
@@ -177,7 +432,7 @@ def send_emails_oauth(
             npp_code, _ = extract_parts_from_filename(file) 
             
             if not npp_code:
-                logs.append({
+                log.write({
                     "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Code": "", "Name": file,
                     "Email To": "", "Email CC": "", "Status": "Failed",
                     "Error": f"Không thể trích xuất Mã ID từ tên file '{file}'"
@@ -189,7 +444,7 @@ def send_emails_oauth(
             files_map[npp_code].append(full_path)
             
         except Exception as e:
-            logs.append({
+            log.write({
                 "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Code": "", "Name": file,
                 "Email To": "", "Email CC": "", "Status": "Failed",
                 "Error": f"Lỗi xử lý file '{file}': {e}"
@@ -197,49 +452,63 @@ def send_emails_oauth(
 
     print(f"✅ Found {len(all_files_in_folder)} files, grouped into {len(files_map)} unique IDs (jobs).")
 
-    # ✅ BƯỚC 2: LẶP QUA CÁC NHÓM ID, TÌM EMAIL VÀ GỬI
+    # ✅ BƯỚC 2: ĐỐI CHIẾU EMAIL CHO TỪNG NHÓM ID (chưa gửi)
     total_jobs = len(files_map)
+    recipient_index = build_recipient_index(df_email, ref_col)
+    
+    # Phát hiện trước các ID không có email / bị trùng (báo cáo trước khi gửi)
+    missing_codes = [code for code in files_map if str(code) not in recipient_index]
+    duplicate_codes = [code for code in files_map if len(recipient_index.get(str(code), ())) > 1]
+    print(f"🔎 Recipient index: {len(recipient_index)} codes, "
+          f"{len(missing_codes)} IDs without email, {len(duplicate_codes)} IDs with multiple matches")
+    send_tasks = []
+    resumed_count = 0
+    outcome_counts = {"success": 0, "failed": 0, "skipped": 0} # Số ID theo kết quả (báo tiến độ)
     
+    def write_result(log_row, seq):
+        ordered_log.write(seq, log_row)
+        outcome_counts[log_row["Status"].lower()] += 1
+    
+    today = datetime.now().strftime('%d/%m/%Y')
     for current, (npp_code, attachment_paths) in enumerate(files_map.items(), 1):
         email_to = ""
         email_cc = ""
         ten_npp = "Bạn" # Default
         
+        # Resume: ID đã gửi ở lần chạy trước → không gửi lại
+        if checkpoint is not None and checkpoint.is_sent(npp_code):
+            sent = checkpoint.get(npp_code)
+            write_result(make_log_row(
+                npp_code, "", sent.get('email_to') or "", "", "Success",
+                f"Đã gửi trước đó lúc {sent.get('time')} (Gmail ID: {sent.get('message_id')})"
+            ), current - 1)
+            resumed_count += 1
+            continue
+        
         try:
-            # Cập nhật tiến độ theo "job" (mỗi job là 1 ID, 1 email)
-            if progress_callback:
-                progress_callback(current, total_jobs)
-
             # BƯỚC 2A: TÌM DỮ LIỆU KHỚP (CHỈ ĐỐI CHIẾU MÃ ID)
             print(f"  > [{current}/{total_jobs}] Processing ID: {npp_code} ({len(attachment_paths)} files)")
             
-            match_id = (df_email[ref_col].astype(str).str.strip() == str(npp_code))
-            matched = df_email[match_id]
+            positions = recipient_index.get(str(npp_code), ())
 
-            if matched.empty:
-                logs.append({
-                    "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Code": npp_code,
-                    "Name": "N/A (No match)",
-                    "Email To": "N/A", "Email CC": "N/A", "Status": "Skipped",
-                    "Error": f"Không tìm thấy email khớp với Mã ID: {npp_code}"
-                })
+            if len(positions) == 0:
+                write_result(make_log_row(
+                    npp_code, "N/A (No match)", "N/A", "N/A", "Skipped",
+                    f"Không tìm thấy email khớp với Mã ID: {npp_code}"
+                ), current - 1)
                 print(f"⚠️ [{current}/{total_jobs}] Skipped: No match found for {npp_code}")
                 continue
             
-            if len(matched) > 1:
-                logs.append({
-                    "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Code": npp_code,
-                    "Name": "N/A (Multiple matches)",
-                    "Email To": "N/A", "Email CC": "N/A", "Status": "Skipped",
-                    "Error": f"Tìm thấy nhiều hơn 1 email khớp với Mã ID: {npp_code}"
-                })
+            if len(positions) > 1:
+                write_result(make_log_row(
+                    npp_code, "N/A (Multiple matches)", "N/A", "N/A", "Skipped",
+                    f"Tìm thấy nhiều hơn 1 email khớp với Mã ID: {npp_code}"
+                ), current - 1)
                 print(f"⚠️ [{current}/{total_jobs}] Skipped: Multiple matches found for {npp_code}")
                 continue
             
             # BƯỚC 2B: Lấy thông tin email (đã tìm thấy 1 match)
-            row = matched.iloc[0]
+            row = df_email.iloc[positions[0]]
             email_to = row[email_col] if email_col in row and pd.notna(row[email_col]) else ""
             email_cc = row[cc_col] if cc_col and cc_col in row and pd.notna(row[cc_col]) else ""
             
@@ -248,75 +517,234 @@ def send_emails_oauth(
                 ten_npp = row[name_col]
             
             if not email_to or str(email_to).strip() == "":
-                logs.append({
-                    "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Code": npp_code,
-                    "Name": ten_npp,
-                    "Email To": "N/A",
-                    "Email CC": email_cc if email_cc else "",
-                    "Status": "Skipped",
-                    "Error": "Địa chỉ email người nhận (TO) trống."
-                })
+                write_result(make_log_row(
+                    npp_code, ten_npp, "N/A", email_cc if email_cc else "", "Skipped",
+                    "Địa chỉ email người nhận (TO) trống."
+                ), current - 1)
                 print(f"⚠️ [{current}/{total_jobs}] Skipped: TO email is empty for {npp_code}")
                 continue
             
-            # BƯỚC 2C: Chuẩn bị và gửi email
-            subject = subject_template.replace("{ma_npp}", npp_code).replace("{ten_npp}", str(ten_npp))
-            body = body_template.replace("{ma_npp}", npp_code).replace("{ten_npp}", str(ten_npp))
-            
-            # GỬI EMAIL VỚI NHIỀU FILE
-            success, error = send_email_oauth(
-                service,
-                f"{sender_name} <{sender_email}>",
-                email_to,
-                subject,
-                body,
-                attachment_paths, # Gửi list paths
-                email_cc if email_cc and pd.notna(email_cc) and str(email_cc).strip() != "" else None
+            # BƯỚC 2C: Chuẩn bị nội dung email
+            context = {column_label(col): row[col] for col in template_columns}
+            context.update(
+                ma_npp=npp_code,
+                ten_npp=ten_npp,
+                email=email_to,
+                so_file=len(attachment_paths),
+                ds_file=", ".join(os.path.basename(path) for path in attachment_paths),
+                ngay=today
             )
+            subject = subject_tpl.render(context)
+            body = body_tpl.render(context)
             
-            if success:
-                logs.append({
-                    "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Code": npp_code,
-                    "Name": ten_npp,
-                    "Email To": email_to,
-                    "Email CC": email_cc if email_cc else "",
-                    "Status": "Success",
-                    "Error": f"Sent {len(attachment_paths)} files."
-                })
-                print(f"✅ [{current}/{total_jobs}] Sent to {email_to} ({npp_code} - {ten_npp}) with {len(attachment_paths)} files.")
-            else:
-                logs.append({
-                    "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Code": npp_code,
-                    "Name": ten_npp,
-                    "Email To": email_to,
-                    "Email CC": email_cc if email_cc else "",
-                    "Status": "Failed",
-                    "Error": error
-                })
-                print(f"❌ [{current}/{total_jobs}] Error sending to {email_to} ({npp_code}): {error}")
+            send_tasks.append({
+                "index": current - 1,
+                "npp_code": npp_code,
+                "ten_npp": ten_npp,
+                "email_to": email_to,
+                "email_cc": email_cc,
+                "subject": subject,
+                "body": body,
+                "attachment_paths": attachment_paths,
+                "cc_header": email_cc if email_cc and pd.notna(email_cc) and str(email_cc).strip() != "" else None,
+            })
 
         except Exception as e:
             # Log lỗi nghiêm trọng
-            logs.append({
-                "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "Code": npp_code,
-                "Name": ten_npp,
-                "Email To": email_to,
-                "Email CC": email_cc,
-                "Status": "Failed",
-                "Error": str(e)
-            })
+            write_result(make_log_row(npp_code, ten_npp, email_to, email_cc, "Failed", str(e)), current - 1)
             print(f"❌ [{current}/{total_jobs}] Critical Error for ID {npp_code}: {str(e)}")
 
-    # Ghi log vào BytesIO buffer
-    df_log = pd.DataFrame(logs)
+    if resumed_count:
+        print(f"⏭️ Resume: {resumed_count} IDs already sent (checkpoint), {len(send_tasks)} left to send")
+    
+    # ✅ BƯỚC 3: TẠO MESSAGE & GỬI EMAIL (pipeline, song song nếu max_workers > 1)
+    done_count = [total_jobs - len(send_tasks)] # Các ID bị skip coi như đã xử lý xong
+    progress_lock = threading.Lock()
+    
+    def report_progress():
+        if not progress_callback:
+            return
+        if multi_sender:
+            progress_callback(done_count[0], total_jobs, outcome_counts, pool.snapshot())
+        else:
+            progress_callback(done_count[0], total_jobs, outcome_counts)
+    
+    report_progress()
     
-    output = BytesIO()
-    df_log.to_csv(output, index=False, encoding="utf-8-sig")
-    output.seek(0)
+    thread_local = threading.local()
+    leases = []
+    
+    def get_service(account):
+        # googleapiclient/httplib2 không thread-safe → mỗi worker thread 1 service riêng / tài khoản
+        # (lấy từ pool dùng chung của process, kết nối keep-alive được dùng lại giữa các job)
+        thread_leases = getattr(thread_local, 'leases', None)
+        if thread_leases is None:
+            thread_leases = thread_local.leases = {}
+        lease = thread_leases.get(account.email)
+        if lease is None:
+            lease = thread_leases[account.email] = gmail_services.acquire(account.credentials, account.email)
+            with progress_lock:
+                leases.append(lease)
+        return lease.service
+    
+    def finish_task(task, success, error, message_id=None):
+        npp_code = task["npp_code"]
+        ten_npp = task["ten_npp"]
+        email_to = task["email_to"]
+        email_cc = task["email_cc"]
+        attachment_paths = task["attachment_paths"]
+        account = task.pop("account", None)
+        if account is not None:
+            pool.release(account, success)
+        via = f" via {account.email}" if multi_sender and account is not None else ""
+        
+        if success:
+            if checkpoint is not None:
+                checkpoint.record(npp_code, message_id, email_to)
+            log_row = make_log_row(
+                npp_code, ten_npp, email_to, email_cc if email_cc else "", "Success",
+                f"Sent {len(attachment_paths)} files."
+            )
+            print(f"✅ [{task['index'] + 1}/{total_jobs}] Sent to {email_to} ({npp_code} - {ten_npp}) with {len(attachment_paths)} files{via}.")
+        else:
+            log_row = make_log_row(npp_code, ten_npp, email_to, email_cc if email_cc else "", "Failed", error)
+            print(f"❌ [{task['index'] + 1}/{total_jobs}] Error sending to {email_to} ({npp_code}){via}: {error}")
+        
+        # Cập nhật tiến độ theo "job" (mỗi job là 1 ID, 1 email)
+        with progress_lock:
+            write_result(log_row, task["index"])
+            done_count[0] += 1
+            report_progress()
+    
+    def build_message(task):
+        # Chọn tài khoản gửi trước khi tạo message (địa chỉ From là email của tài khoản)
+        account = task.get("account")
+        if account is None:
+            account = pool.assign()
+            if account is None:
+                raise RuntimeError("Không còn tài khoản gửi nào khả dụng (lỗi đăng nhập / hết quota ngày)")
+            task["account"] = account
+        try:
+            return build_email_message(
+                f"{sender_name} <{account.email}>", task["email_to"], task["subject"], task["body"],
+                task["attachment_paths"], task["cc_header"], # Gửi list paths
+                html=body_html
+            )
+        except Exception:
+            task.pop("account", None)
+            pool.cancel(account)
+            raise
+    
+    def reroute(task, error):
+        """Tài khoản bị lỗi đăng nhập / hết quota ngày → tạo lại message bằng tài khoản khác (None nếu hết)"""
+        account = task.pop("account")
+        pool.disable(account, format_send_error(error))
+        next_account = pool.assign()
+        pool.release(account, False, rerouted=next_account is not None)
+        if next_account is None:
+            return None
+        print(f"🔀 {task['npp_code']}: {account.email} → {next_account.email}")
+        task["account"] = next_account
+        try:
+            return build_message(task)
+        except Exception as e:
+            print(f"❌ {task['npp_code']}: cannot rebuild message: {e}")
+            return None
+    
+    def send_one(task, message):
+        # GỬI EMAIL VỚI NHIỀU FILE
+        while True:
+            account = task["account"]
+            errors = []
+            success, error, message_id = send_message_oauth(
+                get_service(account), message, account.retry_policy, account.acquire_quota, errors.append
+            )
+            if success or not errors or not is_account_error(errors[-1]):
+                return task, success, error, message_id
+            message = reroute(task, errors[-1])
+            if message is None:
+                return task, False, f"{error} (không còn tài khoản gửi khả dụng)", None
+    
+    def send_single(items):
+        return [send_one(task, message) for task, message in items]
+    
+    def send_batches(items):
+        outcomes = []
+        # 1 batch chỉ gồm email của cùng 1 tài khoản
+        by_account = defaultdict(list)
+        for task, message in items:
+            by_account[task["account"].email].append((task, message))
+        for account_items in by_account.values():
+            account = account_items[0][0]["account"]
+            for batch in split_into_batches(account_items, max_requests=batch_size):
+                tasks_by_key = {task["index"]: (task, message) for task, message in batch}
+                errors = {}
+                try:
+                    results_by_key = send_batch_oauth(
+                        get_service(account),
+                        [(task["index"], message) for task, message in batch],
+                        account.rate_limiter,
+                        account.retry_policy,
+                        errors.__setitem__
+                    )
+                except Exception as e:
+                    results_by_key = {key: (False, str(e), None) for key in tasks_by_key}
+                for key, (success, error, message_id) in results_by_key.items():
+                    task, message = tasks_by_key[key]
+                    if not success and key in errors and is_account_error(errors[key]):
+                        message = reroute(task, errors[key])
+                        if message is not None:
+                            outcomes.append(send_one(task, message))
+                            continue
+                        error = f"{error} (không còn tài khoản gửi khả dụng)"
+                    outcomes.append((task, success, error, message_id))
+        return outcomes
+    
+    batch_size = min(int(batch_size or 0), GMAIL_BATCH_MAX_REQUESTS)
+    # Mỗi tài khoản có thể gửi max_workers request song song (quota Gmail tính theo user)
+    n_senders = max_workers * sum(1 for account in accounts if account.available)
+    
+    if batch_size > 1:
+        # Chế độ batch: mỗi worker gửi 1 nhóm tối đa batch_size email / HTTP request
+        print(f"🚀 Sending {len(send_tasks)} emails in batches of <= {batch_size} with {n_senders} worker(s)...")
+        send_fn, group_size = send_batches, batch_size
+    else:
+        print(f"🚀 Sending {len(send_tasks)} emails with {n_senders} worker(s)...")
+        send_fn, group_size = send_single, 1
+    
+    # Token được refresh nền trước khi hết hạn trong lúc gửi
+    for account in accounts:
+        if isinstance(account.credentials, ManagedCredentials) and account.available:
+            account.credentials.start_auto_refresh()
+    
+    # Pipeline: 1 thread tạo/encode message trước, các worker gửi song song (queue giới hạn bộ nhớ)
+    try:
+        timer = run_send_pipeline(
+            send_tasks, build_message, send_fn, finish_task,
+            n_senders=min(n_senders, max(1, len(send_tasks))),
+            group_size=group_size,
+            queue_size=pipeline_queue_size,
+            should_stop=should_stop
+        )
+    finally:
+        ordered_log.flush_pending()
+        log.flush()
+        for lease in leases:
+            gmail_services.release(lease)
+        for account in accounts:
+            if isinstance(account.credentials, ManagedCredentials):
+                account.credentials.stop_auto_refresh()
+    print(f"⏱️ Pipeline: {timer.summary()}")
+    if multi_sender:
+        print(f"👥 Sender pool: {pool.summary()}")
+    else:
+        print(f"🔁 Retry: {accounts[0].retry_policy.summary()}")
+    for account in accounts:
+        if isinstance(account.credentials, ManagedCredentials) and account.credentials.refresh_count:
+            print(f"🔑 Token {account.email}: {account.credentials.summary()}")
+    print(f"📧 Gmail HTTP pool: {gmail_services.created} created / {gmail_services.reused} reused (process total)")
     
+    print(f"📇 Email list cache: {contact_cache.hits} hits / {contact_cache.misses} misses (process total)")
+    print(f"📎 Attachment cache: {attachment_cache.hits} hits / {attachment_cache.misses} misses (process total)")
     print("✅ Email sending completed.\n")
-    return output
\ No newline at end of file
+    return finish_log()
\ No newline at end of file
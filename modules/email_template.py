@@ -0,0 +1,116 @@
+import re
+import html
+import math
+from datetime import datetime, date
+
+# {tên biến}: biến có sẵn hoặc tên cột trong file danh sách email; {{ / }} = dấu ngoặc thật
+PLACEHOLDER_RE = re.compile(r'\{\{|\}\}|\{([^{}]+)\}')
+
+# Biến có sẵn cho mỗi ID (ưu tiên hơn cột trùng tên trong file email)
+BUILTIN_FIELDS = {
+    'ma_npp': 'Mã ID (từ tên file)',
+    'ten_npp': 'Tên (cột Tên, không có thì "Bạn")',
+    'email': 'Email người nhận',
+    'so_file': 'Số file đính kèm',
+    'ds_file': 'Tên các file đính kèm',
+    'ngay': 'Ngày gửi (dd/mm/yyyy)',
+}
+
+
+def column_label(col):
+    """Tên cột trong file email → tên biến trong template (header số / ngày → chuỗi, bỏ khoảng trắng đầu cuối)"""
+    return str(col).strip()
+
+
+def format_value(value):
+    """Giá trị ô Excel → chuỗi trong email (ô trống → '', 12.0 → '12', ngày → dd/mm/yyyy)"""
+    if type(value) is str:
+        return value
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return str(int(value))
+        return str(value)
+    if isinstance(value, datetime):
+        if value != value: # NaT
+            return ""
+        if (value.hour, value.minute, value.second) == (0, 0, 0):
+            return value.strftime('%d/%m/%Y')
+        return value.strftime('%d/%m/%Y %H:%M')
+    if isinstance(value, date):
+        return value.strftime('%d/%m/%Y')
+    if str(value) in ('NaT', '<NA>'):
+        return ""
+    return str(value)
+
+
+class EmailTemplate:
+    """
+    Mẫu tiêu đề / nội dung email, biên dịch 1 lần / job
+    - Template được tách sẵn thành các đoạn chữ cố định & vị trí biến → mỗi lần render chỉ ghép
+      các đoạn (''.join), không quét lại cả nội dung cho từng biến như chuỗi .replace()
+    - fields: các biến dùng trong template (theo thứ tự xuất hiện, không trùng)
+    - html=True: giá trị được escape (nội dung email dạng HTML)
+    """
+
+    def __init__(self, source, html=False):
+        self.source = source or ""
+        self.html = html
+        self.fields = []
+        self._literals = [] # Đoạn chữ cố định trước mỗi biến (+ đoạn cuối)
+        self._slots = [] # Vị trí (trong fields) của biến thứ i trong template
+        text = []
+        last = 0
+        for match in PLACEHOLDER_RE.finditer(self.source):
+            text.append(self.source[last:match.start()])
+            last = match.end()
+            if match.group(1) is None:
+                text.append(match.group(0)[0]) # {{ → {, }} → }
+                continue
+            field = match.group(1).strip()
+            if field not in self.fields:
+                self.fields.append(field)
+            self._literals.append(''.join(text))
+            self._slots.append(self.fields.index(field))
+            text = []
+        text.append(self.source[last:])
+        self._literals.append(''.join(text))
+
+    @property
+    def columns(self):
+        """Các biến lấy từ cột trong file email (không phải biến có sẵn)"""
+        return [field for field in self.fields if field not in BUILTIN_FIELDS]
+
+    def missing_fields(self, columns):
+        """Biến không phải biến có sẵn & không có trong các cột của file email"""
+        available = set(column_label(col) for col in columns)
+        return [field for field in self.columns if field not in available]
+
+    def render(self, context):
+        """context: dict biến → giá trị (biến có sẵn + giá trị các cột của dòng)"""
+        get = context.get
+        if self.html:
+            values = [html.escape(format_value(get(field))) for field in self.fields]
+        else:
+            values = [format_value(get(field)) for field in self.fields]
+        parts = [None] * (2 * len(self._slots) + 1)
+        parts[0::2] = self._literals
+        parts[1::2] = [values[slot] for slot in self._slots]
+        return ''.join(parts)
+
+
+def validate_templates(templates, columns):
+    """Báo lỗi (ValueError) nếu template dùng biến không có trong file email, trước khi gửi"""
+    missing = []
+    for template in templates:
+        for field in template.missing_fields(columns):
+            if field not in missing:
+                missing.append(field)
+    if missing:
+        raise ValueError(
+            "Biến không có trong file email: " + ", ".join('{' + field + '}' for field in missing)
+            + " (biến có sẵn: " + ", ".join('{' + field + '}' for field in BUILTIN_FIELDS) + ")"
+        )
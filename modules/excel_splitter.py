@@ -1,11 +1,32 @@
-from flask import request, send_file
-import pandas as pd
+from flask import request, Response
 import openpyxl
-from openpyxl.styles import Font, Border, Side, PatternFill, Alignment
+from openpyxl.styles import Font, Border, PatternFill, Alignment
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.read_only import ReadOnlyCell
+from openpyxl.worksheet.cell_range import CellRange
+try:
+    # API nội bộ của openpyxl (đã test với bản trong requirements.txt): đọc được cả style / chiều cao dòng / merge
+    from openpyxl.worksheet._reader import WorkSheetParser
+except ImportError:
+    WorkSheetParser = None
 from io import BytesIO
 import zipfile
 import os
+import itertools
+import unicodedata
+from urllib.parse import quote
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from copy import copy
+
+# Số process tạo file Excel song song khi tách (1 = tuần tự trong request thread)
+SPLIT_MAX_WORKERS = int(os.environ.get('SPLIT_MAX_WORKERS', min(4, os.cpu_count() or 1)))
+# Ít file quá thì tạo tuần tự (chi phí khởi động process pool không đáng)
+SPLIT_PARALLEL_MIN_FILES = int(os.environ.get('SPLIT_PARALLEL_MIN_FILES', 20))
+
+# Độ rộng cột mặc định của openpyxl (cột không khai báo width trong file gốc)
+DEFAULT_COLUMN_WIDTH = 13
 
 def column_letter_to_index(col_letter):
     """
@@ -20,252 +41,588 @@ def column_letter_to_index(col_letter):
         result = result * 26 + (ord(char) - ord('A') + 1)
     return result
 
-def split_excel_new():
+class SplitError(ValueError):
+    """Lỗi do dữ liệu người dùng nhập (trả về 400 / job failed kèm thông báo)"""
+
+
+def read_split_options(form, filename=None):
     """
-    Tách file Excel - FIX: Copy đúng header + data + chỉ các cột chọn
+    Đọc & kiểm tra các tham số tách file từ form
+    Raise SplitError nếu thiếu/sai tham số
     """
+    sheet_name = form.get('sheet_name')
+    template_end_row = form.get('template_end_row')
+    start_row = form.get('start_row')
+    end_row = form.get('end_row')
+    split_column = form.get('split_column')
+    start_col = form.get('start_col', '').strip()
+    end_col = form.get('end_col', '').strip()
+    name_col = form.get('name_col')
     
-    file = request.files.get('file')
-    sheet_name = request.form.get('sheet_name')
-    template_end_row = request.form.get('template_end_row')
-    start_row = request.form.get('start_row')
-    end_row = request.form.get('end_row')
-    split_column = request.form.get('split_column')
-    start_col = request.form.get('start_col', '').strip()
-    end_col = request.form.get('end_col', '').strip()
-    name_col = request.form.get('name_col')
-    
-    if not file or not sheet_name or not split_column or not template_end_row or not start_row or not end_row:
-        return "❌ Missing required fields!", 400
+    if not sheet_name or not split_column or not template_end_row or not start_row or not end_row:
+        raise SplitError("❌ Missing required fields!")
     
     try:
         template_end_row = int(template_end_row)
         start_row = int(start_row)
         end_row = int(end_row)
     except ValueError:
-        return "❌ Invalid row numbers!", 400
+        raise SplitError("❌ Invalid row numbers!")
     
-    try:
-        file_bytes = file.read()
-        
-        # ✅ SỬA ĐỔI: Lấy tên file gốc và làm sạch nó
-        original_filename_cleaned = "file_goc"
-        if file and file.filename:
-            # Tách tên, bỏ phần đuôi file (ví dụ: .xlsx)
-            original_filename_cleaned = os.path.splitext(file.filename)[0]
-            # Làm sạch tên file gốc (loại bỏ ký tự đặc biệt)
-            original_filename_cleaned = original_filename_cleaned.replace("/", "_").replace("\\", "_").replace(":", "_")
-            original_filename_cleaned = original_filename_cleaned.replace("*", "_").replace("?", "_").replace('"', "_")
-            original_filename_cleaned = original_filename_cleaned.replace(" ", "") # Loại bỏ khoảng trắng cho gọn
-        
-        # Parse column range
-        start_col_idx = None
-        end_col_idx = None
-        
-        if start_col:
-            start_col_idx = column_letter_to_index(start_col)
-            if not start_col_idx:
-                return f"❌ Invalid start column: {start_col}", 400
-        
-        if end_col:
-            end_col_idx = column_letter_to_index(end_col)
-            if not end_col_idx:
-                return f"❌ Invalid end column: {end_col}", 400
-        
-        print(f"\n🔍 [Split] Sheet: {sheet_name}, Split Column: {split_column}")
-        print(f"  Template End: {template_end_row}, Data: {start_row}-{end_row}")
-        if start_col_idx or end_col_idx:
-            print(f"  Column Range: {start_col or 'A'} to {end_col or 'Last'}")
-        
-        # Đọc file gốc (KHÔNG skip dòng nào)
-        wb_orig = openpyxl.load_workbook(BytesIO(file_bytes))
-        ws_orig = wb_orig[sheet_name]
-        
-        # Tìm header ở dòng template_end_row
-        header_row_cells = []
-        split_col_idx = None
-        name_col_idx = None
-        
-        # Xác định max column cần đọc
-        max_col_to_read = ws_orig.max_column
-        if end_col_idx and end_col_idx < max_col_to_read:
-            max_col_to_read = end_col_idx
-        
-        min_col_to_read = 1
-        if start_col_idx and start_col_idx > 1:
-            min_col_to_read = start_col_idx
-        
-        for col_idx in range(min_col_to_read, max_col_to_read + 1):
-            cell_val = str(ws_orig.cell(template_end_row, col_idx).value).strip().lower()
-            header_row_cells.append(cell_val)
-            
-            if cell_val == split_column.lower():
-                split_col_idx = col_idx
-            
-            if name_col and cell_val == name_col.lower():
-                name_col_idx = col_idx
-        
-        if split_col_idx is None:
-            return f"❌ Column '{split_column}' not found! Available: {', '.join([c for c in header_row_cells if c != 'nan'])}", 400
-        
-        print(f"  ✅ Found split column at col {split_col_idx}")
-        
-        # Đọc data từ start_row đến end_row
-        data_rows = []
-        for row_idx in range(start_row, end_row + 1):
-            # Kiểm tra xem dòng này có data không (check cột split)
-            split_val = ws_orig.cell(row=row_idx, column=split_col_idx).value
-            if split_val and str(split_val).strip() and str(split_val).lower() != 'nan':
-                data_rows.append((split_val, row_idx))
-        
-        print(f"  ✅ Found {len(data_rows)} data rows")
+    # ✅ SỬA ĐỔI: Lấy tên file gốc và làm sạch nó
+    original_filename_cleaned = "file_goc"
+    if filename:
+        # Tách tên, bỏ phần đuôi file (ví dụ: .xlsx)
+        original_filename_cleaned = os.path.splitext(filename)[0]
+        # Làm sạch tên file gốc (loại bỏ ký tự đặc biệt)
+        original_filename_cleaned = original_filename_cleaned.replace("/", "_").replace("\\", "_").replace(":", "_")
+        original_filename_cleaned = original_filename_cleaned.replace("*", "_").replace("?", "_").replace('"', "_")
+        original_filename_cleaned = original_filename_cleaned.replace(" ", "") # Loại bỏ khoảng trắng cho gọn
+    
+    # Parse column range
+    start_col_idx = None
+    end_col_idx = None
+    
+    if start_col:
+        start_col_idx = column_letter_to_index(start_col)
+        if not start_col_idx:
+            raise SplitError(f"❌ Invalid start column: {start_col}")
+    
+    if end_col:
+        end_col_idx = column_letter_to_index(end_col)
+        if not end_col_idx:
+            raise SplitError(f"❌ Invalid end column: {end_col}")
+    
+    return {
+        'sheet_name': sheet_name,
+        'template_end_row': template_end_row,
+        'start_row': start_row,
+        'end_row': end_row,
+        'split_column': split_column,
+        'start_col': start_col,
+        'end_col': end_col,
+        'start_col_idx': start_col_idx,
+        'end_col_idx': end_col_idx,
+        'name_col': name_col,
+        'original_filename_cleaned': original_filename_cleaned,
+        'download_name': f"tach_theo_{split_column}.zip",
+    }
+
+def prepare_split(file_bytes, options):
+    """
+    Đọc file gốc (1 lượt), nhóm dữ liệu theo cột split
+    Trả về (template, file_jobs): file_jobs là list (filename, group_rows)
+    template['warning']: file output bị mất định dạng (không đọc được style / merge...), None nếu không
+    Raise SplitError nếu không tìm thấy sheet/cột/dữ liệu
+    """
+    sheet_name = options['sheet_name']
+    template_end_row = options['template_end_row']
+    start_row = options['start_row']
+    end_row = options['end_row']
+    split_column = options['split_column']
+    start_col_idx = options['start_col_idx']
+    end_col_idx = options['end_col_idx']
+    name_col = options['name_col']
+    
+    print(f"\n🔍 [Split] Sheet: {sheet_name}, Split Column: {split_column}")
+    print(f"  Template End: {template_end_row}, Data: {start_row}-{end_row}")
+    if start_col_idx or end_col_idx:
+        print(f"  Column Range: {options['start_col'] or 'A'} to {options['end_col'] or 'Last'}")
+    
+    # Đọc file gốc 1 lần duy nhất (read-only, stream từng dòng)
+    wb_orig = openpyxl.load_workbook(BytesIO(file_bytes), read_only=True)
+    if sheet_name not in wb_orig.sheetnames:
+        wb_orig.close()
+        raise SplitError(f"❌ Sheet '{sheet_name}' not found!")
+    ws_orig = wb_orig[sheet_name]
+    sheet_data = read_sheet_streaming(ws_orig, template_end_row, start_row, end_row, end_col_idx)
+    style_cache = CellStyleCache(ws_orig)
+    
+    # ✅ Đã parse xong: đóng file gốc, chỉ giữ lại dữ liệu đã đọc + bảng style
+    wb_orig.close()
+    
+    # Tìm header ở dòng template_end_row
+    header_row_cells = []
+    split_col_idx = None
+    name_col_idx = None
+    
+    # Xác định max column cần đọc
+    max_col_to_read = sheet_data['max_column']
+    if end_col_idx and end_col_idx < max_col_to_read:
+        max_col_to_read = end_col_idx
+    
+    min_col_to_read = 1
+    if start_col_idx and start_col_idx > 1:
+        min_col_to_read = start_col_idx
+    
+    header_values = sheet_data['template_rows'].get(template_end_row, ())
+    for col_idx in range(min_col_to_read, max_col_to_read + 1):
+        value = header_values[col_idx - 1][0] if col_idx <= len(header_values) else None
+        cell_val = str(value).strip().lower()
+        header_row_cells.append(cell_val)
         
-        if len(data_rows) == 0:
-            return "❌ No data found in range!", 400
+        if cell_val == split_column.lower():
+            split_col_idx = col_idx
         
-        # Nhóm dữ liệu theo cột split
-        grouped_data = {}
-        for split_val, row_idx in data_rows:
+        if name_col and cell_val == name_col.lower():
+            name_col_idx = col_idx
+    
+    if split_col_idx is None:
+        raise SplitError(f"❌ Column '{split_column}' not found! Available: {', '.join([c for c in header_row_cells if c != 'nan'])}")
+    
+    print(f"  ✅ Found split column at col {split_col_idx}")
+    
+    # Nhóm dữ liệu theo cột split (bỏ các dòng trống ở cột split)
+    grouped_data = {}
+    data_row_count = 0
+    for row_idx, row_cells in sheet_data['data_rows']:
+        split_val = row_cells[split_col_idx - 1][0] if split_col_idx <= len(row_cells) else None
+        if split_val and str(split_val).strip() and str(split_val).lower() != 'nan':
+            data_row_count += 1
             code = str(split_val).strip()
             if code not in grouped_data:
                 grouped_data[code] = []
-            grouped_data[code].append(row_idx)
-        
-        print(f"  ✅ Grouped into {len(grouped_data)} files")
-        
-        # Tạo ZIP
-        zip_buffer = BytesIO()
-        file_count = 0
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for code, row_indices in grouped_data.items():
-                file_count += 1
-                
-                mã = code.replace("/", "_").replace("\\", "_").replace(":", "_")
-                mã = mã.replace("*", "_").replace("?", "_").replace('"', "_")
-                
-                filename_part1 = mã # Tên file phần 1 (Mã)
-                
-                if name_col_idx and name_col_idx >= min_col_to_read:
-                    row_idx_first = row_indices[0]
-                    tên = str(ws_orig.cell(row=row_idx_first, column=name_col_idx).value).strip()
-                    tên = tên.replace("/", "_").replace("\\", "_")
-                    filename_part1 = f"{mã}-{tên}" # Tên file phần 1 (Mã-Tên)
-                
-                # ✅ SỬA ĐỔI: Nối tên file gốc vào
-                final_filename = f"{filename_part1}-{original_filename_cleaned}"
-                
-                print(f"  [{file_count}] Creating: {final_filename}.xlsx")
-                
-                # Tạo file Excel
-                buf = create_excel_file(
-                    BytesIO(file_bytes),
-                    ws_orig,
-                    sheet_name,
-                    template_end_row,
-                    row_indices,
-                    min_col_to_read,
-                    max_col_to_read
-                )
-                
-                # Sử dụng tên file cuối cùng
-                zipf.writestr(f"{final_filename}.xlsx", buf.read())
+            grouped_data[code].append((row_idx, row_cells))
+    
+    print(f"  ✅ Found {data_row_count} data rows")
+    
+    if data_row_count == 0:
+        raise SplitError("❌ No data found in range!")
+    
+    print(f"  ✅ Grouped into {len(grouped_data)} files")
+    
+    # Template (header, độ rộng cột, merged cells...) chỉ chuẩn bị 1 lần cho cả job
+    template = build_template_snapshot(sheet_data, style_cache, min_col_to_read, max_col_to_read)
+    
+    # Đặt tên file cho từng nhóm
+    file_jobs = []
+    for code, group_rows in grouped_data.items():
+        mã = code.replace("/", "_").replace("\\", "_").replace(":", "_")
+        mã = mã.replace("*", "_").replace("?", "_").replace('"', "_")
         
-        zip_buffer.seek(0)
+        filename_part1 = mã # Tên file phần 1 (Mã)
         
-        print(f"  ✅ Total files: {file_count}\n")
+        if name_col_idx and name_col_idx >= min_col_to_read:
+            first_row_cells = group_rows[0][1]
+            name_value = first_row_cells[name_col_idx - 1][0] if name_col_idx <= len(first_row_cells) else None
+            tên = str(name_value).strip()
+            tên = tên.replace("/", "_").replace("\\", "_")
+            filename_part1 = f"{mã}-{tên}" # Tên file phần 1 (Mã-Tên)
         
-        return send_file(
-            zip_buffer,
-            as_attachment=True,
-            download_name=f"tach_theo_{split_column}.zip",
-            mimetype='application/zip'
-        )
+        # ✅ SỬA ĐỔI: Nối tên file gốc vào
+        final_filename = f"{filename_part1}-{options['original_filename_cleaned']}"
+        file_jobs.append((f"{final_filename}.xlsx", group_rows))
     
+    return template, file_jobs
+
+def split_excel_new():
+    """
+    Tách file Excel - FIX: Copy đúng header + data + chỉ các cột chọn
+    (đồng bộ: stream ZIP trực tiếp trong response)
+    """
+    
+    file = request.files.get('file')
+    if not file:
+        return "❌ Missing required fields!", 400
+    
+    try:
+        options = read_split_options(request.form, file.filename)
+        template, file_jobs = prepare_split(file.read(), options)
+    except SplitError as e:
+        return str(e), 400
     except Exception as e:
         print(f"❌ Error: {str(e)}")
         import traceback
         traceback.print_exc()
         return f"❌ Error: {str(e)}", 500
+    
+    # Stream ZIP về trình duyệt: file Excel nào tạo xong thì gửi luôn, không gom cả ZIP trong RAM
+    def generate():
+        file_count = 0
+        excel_files = generate_excel_files(template, file_jobs, SPLIT_MAX_WORKERS)
+        try:
+            for filename, chunk in stream_zip(excel_files):
+                if filename:
+                    file_count += 1
+                    print(f"  [{file_count}/{len(file_jobs)}] Created: {filename}")
+                yield chunk
+            print(f"  ✅ Total files: {file_count}\n")
+        except Exception as e:
+            # Đã gửi header 200 → chỉ có thể dừng stream (trình duyệt nhận ZIP lỗi)
+            print(f"❌ Error while streaming ZIP: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            raise
+    
+    response = Response(generate(), mimetype='application/zip')
+    set_attachment_header(response, options['download_name'])
+    response.headers['X-Accel-Buffering'] = 'no' # Không cho proxy buffer lại response
+    return response
 
-def create_excel_file(orig_file, ws_orig, sheet_name, template_end_row, row_indices, min_col, max_col):
+def split_excel_to_file(file_bytes, options, zip_path, progress_callback=None):
+    """
+    Tách file Excel và ghi ZIP ra đĩa (dùng cho job chạy nền)
+    progress_callback(current, total): số file đã tạo / tổng số file
+    Trả về {'file_count': số file đã tạo, 'warning': cảnh báo cho user (file bị mất định dạng) hoặc None}
     """
-    Tạo file Excel: copy template + ghi data (FIX: chỉ copy cột cần thiết)
+    template, file_jobs = prepare_split(file_bytes, options)
+    del file_bytes
+    total = len(file_jobs)
+    if progress_callback:
+        progress_callback(0, total)
+    
+    # Ghi ra file tạm rồi mới đổi tên → không bao giờ tải về ZIP ghi dở
+    temp_path = f"{zip_path}.part"
+    file_count = 0
+    with open(temp_path, 'wb') as f:
+        for filename, chunk in stream_zip(generate_excel_files(template, file_jobs, SPLIT_MAX_WORKERS)):
+            f.write(chunk)
+            if filename:
+                file_count += 1
+                print(f"  [{file_count}/{total}] Created: {filename}")
+                if progress_callback:
+                    progress_callback(file_count, total)
+    os.replace(temp_path, zip_path)
+    
+    print(f"  ✅ Total files: {file_count}\n")
+    return {'file_count': file_count, 'warning': template['warning']}
+
+class ZipStreamBuffer:
+    """File-like chỉ ghi (không seek/tell) để zipfile ghi ZIP dạng stream (dùng data descriptor)"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
     
-    :param row_indices: List các dòng data cần copy
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(files):
+    """
+    Ghi ZIP dạng stream từ các (filename, bytes)
+    Yield (filename, chunk) ngay sau khi mỗi file được ghi; chunk cuối (filename=None) là central directory
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for filename, file_data in files:
+            zipf.writestr(filename, file_data)
+            yield filename, buffer.pop()
+    yield None, buffer.pop()
+
+def set_attachment_header(response, download_name):
+    """Content-Disposition: attachment (giống send_file, hỗ trợ tên file tiếng Việt)"""
+    try:
+        download_name.encode("ascii")
+        options = {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        options = {"filename": simple, "filename*": f"UTF-8''{quote(download_name, safe='')}"}
+    response.headers.set("Content-Disposition", "attachment", **options)
+
+def read_sheet_streaming(ws_orig, template_end_row, start_row, end_row, max_col=None):
+    """
+    Đọc sheet (read-only) đúng 1 lượt từ trên xuống, không random access
+    Trả về dict:
+    - template_end_row: dòng cuối của template
+    - template_rows: {row_idx: [(value, style_id), ...]} cho dòng 1..template_end_row
+    - data_rows: [(row_idx, [(value, style_id), ...]), ...] cho dòng start_row..end_row
+    - row_heights: {row_idx: height} (chỉ các dòng template/data có chiều cao riêng)
+    - column_widths: {col_idx: width}
+    - merged_ranges: list CellRange nằm trong vùng template
+    - max_column: cột lớn nhất có dữ liệu
+    - warning: lý do file output bị mất định dạng (chỉ khi phải đọc bằng iter_rows), None nếu không
+    
+    :param max_col: Nếu có, bỏ qua các cột sau cột này (giảm bộ nhớ)
+    
+    openpyxl không còn API nội bộ (WorkSheetParser...) → đọc bằng iter_rows công khai (xem read_sheet_values)
+    """
+    if WorkSheetParser is not None and hasattr(ws_orig, '_get_source'):
+        try:
+            sheet_data = read_sheet_parser(ws_orig, template_end_row, start_row, end_row, max_col)
+            sheet_data['warning'] = None
+            return sheet_data
+        except (AttributeError, TypeError) as e:
+            reason = f"openpyxl internal reader failed ({e})"
+    else:
+        reason = "openpyxl internal reader not available"
+    print(f"⚠️ [Split] {reason} - falling back to iter_rows")
+    sheet_data = read_sheet_values(ws_orig, template_end_row, start_row, end_row, max_col)
+    sheet_data['warning'] = (
+        f"⚠️ Output files contain values only: cell styles, column widths, row heights and merged cells "
+        f"were not copied ({reason})"
+    )
+    return sheet_data
+
+def read_sheet_values(ws_orig, template_end_row, start_row, end_row, max_col=None):
+    """
+    Như read_sheet_streaming nhưng chỉ dùng API công khai iter_rows(values_only=True):
+    chỉ có giá trị (style mặc định), không có chiều cao dòng / độ rộng cột / merged cells
+    """
+    template_rows = {}
+    data_rows = []
+    max_column = 0
+    rows = ws_orig.iter_rows(max_row=max(template_end_row, end_row), max_col=max_col, values_only=True)
+    for row_idx, values in enumerate(rows, 1):
+        is_template = row_idx <= template_end_row
+        is_data = start_row <= row_idx <= end_row
+        if not is_template and not is_data:
+            continue
+        values = list(values)
+        # Bỏ các ô trống cuối dòng (giống file xlsx không ghi ô rỗng)
+        while values and values[-1] is None:
+            values.pop()
+        row_cells = [(value, 0) for value in values]
+        max_column = max(max_column, len(row_cells))
+        if is_template:
+            template_rows[row_idx] = row_cells
+        if is_data:
+            data_rows.append((row_idx, row_cells))
+    
+    return {
+        'template_end_row': template_end_row,
+        'template_rows': template_rows,
+        'data_rows': data_rows,
+        'row_heights': {},
+        'column_widths': {},
+        'merged_ranges': [],
+        'max_column': max_column,
+    }
+
+def read_sheet_parser(ws_orig, template_end_row, start_row, end_row, max_col=None):
+    """read_sheet_streaming bằng WorkSheetParser của openpyxl (giữ style_id, chiều cao dòng, merge)"""
+    template_rows = {}
+    data_rows = []
+    row_heights = {}
+    max_column = 0
+    
+    with ws_orig._get_source() as src:
+        parser = WorkSheetParser(
+            src,
+            ws_orig._shared_strings,
+            epoch=ws_orig.parent.epoch,
+            date_formats=ws_orig.parent._date_formats,
+            timedelta_formats=ws_orig.parent._timedelta_formats
+        )
+        
+        for row_idx, cells in parser.parse():
+            # Lấy chiều cao dòng rồi bỏ luôn khỏi parser để bộ nhớ không tăng theo số dòng
+            row_dim = parser.row_dimensions.pop(str(row_idx), None)
+            
+            is_template = row_idx <= template_end_row
+            is_data = start_row <= row_idx <= end_row
+            if not is_template and not is_data:
+                # Vẫn đọc tiếp tới hết để lấy mergeCells (nằm sau sheetData) nhưng không giữ dữ liệu
+                continue
+            
+            row_cells = []
+            for cell in cells:
+                col_idx = cell['column']
+                if max_col and col_idx > max_col:
+                    break
+                # Điền ô trống (file xlsx không ghi các ô rỗng)
+                while len(row_cells) < col_idx - 1:
+                    row_cells.append((None, 0))
+                row_cells.append((cell['value'], cell['style_id'] or 0))
+            max_column = max(max_column, len(row_cells))
+            
+            if row_dim and row_dim.get('ht'):
+                row_heights[row_idx] = float(row_dim['ht'])
+            
+            if is_template:
+                template_rows[row_idx] = row_cells
+            if is_data:
+                data_rows.append((row_idx, row_cells))
+    
+    # Độ rộng cột (1 thẻ <col> có thể áp dụng cho nhiều cột min..max)
+    column_widths = {}
+    for attrs in parser.column_dimensions.values():
+        if attrs.get('width'):
+            for col_idx in range(int(attrs['min']), int(attrs.get('max', attrs['min'])) + 1):
+                column_widths[col_idx] = float(attrs['width'])
+    
+    merged_ranges = []
+    if parser.merged_cells is not None:
+        for merge_cell in parser.merged_cells.mergeCell:
+            cell_range = CellRange(merge_cell.ref)
+            if cell_range.max_row <= template_end_row:
+                merged_ranges.append(cell_range)
+    
+    return {
+        'template_end_row': template_end_row,
+        'template_rows': template_rows,
+        'data_rows': data_rows,
+        'row_heights': row_heights,
+        'column_widths': column_widths,
+        'merged_ranges': merged_ranges,
+        'max_column': max_column,
+    }
+
+def build_template_snapshot(sheet_data, style_cache, min_col, max_col):
+    """
+    Chuẩn bị sẵn phần dùng chung cho mọi file output (1 lần / job):
+    - Độ rộng cột, merged cells đã cắt theo min_col..max_col
+    - Các dòng template đã cắt cột (ô bị merge để trống) + chiều cao dòng
+    
+    :param sheet_data: Kết quả của read_sheet_streaming
+    :param style_cache: CellStyleCache của job - tra style theo style_id gốc
     :param min_col: Cột bắt đầu (1-based index)
     :param max_col: Cột kết thúc (1-based index)
     """
-    wb_new = openpyxl.Workbook()
-    ws_new = wb_new.active
+    template_end_row = sheet_data['template_end_row']
+    row_heights = sheet_data['row_heights']
     
-    # Copy column widths (chỉ các cột được chọn)
+    # Độ rộng cột (chỉ các cột được chọn)
+    column_widths = []
     for col_idx in range(min_col, max_col + 1):
-        col_letter = get_column_letter(col_idx)
-        col_letter_new = get_column_letter(col_idx - min_col + 1)
-        
-        col_dim_orig = ws_orig.column_dimensions[col_letter]
-        col_dim_new = ws_new.column_dimensions[col_letter_new]
-        
-        if col_dim_orig.width:
-            col_dim_new.width = col_dim_orig.width
+        width = sheet_data['column_widths'].get(col_idx, DEFAULT_COLUMN_WIDTH)
+        if width:
+            column_widths.append((get_column_letter(col_idx - min_col + 1), width))
     
-    # Copy row heights
-    for row_num in range(1, template_end_row + 1):
-        if row_num in ws_orig.row_dimensions:
-            row_dim_orig = ws_orig.row_dimensions[row_num]
-            row_dim_new = ws_new.row_dimensions[row_num]
-            if row_dim_orig.height:
-                row_dim_new.height = row_dim_orig.height
+    # Merged cells (chỉ những cells trong range cột)
+    merged_ranges = []
+    hidden_by_merge = set()
+    for merged_range in sheet_data['merged_ranges']:
+        # Check if merged range overlaps with our column range
+        if merged_range.min_col <= max_col and merged_range.max_col >= min_col:
+            min_merged_col = max(merged_range.min_col, min_col)
+            max_merged_col = min(merged_range.max_col, max_col)
+            
+            min_merged_col_new = min_merged_col - min_col + 1
+            max_merged_col_new = max_merged_col - min_col + 1
+            
+            merged_ranges.append(f"{get_column_letter(min_merged_col_new)}{merged_range.min_row}:{get_column_letter(max_merged_col_new)}{merged_range.max_row}")
+            
+            # Các ô bị merge (trừ ô góc trên trái) không giữ giá trị
+            for row_idx in range(merged_range.min_row, merged_range.max_row + 1):
+                for col_idx in range(min_merged_col, max_merged_col + 1):
+                    if (row_idx, col_idx) != (merged_range.min_row, min_merged_col):
+                        hidden_by_merge.add((row_idx, col_idx))
     
-    # Copy template (dòng 1 đến template_end_row) - GIỮ NGUYÊN FORMAT
+    # Dòng template: (chiều cao, [(value, style_id), ...]) đã cắt theo cột
+    template_rows = []
     for row_idx in range(1, template_end_row + 1):
-        for col_idx in range(min_col, max_col + 1):
-            cell_o = ws_orig.cell(row=row_idx, column=col_idx)
-            cell_n = ws_new.cell(row=row_idx, column=col_idx - min_col + 1)
-            
-            cell_n.value = cell_o.value
-            if cell_o.has_style:
-                copy_cell_style(cell_o, cell_n)
-    
-    # Copy merged cells (chỉ những cells trong range cột)
-    for merged_range in ws_orig.merged_cells.ranges:
-        if merged_range.max_row <= template_end_row:
-            # Check if merged range overlaps with our column range
-            if merged_range.min_col <= max_col and merged_range.max_col >= min_col:
-                try:
-                    min_merged_col = max(merged_range.min_col, min_col)
-                    max_merged_col = min(merged_range.max_col, max_col)
-                    
-                    min_merged_col_new = min_merged_col - min_col + 1
-                    max_merged_col_new = max_merged_col - min_col + 1
-                    
-                    merged_range_new = f"{get_column_letter(min_merged_col_new)}{merged_range.min_row}:{get_column_letter(max_merged_col_new)}{merged_range.max_row}"
-                    ws_new.merge_cells(merged_range_new)
-                except:
-                    pass
+        row_cells = clip_row_cells(sheet_data['template_rows'].get(row_idx, ()), min_col, max_col)
+        row_cells = [
+            (None, style_id) if (row_idx, col_idx) in hidden_by_merge else (value, style_id)
+            for col_idx, (value, style_id) in enumerate(row_cells, min_col)
+        ]
+        template_rows.append((row_heights.get(row_idx), row_cells))
     
-    # Ghi dữ liệu
-    data_start_row = template_end_row + 1
-    for idx, orig_row_idx in enumerate(row_indices):
-        excel_row = data_start_row + idx
+    return {
+        'style_cache': style_cache,
+        'min_col': min_col,
+        'max_col': max_col,
+        'column_widths': column_widths,
+        'merged_ranges': merged_ranges,
+        'template_rows': template_rows,
+        'row_heights': row_heights,
+        'warning': sheet_data.get('warning'),
+    }
+
+def generate_excel_files(template, file_jobs, max_workers=1):
+    """
+    Tạo các file Excel output, yield (filename, bytes) theo thứ tự file nào xong trước
+    - max_workers <= 1 hoặc ít file: tạo tuần tự trong thread hiện tại
+    - Ngược lại: chia cho process pool (openpyxl + zlib thuần CPU, không bị GIL giới hạn)
+    
+    :param file_jobs: List (filename, group_rows)
+    """
+    if max_workers <= 1 or len(file_jobs) < SPLIT_PARALLEL_MIN_FILES:
+        for filename, group_rows in file_jobs:
+            yield filename, create_excel_file(template, group_rows).getvalue()
+        return
+    
+    # Tạo sẵn toàn bộ style trước khi gửi template sang process con
+    template['style_cache'].preload_all()
+    
+    # forkserver/spawn: không fork trực tiếp từ process web đang chạy nhiều thread
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_init_split_worker,
+        initargs=(template,)
+    ) as executor:
+        # Giới hạn số file đang xử lý để không giữ quá nhiều kết quả trong bộ nhớ
+        pending = set()
+        jobs_iter = iter(file_jobs)
+        for filename, group_rows in itertools.islice(jobs_iter, max_workers * 2):
+            pending.add(executor.submit(_create_excel_file_worker, filename, group_rows))
         
-        # Copy row height
-        if orig_row_idx in ws_orig.row_dimensions:
-            row_dim = ws_orig.row_dimensions[orig_row_idx]
-            if row_dim.height:
-                ws_new.row_dimensions[excel_row].height = row_dim.height
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                next_job = next(jobs_iter, None)
+                if next_job is not None:
+                    pending.add(executor.submit(_create_excel_file_worker, *next_job))
+
+_worker_template = None
+
+def _init_split_worker(template):
+    """Nhận template 1 lần cho mỗi process con (không gửi lại theo từng file)"""
+    global _worker_template
+    _worker_template = template
+
+def _create_excel_file_worker(filename, group_rows):
+    return filename, create_excel_file(_worker_template, group_rows).getvalue()
+
+def clip_row_cells(row_cells, min_col, max_col):
+    """Cắt 1 dòng [(value, style_id), ...] theo min_col..max_col (điền ô trống nếu thiếu)"""
+    clipped = list(row_cells[min_col - 1:max_col])
+    clipped.extend([(None, 0)] * (max_col - min_col + 1 - len(clipped)))
+    return clipped
+
+def create_excel_file(template, group_rows):
+    """
+    Tạo file Excel (write-only): copy template + ghi data (chỉ copy cột cần thiết)
+    
+    :param template: Kết quả của build_template_snapshot (dùng chung cả job)
+    :param group_rows: List (row_idx, row_cells) các dòng data của nhóm
+    """
+    wb_new = openpyxl.Workbook(write_only=True)
+    ws_new = wb_new.create_sheet()
+    style_cache = template['style_cache']
+    row_heights = template['row_heights']
+    min_col = template['min_col']
+    max_col = template['max_col']
+    workbook_styles = {} # style_id gốc -> StyleArray trong workbook mới
+    
+    # Độ rộng cột & merged cells phải set trước khi ghi dòng
+    for col_letter, width in template['column_widths']:
+        ws_new.column_dimensions[col_letter].width = width
+    for merged_range in template['merged_ranges']:
+        ws_new.merged_cells.add(merged_range)
+    
+    def write_row(new_row_idx, height, row_cells):
+        # Chiều cao dòng phải set trước khi append (write-only ghi dòng ngay lập tức)
+        if height:
+            ws_new.row_dimensions[new_row_idx].height = height
         
-        # Copy data từ row gốc (chỉ cột được chọn)
-        for col_idx in range(min_col, max_col + 1):
-            cell_o = ws_orig.cell(row=orig_row_idx, column=col_idx)
-            cell_n = ws_new.cell(row=excel_row, column=col_idx - min_col + 1)
-            
-            cell_n.value = cell_o.value
-            
-            # Copy formatting từ ô dữ liệu gốc
-            if cell_o.has_style:
-                copy_cell_style(cell_o, cell_n)
+        new_cells = []
+        for value, style_id in row_cells:
+            cell_n = WriteOnlyCell(ws_new, value)
+            if style_id:
+                style_cache.apply(style_id, cell_n, workbook_styles)
+            new_cells.append(cell_n)
+        ws_new.append(new_cells)
+    
+    # Copy template (dòng 1 đến template_end_row) - GIỮ NGUYÊN FORMAT
+    for row_idx, (height, row_cells) in enumerate(template['template_rows'], 1):
+        write_row(row_idx, height, row_cells)
+    
+    # Ghi dữ liệu
+    data_start_row = len(template['template_rows']) + 1
+    for idx, (orig_row_idx, row_cells) in enumerate(group_rows):
+        write_row(data_start_row + idx, row_heights.get(orig_row_idx), clip_row_cells(row_cells, min_col, max_col))
     
     buffer = BytesIO()
     wb_new.save(buffer)
@@ -273,10 +630,11 @@ def create_excel_file(orig_file, ws_orig, sheet_name, template_end_row, row_indi
     
     return buffer
 
-def copy_cell_style(source, target):
-    """Copy đầy đủ style"""
+def build_cell_style(source):
+    """Tạo các style object (Font/Border/Fill/Alignment/Number format) từ ô nguồn"""
+    style = {}
     if source.font:
-        target.font = Font(
+        style['font'] = Font(
             name=source.font.name,
             size=source.font.size,
             bold=source.font.bold,
@@ -285,7 +643,7 @@ def copy_cell_style(source, target):
         )
     
     if source.border:
-        target.border = Border(
+        style['border'] = Border(
             left=source.border.left,
             right=source.border.right,
             top=source.border.top,
@@ -293,18 +651,69 @@ def copy_cell_style(source, target):
         )
     
     if source.fill:
-        target.fill = PatternFill(
+        style['fill'] = PatternFill(
             fill_type=source.fill.fill_type,
             start_color=source.fill.start_color,
             end_color=source.fill.end_color
         )
     
     if source.alignment:
-        target.alignment = Alignment(
+        style['alignment'] = Alignment(
             horizontal=source.alignment.horizontal,
             vertical=source.alignment.vertical,
             wrap_text=source.alignment.wrap_text
         )
     
     if source.number_format:
-        target.number_format = source.number_format
\ No newline at end of file
+        style['number_format'] = source.number_format
+    
+    return style
+
+def copy_cell_style(source, target):
+    """Copy đầy đủ style"""
+    for attr, value in build_cell_style(source).items():
+        setattr(target, attr, value)
+
+
+class CellStyleCache:
+    """
+    Cache style theo style_id của ô gốc
+    - Style object (Font, Border...) chỉ tạo 1 lần cho cả job tách file
+    - Mỗi workbook output chỉ đăng ký style 1 lần (lần đầu gặp style_id),
+      các ô sau dùng lại StyleArray đã có → không phải dedup lại style table
+    """
+    
+    def __init__(self, ws_orig):
+        self.ws_orig = ws_orig
+        self._styles = {} # style_id gốc -> dict style object (dùng chung cả job)
+    
+    def __getstate__(self):
+        # Gửi sang process con: chỉ cần style đã tạo sẵn (xem preload_all), không cần sheet gốc
+        return {'ws_orig': None, '_styles': self._styles}
+    
+    def preload_all(self):
+        """Tạo sẵn style cho mọi style_id của workbook gốc"""
+        if self.ws_orig is not None:
+            for style_id in range(len(self.ws_orig.parent._cell_styles)):
+                self.get_style(style_id)
+    
+    def get_style(self, style_id):
+        style = self._styles.get(style_id)
+        if style is None:
+            source = ReadOnlyCell(self.ws_orig, 1, 1, None, style_id=style_id)
+            style = self._styles[style_id] = build_cell_style(source)
+        return style
+    
+    def apply(self, style_id, target, workbook_styles):
+        """
+        Gán style cho ô output
+        :param workbook_styles: dict style_id -> StyleArray của workbook output đang ghi
+                                (index style chỉ đúng trong workbook đó)
+        """
+        style_array = workbook_styles.get(style_id)
+        if style_array is None:
+            for attr, value in self.get_style(style_id).items():
+                setattr(target, attr, value)
+            workbook_styles[style_id] = copy(target._style)
+        else:
+            target._style = copy(style_array)
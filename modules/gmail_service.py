@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+import time
+from contextlib import contextmanager
+import google_auth_httplib2
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+
+# Cho phép trỏ Gmail API tới endpoint khác (proxy / fake server khi benchmark)
+GMAIL_API_ENDPOINT = os.environ.get('GMAIL_API_ENDPOINT')
+
+# Số kết nối HTTP (keep-alive) tối đa giữ lại cho mỗi user & thời gian giữ khi không dùng
+GMAIL_HTTP_POOL_SIZE = int(os.environ.get('GMAIL_HTTP_POOL_SIZE', 8))
+GMAIL_HTTP_IDLE_SECONDS = int(os.environ.get('GMAIL_HTTP_IDLE_SECONDS', 300))
+
+
+class GmailServiceLease:
+    """1 Gmail service đang được 1 thread dùng (trả lại pool bằng GmailServiceFactory.release)"""
+
+    def __init__(self, user_key, http, service):
+        self.user_key = user_key
+        self.http = http
+        self.service = service
+
+
+class GmailServiceFactory:
+    """
+    Tạo Gmail service dùng chung cho cả process
+    - Discovery document (gmail v1) chỉ đọc + parse 1 lần
+    - Giữ pool httplib2.Http theo user → các job sau dùng lại kết nối keep-alive (không TLS handshake lại)
+    - httplib2.Http không thread-safe: mỗi lease chỉ dùng trong 1 thread, dùng xong trả lại pool
+    """
+
+    def __init__(self, pool_size=GMAIL_HTTP_POOL_SIZE, idle_seconds=GMAIL_HTTP_IDLE_SECONDS):
+        self.pool_size = pool_size
+        self.idle_seconds = idle_seconds
+        self._document = None
+        self._pools = {} # user_key -> list (httplib2.Http, thời điểm trả lại)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def get_discovery_document(self):
+        with self._lock:
+            if self._document is None:
+                self._document = json.loads(discovery_cache.get_static_doc('gmail', 'v1'))
+            return self._document
+
+    def _take_http(self, user_key):
+        now = time.monotonic()
+        with self._lock:
+            pool = self._pools.get(user_key, [])
+            while pool:
+                http, released_at = pool.pop()
+                if now - released_at <= self.idle_seconds:
+                    self.reused += 1
+                    return http
+                close_http(http)
+            self.created += 1
+        return build_http()
+
+    def acquire(self, credentials, user_key=None):
+        """Lấy 1 Gmail service (kèm kết nối HTTP từ pool của user)"""
+        http = self._take_http(user_key or '')
+        authed_http = google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+        client_options = {'api_endpoint': GMAIL_API_ENDPOINT} if GMAIL_API_ENDPOINT else None
+        service = build_from_document(
+            self.get_discovery_document(),
+            http=authed_http,
+            client_options=client_options
+        )
+        return GmailServiceLease(user_key or '', http, service)
+
+    def release(self, lease):
+        """Trả kết nối HTTP về pool (thừa thì đóng)"""
+        with self._lock:
+            pool = self._pools.setdefault(lease.user_key, [])
+            if len(pool) < self.pool_size:
+                pool.append((lease.http, time.monotonic()))
+                return
+        close_http(lease.http)
+
+    @contextmanager
+    def service(self, credentials, user_key=None):
+        lease = self.acquire(credentials, user_key)
+        try:
+            yield lease.service
+        finally:
+            self.release(lease)
+
+
+def close_http(http):
+    """Đóng các kết nối đang mở của 1 httplib2.Http"""
+    for conn in list(http.connections.values()):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    http.connections.clear()
+
+
+# Factory dùng chung cho mọi job trong process
+gmail_services = GmailServiceFactory()
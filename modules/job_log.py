@@ -0,0 +1,101 @@
+import csv
+import io
+import threading
+import time
+
+# Cột của file log CSV (giống make_log_row)
+LOG_COLUMNS = ["Time", "Code", "Name", "Email To", "Email CC", "Status", "Error"]
+
+# Ghi log xuống file sau mỗi bao nhiêu dòng / bao nhiêu giây
+LOG_FLUSH_ROWS = 20
+LOG_FLUSH_SECONDS = 2.0
+
+
+class JobLogWriter:
+    """
+    Ghi log gửi email dạng CSV nối thêm từng dòng (thread-safe)
+    - Dòng được ghi ngay khi có kết quả, flush theo lô (LOG_FLUSH_ROWS dòng / LOG_FLUSH_SECONDS giây)
+    - File log đọc được (tải về) ngay cả khi job đang chạy hoặc bị crash giữa chừng
+    """
+
+    def __init__(self, stream, flush_rows=LOG_FLUSH_ROWS, flush_seconds=LOG_FLUSH_SECONDS):
+        self.stream = stream
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.row_count = 0
+        self._writer = csv.DictWriter(stream, fieldnames=LOG_COLUMNS, extrasaction='ignore', lineterminator='\n')
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._writer.writeheader()
+        self.stream.flush()
+
+    def write(self, row):
+        with self._lock:
+            self._writer.writerow(row)
+            self.row_count += 1
+            self._pending += 1
+            if self._pending >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        self.stream.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self.stream.close()
+
+
+class OrderedLogWriter:
+    """
+    Ghi log theo thứ tự ID (seq = 0, 1, 2, ...) dù kết quả gửi song song về không theo thứ tự
+    - Dòng về sớm được giữ lại, ghi ngay khi các dòng trước nó đã có → file log vẫn được nối thêm
+      dần (tải được khi job đang chạy) và thẳng hàng theo ID như file gốc
+    - flush_pending(): ghi nốt các dòng đang giữ theo thứ tự (khi kết thúc / dừng giữa chừng)
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._next = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def write(self, seq, row):
+        with self._lock:
+            self._pending[seq] = row
+            while self._next in self._pending:
+                self.writer.write(self._pending.pop(self._next))
+                self._next += 1
+
+    def flush_pending(self):
+        with self._lock:
+            for seq in sorted(self._pending):
+                self.writer.write(self._pending.pop(seq))
+                self._next = seq + 1
+
+
+def open_job_log(path):
+    """Tạo file log mới (ghi đè file cũ) — utf-8-sig để Excel đọc đúng tiếng Việt"""
+    return JobLogWriter(open(path, 'w', encoding='utf-8-sig', newline=''))
+
+
+def open_memory_log():
+    """Log ghi vào BytesIO, trả về (writer, buffer)"""
+    buffer = io.BytesIO()
+    stream = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    return JobLogWriter(stream), buffer
+
+
+def finish_memory_log(writer, buffer):
+    """Kết thúc log trong bộ nhớ, trả về BytesIO đã seek(0)"""
+    writer.flush()
+    writer.stream.detach()
+    buffer.seek(0)
+    return buffer
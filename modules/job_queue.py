@@ -0,0 +1,344 @@
+import os
+import json
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+# Số job chạy song song trong 1 worker process
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 2))
+# Số job tối đa của 1 user chạy cùng lúc (trên tất cả worker) → user khác không phải chờ
+MAX_RUNNING_JOBS_PER_USER = int(os.environ.get('MAX_RUNNING_JOBS_PER_USER', 1))
+# Chu kỳ heartbeat của job đang chạy & thời gian mất heartbeat thì coi worker đã chết
+WORKER_HEARTBEAT_SECONDS = int(os.environ.get('WORKER_HEARTBEAT_SECONDS', 10))
+WORKER_STALE_SECONDS = int(os.environ.get('WORKER_STALE_SECONDS', 120))
+# Khi nhận SIGTERM: chờ job đang chạy dừng tối đa bao nhiêu giây
+WORKER_SHUTDOWN_SECONDS = float(os.environ.get('WORKER_SHUTDOWN_SECONDS', 20))
+# Job chạy quá số giây này (dù worker vẫn heartbeat, vd: bị treo) → đưa lại vào hàng đợi
+WORKER_JOB_TIMEOUT_SECONDS = int(os.environ.get('WORKER_JOB_TIMEOUT_SECONDS', 6 * 3600))
+
+
+class JobExists(ValueError):
+    """job_id đã có trong hàng đợi (enqueue không ghi đè job khác)"""
+
+
+class JobInterrupted(Exception):
+    """Handler raise khi dừng job giữa chừng (worker đang dừng / mất claim) → job trả lại hàng đợi"""
+
+
+class JobQueue:
+    """
+    Hàng đợi job bền vững trong SQLite (không cần broker ngoài)
+    - Web chỉ enqueue, worker process (worker.py) lấy job ra chạy
+    - claim() là transaction IMMEDIATE → nhiều worker không lấy trùng job
+    - Công bằng giữa các user: ưu tiên user đang có ít job chạy nhất, giới hạn
+      MAX_RUNNING_JOBS_PER_USER job / user
+    - Job 'running' mất heartbeat (worker chết) hoặc chạy quá WORKER_JOB_TIMEOUT_SECONDS được đưa lại
+      vào hàng đợi; mỗi lần claim có số attempt riêng → heartbeat / finish / release của lần chạy cũ
+      (thread còn sống sau khi job đã bị lấy lại) không ảnh hưởng lần chạy mới
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_queue ("
+                " job_id TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " user_key TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " state TEXT NOT NULL," # queued / running / done / failed
+                " worker_id TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " enqueued_at TEXT NOT NULL,"
+                " started_at TEXT,"
+                " heartbeat_at TEXT,"
+                " finished_at TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS job_queue_state ON job_queue (state, enqueued_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, job_id, kind, user_key, payload):
+        """Thêm job mới; JobExists nếu job_id đã có (không ghi đè job của user khác)"""
+        now = datetime.now().isoformat()
+        try:
+            self._transaction(lambda conn: conn.execute(
+                "INSERT INTO job_queue (job_id, kind, user_key, payload, state, enqueued_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, kind, user_key or '', json.dumps(payload), now)
+            ))
+        except sqlite3.IntegrityError:
+            raise JobExists(f"Job already exists: {job_id}")
+
+    def requeue(self, job_id, user_key, payload):
+        """
+        Đưa lại job đã kết thúc (done / failed) của user_key vào hàng đợi (vd: resume)
+        → False nếu job không có, của user khác hoặc đang chờ / đang chạy
+        """
+        now = datetime.now().isoformat()
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE job_queue SET payload = ?, state = 'queued', worker_id = NULL, enqueued_at = ?, "
+            "finished_at = NULL WHERE job_id = ? AND user_key = ? AND state IN ('done', 'failed')",
+            (json.dumps(payload), now, job_id, user_key or '')
+        ).rowcount) > 0
+
+    def claim(self, worker_id, max_running_per_user=MAX_RUNNING_JOBS_PER_USER):
+        """Lấy 1 job để chạy → (job_id, kind, payload, attempt), None nếu không có job phù hợp"""
+        def claim_next(conn):
+            row = conn.execute(
+                "SELECT q.job_id, q.kind, q.payload, q.attempts + 1 FROM job_queue q "
+                "LEFT JOIN (SELECT user_key, COUNT(*) AS n FROM job_queue WHERE state = 'running' "
+                "           GROUP BY user_key) r ON r.user_key = q.user_key "
+                "WHERE q.state = 'queued' AND COALESCE(r.n, 0) < ? "
+                "ORDER BY COALESCE(r.n, 0), q.enqueued_at LIMIT 1",
+                (max_running_per_user,)
+            ).fetchone()
+            if row is None:
+                return None
+            now = datetime.now().isoformat()
+            conn.execute(
+                "UPDATE job_queue SET state = 'running', worker_id = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                (worker_id, now, now, row[0])
+            )
+            return row[0], row[1], json.loads(row[2]), row[3]
+        return self._transaction(claim_next)
+
+    def heartbeat(self, worker_id, claims):
+        """claims: [(job_id, attempt)] đang chạy → list job_id không còn thuộc lần claim này (đã bị lấy lại)"""
+        if not claims:
+            return []
+        now = datetime.now().isoformat()
+        def beat(conn):
+            return [
+                job_id for job_id, attempt in claims
+                if not conn.execute(
+                    "UPDATE job_queue SET heartbeat_at = ? "
+                    "WHERE job_id = ? AND state = 'running' AND worker_id = ? AND attempts = ?",
+                    (now, job_id, worker_id, attempt)
+                ).rowcount
+            ]
+        return self._transaction(beat)
+
+    def owns(self, job_id, worker_id, attempt):
+        """Job vẫn đang chạy bởi đúng lần claim này"""
+        row = self.get(job_id)
+        return bool(row and row['state'] == 'running' and row['worker_id'] == worker_id and row['attempts'] == attempt)
+
+    def finish(self, job_id, state, worker_id, attempt):
+        """Kết thúc job (done / failed) → False nếu job đã bị lấy lại (không ghi đè lần chạy mới)"""
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE job_queue SET state = ?, finished_at = ? "
+            "WHERE job_id = ? AND state = 'running' AND worker_id = ? AND attempts = ?",
+            (state, datetime.now().isoformat(), job_id, worker_id, attempt)
+        ).rowcount) > 0
+
+    def requeue_stale(self, stale_seconds=WORKER_STALE_SECONDS, job_timeout=WORKER_JOB_TIMEOUT_SECONDS):
+        """
+        Đưa job 'running' của worker đã chết (mất heartbeat) hoặc chạy quá job_timeout giây
+        lại vào hàng đợi → trả về list job_id
+        """
+        now = datetime.now()
+        cutoff = (now - timedelta(seconds=stale_seconds)).isoformat()
+        deadline = (now - timedelta(seconds=job_timeout)).isoformat()
+        def requeue(conn):
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT job_id FROM job_queue WHERE state = 'running' AND (heartbeat_at < ? OR started_at < ?)",
+                (cutoff, deadline)
+            )]
+            conn.executemany(
+                "UPDATE job_queue SET state = 'queued', worker_id = NULL WHERE job_id = ?",
+                [(job_id,) for job_id in job_ids]
+            )
+            return job_ids
+        return self._transaction(requeue)
+
+    def release(self, job_id, worker_id, attempt):
+        """Trả job bị dừng giữa chừng lại hàng đợi ngay (không chờ mất heartbeat) → False nếu đã bị lấy lại"""
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE job_queue SET state = 'queued', worker_id = NULL "
+            "WHERE job_id = ? AND state = 'running' AND worker_id = ? AND attempts = ?",
+            (job_id, worker_id, attempt)
+        ).rowcount) > 0
+
+    def finished_before(self, kind, seconds):
+        """job_id các job loại kind đã kết thúc (done / failed) quá seconds giây"""
+        cutoff = (datetime.now() - timedelta(seconds=seconds)).isoformat()
+        return [row[0] for row in self._connect().execute(
+            "SELECT job_id FROM job_queue WHERE kind = ? AND state IN ('done', 'failed') AND finished_at < ?",
+            (kind, cutoff)
+        )]
+
+    def delete(self, job_id):
+        self._transaction(lambda conn: conn.execute("DELETE FROM job_queue WHERE job_id = ?", (job_id,)))
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            "SELECT state, worker_id, heartbeat_at, attempts, user_key FROM job_queue WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'state': row[0], 'worker_id': row[1], 'heartbeat_at': row[2], 'attempts': row[3], 'user_key': row[4]}
+
+
+class JobClaim:
+    """
+    1 lần chạy job của worker (truyền cho handler)
+    - stop_requested(): worker đang dừng hoặc job đã bị lấy lại (quá hạn) → handler nên dừng sớm
+      (raise JobInterrupted để trả job lại hàng đợi)
+    - is_current(): job vẫn thuộc lần chạy này → mới được ghi kết quả / xóa file của job
+    """
+
+    def __init__(self, queue, worker_id, job_id, kind, payload, attempt, stop_event):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.job_id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempt = attempt
+        self._stop = stop_event
+        self._lost = threading.Event()
+
+    def mark_lost(self):
+        self._lost.set()
+
+    def stop_requested(self):
+        return self._stop.is_set() or self._lost.is_set()
+
+    def is_current(self):
+        return not self._lost.is_set() and self.queue.owns(self.job_id, self.worker_id, self.attempt)
+
+
+class JobWorker:
+    """
+    Worker lấy job từ JobQueue và chạy bằng handler theo loại job
+    - handlers: {'send': fn(job_id, payload, claim), 'split': ...}; claim: JobClaim
+      handler trả về 'failed' hoặc raise → job failed; raise JobInterrupted → job trả lại hàng đợi
+    - concurrency: số job chạy song song (mỗi job 1 thread)
+    """
+
+    def __init__(self, queue, handlers, concurrency=WORKER_CONCURRENCY, poll_interval=1.0, worker_id=None):
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._running = set() # JobClaim đang chạy
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._slots = []
+
+    def run_job(self, claim):
+        job_id = claim.job_id
+        print(f"🚀 [Worker {self.worker_id}] Running {claim.kind} job {job_id} (attempt {claim.attempt})")
+        try:
+            state = self.handlers[claim.kind](job_id, claim.payload, claim) or 'done'
+        except JobInterrupted as e:
+            state = None
+            if self.queue.release(job_id, self.worker_id, claim.attempt):
+                print(f"⏸️ [Worker {self.worker_id}] Job {job_id} interrupted ({e}) - returned to queue")
+        except Exception as e:
+            state = 'failed'
+            print(f"❌ [Worker {self.worker_id}] Job {job_id} failed: {str(e)}")
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._running.discard(claim)
+        if state is not None and not self.queue.finish(job_id, state, self.worker_id, claim.attempt):
+            print(f"⚠️ [Worker {self.worker_id}] Job {job_id} was taken over - result ({state}) not recorded")
+
+    def run_slot(self):
+        """1 slot chạy job: lấy job → chạy → lặp lại"""
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(self.worker_id)
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ [Worker {self.worker_id}] Queue busy: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            claim = JobClaim(self.queue, self.worker_id, *job, stop_event=self._stop)
+            with self._lock:
+                self._running.add(claim)
+            self.run_job(claim)
+
+    def run_heartbeat(self):
+        last_requeue = 0.0
+        while not self._stop.wait(WORKER_HEARTBEAT_SECONDS):
+            try:
+                with self._lock:
+                    running = list(self._running)
+                lost = set(self.queue.heartbeat(self.worker_id, [(claim.job_id, claim.attempt) for claim in running]))
+                for claim in running:
+                    if claim.job_id in lost:
+                        claim.mark_lost()
+                        print(f"⚠️ [Worker {self.worker_id}] Job {claim.job_id} was requeued - stopping this run")
+                if time.monotonic() - last_requeue >= WORKER_STALE_SECONDS / 2:
+                    last_requeue = time.monotonic()
+                    requeued = self.queue.requeue_stale()
+                    if requeued:
+                        print(f"⚠️ [Worker {self.worker_id}] Requeued stale jobs: {', '.join(requeued)}")
+            except Exception as e:
+                print(f"⚠️ [Worker {self.worker_id}] Heartbeat error: {e}")
+
+    def start(self):
+        """Chạy worker trong các thread nền (daemon), trả về ngay"""
+        requeued = self.queue.requeue_stale()
+        if requeued:
+            print(f"⚠️ [Worker {self.worker_id}] Requeued stale jobs: {', '.join(requeued)}")
+        self._slots = [
+            threading.Thread(target=self.run_slot, name=f"job-slot-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        threads = [threading.Thread(target=self.run_heartbeat, name="job-heartbeat", daemon=True)] + self._slots
+        for thread in threads:
+            thread.start()
+        print(f"✅ [Worker {self.worker_id}] Started with {self.concurrency} slot(s)")
+        return threads
+
+    def stop(self):
+        """Không lấy job mới nữa; handler thấy claim.stop_requested() và dừng sớm nếu hỗ trợ"""
+        self._stop.set()
+
+    def alive(self):
+        """Tất cả slot còn chạy (slot chết bất thường → nên restart process)"""
+        return all(thread.is_alive() for thread in self._slots)
+
+    def shutdown(self, timeout=WORKER_SHUTDOWN_SECONDS):
+        """
+        Dừng worker: không lấy job mới, chờ job đang chạy dừng (xong, hoặc JobInterrupted → tự trả lại
+        hàng đợi) tối đa timeout giây. Job có thread vẫn còn chạy thì không trả lại (tránh 2 lần chạy
+        cùng lúc): process thoát → mất heartbeat → requeue_stale đưa lại vào hàng đợi
+        """
+        self.stop()
+        deadline = time.monotonic() + timeout
+        for thread in self._slots:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            running = [claim.job_id for claim in self._running]
+        if running:
+            print(f"⚠️ [Worker {self.worker_id}] Still running, requeued after {WORKER_STALE_SECONDS}s: {', '.join(running)}")
+        print(f"✅ [Worker {self.worker_id}] Stopped")
@@ -0,0 +1,228 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# Số lần ghi tiến độ tối đa mỗi giây cho 1 job (các cập nhật ở giữa được gộp lại)
+JOB_PROGRESS_UPDATES_PER_SEC = float(os.environ.get('JOB_PROGRESS_UPDATES_PER_SEC', 2))
+# Job chạy ở process khác (worker.py): đọc version các job đang được theo dõi mỗi bao nhiêu giây
+JOB_WATCH_POLL_SECONDS = float(os.environ.get('JOB_WATCH_POLL_SECONDS', 1.0))
+
+
+class JobStore:
+    """
+    Lưu trạng thái job trong SQLite (WAL)
+    - Mỗi job 1 dòng: status (JSON) + các cột progress/total/updated_at riêng
+    - Cập nhật tiến độ chỉ UPDATE 3 cột, không ghi lại cả JSON
+    - Ghi/đọc là transaction → /check_status không bao giờ thấy dữ liệu ghi dở,
+      dùng được cho nhiều thread & nhiều worker gunicorn cùng lúc
+    - Cột version tăng sau mỗi lần ghi → stream tiến độ (SSE) chỉ gửi khi có thay đổi
+    - Theo dõi thay đổi (wait_for_change): 1 thread nền / process đọc version của mọi job đang có
+      stream chờ bằng 1 query (không phải mỗi stream 1 query / giây)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        self._watch_counts = {} # job_id → số stream đang chờ thay đổi
+        self._versions = {} # job_id → version đọc gần nhất (dùng chung cho các stream)
+        self._watch_wakeup = threading.Event() # Ghi trong process này → đọc lại version ngay
+        self._watcher = None
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " progress INTEGER NOT NULL DEFAULT 0,"
+                " total INTEGER NOT NULL DEFAULT 0,"
+                " updated_at TEXT)"
+            )
+            # Thêm cột mới cho DB tạo từ phiên bản trước
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'stats' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN stats TEXT")
+            if 'version' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        # sqlite3 connection không dùng chung giữa các thread → mỗi thread 1 connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save(self, job_id, status_dict):
+        """Ghi toàn bộ status của job (tạo mới hoặc ghi đè)"""
+        data = dict(status_dict)
+        progress = int(data.pop('progress', 0) or 0)
+        total = int(data.pop('total', 0) or 0)
+        updated_at = data.pop('updated_at', None) or datetime.now().isoformat()
+        stats = data.pop('stats', None)
+        data.pop('version', None)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, data, progress, total, updated_at, stats) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET data = excluded.data, progress = excluded.progress, "
+                "total = excluded.total, updated_at = excluded.updated_at, stats = excluded.stats, "
+                "version = version + 1",
+                (job_id, json.dumps(data), progress, total, updated_at, json.dumps(stats) if stats else None)
+            )
+        self._notify()
+
+    def load(self, job_id):
+        row = self._connect().execute(
+            "SELECT data, progress, total, updated_at, stats, version FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status = json.loads(row[0])
+        status['progress'] = row[1]
+        status['total'] = row[2]
+        status['updated_at'] = row[3]
+        status['stats'] = json.loads(row[4]) if row[4] else None
+        status['version'] = row[5]
+        return status
+
+    def update_progress(self, job_id, current, total, stats=None):
+        """Cập nhật tiến độ (stats: số ID thành công/lỗi/bỏ qua, ETA... nếu có)"""
+        with self._connect() as conn:
+            if stats is None:
+                conn.execute(
+                    "UPDATE jobs SET progress = ?, total = ?, updated_at = ?, version = version + 1 "
+                    "WHERE job_id = ?",
+                    (int(current), int(total), datetime.now().isoformat(), job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET progress = ?, total = ?, updated_at = ?, stats = ?, version = version + 1 "
+                    "WHERE job_id = ?",
+                    (int(current), int(total), datetime.now().isoformat(), json.dumps(stats), job_id)
+                )
+        self._notify()
+
+    def delete(self, job_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def get_version(self, job_id):
+        """Version hiện tại của job (None nếu không có)"""
+        row = self._connect().execute("SELECT version FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def _notify(self):
+        self._watch_wakeup.set()
+
+    def _watch_loop(self):
+        while True:
+            self._watch_wakeup.wait(JOB_WATCH_POLL_SECONDS)
+            self._watch_wakeup.clear()
+            with self._changed:
+                job_ids = list(self._watch_counts)
+            if not job_ids:
+                continue
+            try:
+                versions = dict.fromkeys(job_ids)
+                versions.update(self._connect().execute(
+                    f"SELECT job_id, version FROM jobs WHERE job_id IN ({','.join('?' * len(job_ids))})", job_ids
+                ).fetchall())
+            except sqlite3.Error as e:
+                print(f"⚠️ Job watcher: {e}")
+                continue
+            with self._changed:
+                changed = False
+                for job_id, version in versions.items():
+                    if job_id in self._watch_counts and self._versions.get(job_id) != version:
+                        self._versions[job_id] = version
+                        changed = True
+                if changed:
+                    self._changed.notify_all()
+
+    def wait_for_change(self, job_id, version, timeout):
+        """
+        Chờ job thay đổi (version khác), tối đa timeout giây → trả về version mới
+        Không query riêng cho từng lần chờ: version do thread theo dõi dùng chung đọc
+        (ghi trong process này được thấy ngay, ghi từ worker khác sau tối đa JOB_WATCH_POLL_SECONDS)
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            self._watch_counts[job_id] = self._watch_counts.get(job_id, 0) + 1
+            known = job_id in self._versions
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch_loop, name="job-watch", daemon=True)
+                self._watcher.start()
+        try:
+            if not known:
+                current = self.get_version(job_id)
+                with self._changed:
+                    self._versions.setdefault(job_id, current)
+            with self._changed:
+                while True:
+                    current = self._versions.get(job_id)
+                    remaining = deadline - time.monotonic()
+                    if current != version or remaining <= 0:
+                        return current
+                    self._changed.wait(remaining)
+        finally:
+            with self._changed:
+                self._watch_counts[job_id] -= 1
+                if not self._watch_counts[job_id]:
+                    del self._watch_counts[job_id]
+                    self._versions.pop(job_id, None)
+
+
+class ThrottledProgress:
+    """
+    progress_callback gộp cập nhật: ghi tối đa max_per_sec lần/giây
+    (luôn ghi lần đầu và khi xong hết); gọi flush() để ghi giá trị cuối cùng
+    - counts (nếu có): số ID theo kết quả, vd {'success': 10, 'failed': 1, 'skipped': 2}
+    - accounts (nếu có): tiến độ từng tài khoản gửi (gửi bằng nhiều tài khoản)
+    - Tự tính ETA theo tốc độ từ lần cập nhật đầu tiên
+    """
+
+    def __init__(self, store, job_id, max_per_sec=JOB_PROGRESS_UPDATES_PER_SEC):
+        self.store = store
+        self.job_id = job_id
+        self.min_interval = 1.0 / max_per_sec if max_per_sec > 0 else 0.0
+        self._last_write = None
+        self._pending = None
+        self._start = None # (thời điểm, current) lần gọi đầu tiên
+        self._lock = threading.Lock()
+
+    def _stats(self, current, total, counts, accounts, now):
+        start_time, start_count = self._start
+        done = current - start_count
+        eta = None
+        if done > 0 and total > current:
+            eta = round((now - start_time) / done * (total - current), 1)
+        stats = {'eta_seconds': eta}
+        if counts:
+            stats['counts'] = dict(counts)
+        if accounts:
+            stats['accounts'] = accounts
+        return stats
+
+    def __call__(self, current, total, counts=None, accounts=None):
+        with self._lock:
+            now = time.monotonic()
+            if self._start is None:
+                self._start = (now, current)
+            stats = self._stats(current, total, counts, accounts, now)
+            due = self._last_write is None or now - self._last_write >= self.min_interval
+            if not (due or current >= total):
+                self._pending = (current, total, stats)
+                return
+            self._pending = None
+            self._last_write = now
+            self.store.update_progress(self.job_id, current, total, stats)
+
+    def flush(self):
+        with self._lock:
+            if self._pending is not None:
+                self.store.update_progress(self.job_id, *self._pending)
+                self._pending = None
@@ -0,0 +1,58 @@
+import threading
+import time
+
+# Quota Gmail API (theo tài liệu Google):
+# - Mỗi user được 250 quota units / giây
+# - messages.send tốn 100 quota units / lần gọi
+GMAIL_QUOTA_UNITS_PER_SEC = 250
+GMAIL_SEND_QUOTA_COST = 100
+
+
+class TokenBucket:
+    """
+    Token bucket thread-safe dùng để giới hạn tốc độ gọi API
+    - rate: số token được nạp lại mỗi giây
+    - capacity: số token tối đa (cho phép burst ngắn)
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    def acquire(self, tokens=1):
+        """Chờ (block) cho đến khi đủ token, trả về số giây đã chờ"""
+        tokens = min(float(tokens), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+
+def create_gmail_rate_limiter(quota_units_per_sec=None):
+    """
+    Tạo token bucket theo quota units của Gmail
+    - None: dùng quota mặc định (250 units/giây)
+    - 0 hoặc số âm: không giới hạn (trả về None)
+    """
+    if quota_units_per_sec is None:
+        quota_units_per_sec = GMAIL_QUOTA_UNITS_PER_SEC
+    if quota_units_per_sec <= 0:
+        return None
+    # Capacity tối thiểu bằng chi phí 1 lần send để không bị kẹt vĩnh viễn
+    capacity = max(quota_units_per_sec, GMAIL_SEND_QUOTA_COST)
+    return TokenBucket(quota_units_per_sec, capacity)
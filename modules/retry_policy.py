@@ -0,0 +1,197 @@
+import random
+import socket
+import threading
+import time
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
+
+# Lý do (reason) Gmail trả về khi bị giới hạn quota / tốc độ
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded', 'concurrentLimitExceeded'}
+# Hết quota gửi trong ngày của tài khoản → retry cũng không được, phải đổi tài khoản
+DAILY_LIMIT_REASONS = {'dailyLimitExceeded'}
+
+# Phân loại lỗi
+ERROR_RATE_LIMIT = 'rate_limit' # 429 / 403 rate limit → retry + giảm tốc cả job
+ERROR_TRANSIENT = 'transient' # 5xx, lỗi mạng → retry
+ERROR_PERMANENT = 'permanent' # 400, 401, 403 khác... → không retry
+
+
+def get_error_reasons(error):
+    """Lấy danh sách 'reason' trong body lỗi của Gmail API"""
+    reasons = set()
+    for detail in getattr(error, 'error_details', None) or []:
+        if isinstance(detail, dict) and detail.get('reason'):
+            reasons.add(detail['reason'])
+    return reasons
+
+
+def classify_error(error):
+    """Phân loại exception khi gọi Gmail API"""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if get_error_reasons(error) & DAILY_LIMIT_REASONS:
+            return ERROR_PERMANENT
+        if status == 429:
+            return ERROR_RATE_LIMIT
+        if status == 403 and get_error_reasons(error) & RATE_LIMIT_REASONS:
+            return ERROR_RATE_LIMIT
+        if status >= 500:
+            return ERROR_TRANSIENT
+        return ERROR_PERMANENT
+    if isinstance(error, (socket.timeout, ConnectionError, TimeoutError)):
+        return ERROR_TRANSIENT
+    return ERROR_PERMANENT
+
+
+def is_account_error(error):
+    """
+    Lỗi do tài khoản gửi (không phải do email): token bị thu hồi / hết hạn (401),
+    hết quota gửi trong ngày → các email còn lại nên gửi bằng tài khoản khác
+    """
+    if isinstance(error, RefreshError):
+        return True
+    if isinstance(error, HttpError):
+        return error.resp.status == 401 or bool(get_error_reasons(error) & DAILY_LIMIT_REASONS)
+    return False
+
+
+def get_retry_after(error):
+    """Số giây server yêu cầu chờ (header Retry-After), None nếu không có"""
+    resp = getattr(error, 'resp', None)
+    if resp is None:
+        return None
+    value = resp.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None # Dạng HTTP-date: bỏ qua, dùng backoff
+
+
+class AimdController:
+    """
+    Giới hạn số request Gmail đang chạy đồng thời theo kiểu AIMD (như TCP)
+    - Bị rate limit: giảm một nửa giới hạn (multiplicative decrease)
+    - Thành công liên tục đủ 'limit' lần: tăng giới hạn thêm 1 (additive increase)
+    - Dùng chung cho mọi worker của 1 job
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.throttle_count = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self, cooldown=1.0):
+        with self._cond:
+            self.throttle_count += 1
+            self._successes = 0
+            # Nhiều request cùng bị 429 trong 1 đợt → chỉ giảm 1 lần
+            now = time.monotonic()
+            if now - self._last_decrease >= cooldown:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self._last_decrease = now
+
+
+class RetryPolicy:
+    """
+    Gọi lại request Gmail khi gặp lỗi tạm thời
+    - Backoff lũy thừa + jitter (full jitter), tối đa max_delay giây
+    - Tôn trọng header Retry-After
+    - Báo kết quả cho AimdController (nếu có) để điều chỉnh độ song song
+    """
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=32.0, controller=None):
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.controller = controller
+        self.retry_count = 0
+        self._lock = threading.Lock()
+
+    def backoff_delay(self, attempt, error=None):
+        """Thời gian chờ trước lần thử thứ attempt + 1"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        retry_after = get_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def should_retry(self, error, attempt):
+        return attempt < self.max_retries and classify_error(error) != ERROR_PERMANENT
+
+    def record_failure(self, error):
+        """Báo lỗi cho controller, trả về loại lỗi"""
+        kind = classify_error(error)
+        if kind == ERROR_RATE_LIMIT and self.controller:
+            self.controller.on_throttle()
+        return kind
+
+    def record_success(self):
+        if self.controller:
+            self.controller.on_success()
+
+    def wait_before_retry(self, attempt, error):
+        with self._lock:
+            self.retry_count += 1
+        time.sleep(self.backoff_delay(attempt, error))
+
+    def call(self, fn, before_attempt=None):
+        """
+        Gọi fn() (có retry), trả về kết quả hoặc raise lỗi cuối cùng
+        before_attempt: gọi trước mỗi lần thử (vd: lấy quota từ rate limiter)
+        """
+        attempt = 0
+        while True:
+            if before_attempt:
+                before_attempt()
+            if self.controller:
+                self.controller.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                kind = self.record_failure(e)
+                if not self.should_retry(e, attempt):
+                    raise
+                print(f"🔁 Retry {attempt + 1}/{self.max_retries} after {kind} error: {e}")
+                error = e
+            else:
+                self.record_success()
+                return result
+            finally:
+                if self.controller:
+                    self.controller.release()
+
+            self.wait_before_retry(attempt, error)
+            attempt += 1
+
+    def summary(self):
+        text = f"{self.retry_count} retries"
+        if self.controller:
+            text += (f", {self.controller.throttle_count} rate-limit responses, "
+                     f"concurrency limit {self.controller.limit}/{self.controller.max_limit}")
+        return text
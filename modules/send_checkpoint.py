@@ -0,0 +1,62 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+
+class SendCheckpoint:
+    """
+    Checkpoint của 1 job gửi email (file JSON Lines, chỉ ghi nối thêm)
+    - Mỗi dòng: {"code": Mã ID, "message_id": id Gmail trả về, "email_to": ..., "time": ...}
+    - Ghi + fsync ngay sau mỗi email gửi thành công → worker bị kill giữa chừng
+      thì lần chạy lại (resume) bỏ qua các ID đã gửi
+    - Dòng cuối bị ghi dở (crash lúc đang ghi) sẽ bị bỏ qua khi đọc
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.sent = self._load()
+
+    def _load(self):
+        sent = {}
+        if not os.path.exists(self.path):
+            return sent
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                valid_size += len(line)
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                sent[str(record.get('code'))] = record
+        # Cắt bỏ dòng ghi dở để lần ghi tiếp theo không dính vào dòng lỗi
+        if valid_size != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_size)
+        return sent
+
+    def is_sent(self, code):
+        return str(code) in self.sent
+
+    def get(self, code):
+        return self.sent.get(str(code))
+
+    def record(self, code, message_id=None, email_to=None):
+        """Ghi nhận 1 Mã ID đã gửi thành công"""
+        record = {
+            'code': str(code),
+            'message_id': message_id,
+            'email_to': None if email_to is None else str(email_to),
+            'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.sent[record['code']] = record
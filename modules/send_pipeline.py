@@ -0,0 +1,156 @@
+import queue
+import threading
+import time
+
+# Sentinel báo hết việc cho các thread gửi
+_DONE = object()
+# Producer chờ queue còn chỗ tối đa bao lâu mỗi lần trước khi kiểm tra lại pipeline đã dừng chưa
+PUT_POLL_SECONDS = 0.5
+
+
+class PipelineStopped(Exception):
+    """Pipeline dừng giữa chừng theo yêu cầu (should_stop), các task chưa gửi bị bỏ"""
+
+
+class StageTimer:
+    """Cộng dồn thời gian theo từng stage (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+    def summary(self):
+        totals = dict(self.totals)
+        build = totals.get('build', 0.0)
+        send = totals.get('send', 0.0)
+        producer_blocked = totals.get('producer_blocked', 0.0)
+        sender_idle = totals.get('sender_idle', 0.0)
+        # Producer phải chờ queue đầy → gửi (mạng) chậm hơn; sender phải chờ message → encode chậm hơn
+        bottleneck = "send (Gmail API)" if producer_blocked >= sender_idle else "build (MIME encode)"
+        return (
+            f"build {build:.2f}s, send {send:.2f}s, "
+            f"producer blocked {producer_blocked:.2f}s, senders idle {sender_idle:.2f}s "
+            f"→ bottleneck: {bottleneck}"
+        )
+
+
+def run_send_pipeline(tasks, build_fn, send_fn, finish_fn, n_senders=1, group_size=1, queue_size=None, timer=None,
+                      should_stop=None):
+    """
+    Pipeline 2 stage: 1 thread tạo message trước (producer) → queue giới hạn → n_senders thread gửi
+    - build_fn(task) -> message (lỗi → finish_fn(task, False, error))
+    - send_fn(items) -> list (task, success, error, ...) — phần tử thừa (vd: message_id)
+      được truyền tiếp cho finish_fn; items là list (task, message),
+      tối đa group_size phần tử (group_size > 1 dùng cho Gmail batch)
+    - queue_size: số message tối đa chờ gửi (giới hạn bộ nhớ khi file đính kèm lớn)
+    - finish_fn lỗi (vd: ghi checkpoint / tiến độ lỗi): pipeline dừng — không tạo / gửi message mới,
+      các thread gửi lấy hết message còn trong queue (bỏ, không gửi) rồi kết thúc; lỗi đầu tiên
+      được raise lại sau khi mọi thread đã dừng (các ID chưa gửi được gửi lại khi resume)
+    - should_stop() trả về True (vd: worker đang dừng): dừng như trên, raise PipelineStopped;
+      email đang gửi dở vẫn được gửi xong & finish_fn
+    Trả về StageTimer chứa thời gian từng stage
+    """
+    timer = timer or StageTimer()
+    n_senders = max(1, n_senders)
+    group_size = max(1, group_size)
+    message_queue = queue.Queue(maxsize=queue_size or n_senders * group_size * 2)
+    stopped = threading.Event()
+    errors = []
+
+    def fail(error):
+        if not errors:
+            errors.append(error)
+        stopped.set()
+
+    def is_stopped():
+        if not stopped.is_set() and should_stop is not None and should_stop():
+            fail(PipelineStopped("Stop requested"))
+        return stopped.is_set()
+
+    def finish(*outcome):
+        try:
+            finish_fn(*outcome)
+        except Exception as e:
+            print(f"❌ Pipeline: finish_fn failed: {e}")
+            fail(e)
+
+    def put(item):
+        """Chờ queue còn chỗ; False nếu không còn thread gửi nào (không bao giờ chờ mãi)"""
+        t0 = time.perf_counter()
+        try:
+            while True:
+                try:
+                    message_queue.put(item, timeout=PUT_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    if item is not _DONE and is_stopped():
+                        return False
+                    if not any(sender.is_alive() for sender in senders):
+                        fail(RuntimeError("All send threads stopped"))
+                        return False
+        finally:
+            timer.add('producer_blocked', time.perf_counter() - t0)
+
+    def produce():
+        try:
+            for task in tasks:
+                if is_stopped():
+                    break
+                t0 = time.perf_counter()
+                try:
+                    message = build_fn(task)
+                except Exception as e:
+                    timer.add('build', time.perf_counter() - t0)
+                    finish(task, False, str(e))
+                    continue
+                timer.add('build', time.perf_counter() - t0)
+                if not put((task, message)):
+                    break
+        except Exception as e:
+            fail(e)
+        finally:
+            for _ in range(n_senders):
+                if not put(_DONE):
+                    break
+
+    def consume():
+        done = False
+        while not done:
+            items = []
+            while len(items) < group_size:
+                t0 = time.perf_counter()
+                item = message_queue.get()
+                timer.add('sender_idle', time.perf_counter() - t0)
+                if item is _DONE:
+                    done = True
+                    break
+                items.append(item)
+            if not items or is_stopped():
+                # Pipeline đã dừng: chỉ lấy hết queue (producer không bị chặn), không gửi tiếp
+                continue
+
+            t0 = time.perf_counter()
+            try:
+                outcomes = send_fn(items)
+            except Exception as e:
+                outcomes = [(task, False, str(e)) for task, _ in items]
+            timer.add('send', time.perf_counter() - t0)
+
+            for outcome in outcomes:
+                finish(*outcome)
+
+    producer = threading.Thread(target=produce, name="gmail-build", daemon=True)
+    senders = [threading.Thread(target=consume, name=f"gmail-send-{i}", daemon=True) for i in range(n_senders)]
+    producer.start()
+    for sender in senders:
+        sender.start()
+    producer.join()
+    for sender in senders:
+        sender.join()
+    if errors:
+        raise errors[0]
+    return timer
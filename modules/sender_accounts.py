@@ -0,0 +1,108 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, date
+
+# Số email tối đa 1 tài khoản được gửi mỗi ngày (Gmail thường ~500, Google Workspace ~2000)
+SENDER_DAILY_LIMIT = int(os.environ.get('SENDER_DAILY_LIMIT', 500))
+
+
+class SenderAccountStore:
+    """
+    Lưu các tài khoản Gmail dùng để gửi (pool) phía server, theo user đăng nhập (owner)
+    - credentials (token + refresh_token) không gửi về trình duyệt; worker đọc khi chạy job
+    - Đếm số email đã gửi mỗi ngày / tài khoản → quota còn lại để chia việc giữa các tài khoản
+    """
+
+    def __init__(self, db_path, daily_limit=SENDER_DAILY_LIMIT):
+        self.db_path = db_path
+        self.daily_limit = daily_limit
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sender_accounts ("
+                " owner TEXT NOT NULL,"
+                " email TEXT NOT NULL,"
+                " credentials TEXT NOT NULL,"
+                " daily_limit INTEGER,"
+                " added_at TEXT NOT NULL,"
+                " PRIMARY KEY (owner, email))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sender_usage ("
+                " email TEXT NOT NULL,"
+                " day TEXT NOT NULL,"
+                " sent INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (email, day))"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save(self, owner, email, credentials):
+        """Thêm / cập nhật tài khoản gửi của owner (credentials dạng dict như session['credentials'])"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sender_accounts (owner, email, credentials, added_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(owner, email) DO UPDATE SET credentials = excluded.credentials",
+                (owner, email, json.dumps(credentials), datetime.now().isoformat())
+            )
+
+    def remove(self, owner, email):
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM sender_accounts WHERE owner = ? AND email = ?", (owner, email)
+            ).rowcount > 0
+
+    def get_credentials(self, owner, email):
+        """credentials (dict) của tài khoản, None nếu owner chưa thêm tài khoản này"""
+        row = self._connect().execute(
+            "SELECT credentials FROM sender_accounts WHERE owner = ? AND email = ?", (owner, email)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def sent_today(self, email):
+        row = self._connect().execute(
+            "SELECT sent FROM sender_usage WHERE email = ? AND day = ?", (email, date.today().isoformat())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def remaining(self, owner, email):
+        """Số email tài khoản còn được gửi hôm nay"""
+        row = self._connect().execute(
+            "SELECT daily_limit FROM sender_accounts WHERE owner = ? AND email = ?", (owner, email)
+        ).fetchone()
+        daily_limit = row[0] if row and row[0] is not None else self.daily_limit
+        return max(0, daily_limit - self.sent_today(email))
+
+    def record_sent(self, email, count=1):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sender_usage (email, day, sent) VALUES (?, ?, ?) "
+                "ON CONFLICT(email, day) DO UPDATE SET sent = sent + excluded.sent",
+                (email, date.today().isoformat(), count)
+            )
+
+    def list(self, owner):
+        """Các tài khoản gửi của owner kèm số email đã gửi / còn lại hôm nay"""
+        rows = self._connect().execute(
+            "SELECT email, daily_limit FROM sender_accounts WHERE owner = ? ORDER BY added_at", (owner,)
+        ).fetchall()
+        accounts = []
+        for email, daily_limit in rows:
+            daily_limit = daily_limit if daily_limit is not None else self.daily_limit
+            sent = self.sent_today(email)
+            accounts.append({
+                'email': email,
+                'daily_limit': daily_limit,
+                'sent_today': sent,
+                'remaining': max(0, daily_limit - sent),
+            })
+        return accounts
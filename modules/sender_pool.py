@@ -0,0 +1,148 @@
+import threading
+from modules.rate_limiter import create_gmail_rate_limiter, GMAIL_SEND_QUOTA_COST
+from modules.retry_policy import RetryPolicy, AimdController
+
+# Trọng số của tài khoản không giới hạn quota ngày (khi so với tài khoản có giới hạn)
+UNLIMITED_WEIGHT = 1000
+# Tỉ lệ lỗi (EWMA): mỗi kết quả mới chiếm bao nhiêu phần
+ERROR_RATE_ALPHA = 0.2
+# Tài khoản tỉ lệ lỗi cao vẫn được chia 1 ít việc để biết khi nào hết lỗi
+MIN_HEALTH = 0.05
+
+
+class SenderAccount:
+    """
+    1 tài khoản Gmail trong pool gửi
+    - Quota Gmail tính theo user → mỗi tài khoản có rate limiter, retry & AIMD riêng
+    - remaining: số email còn được gửi trong ngày (None = không giới hạn)
+    """
+
+    def __init__(self, email, credentials, remaining=None, max_workers=1, quota_units_per_sec=None, max_retries=5):
+        self.email = email
+        self.credentials = credentials
+        self.remaining = remaining
+        self.rate_limiter = create_gmail_rate_limiter(quota_units_per_sec)
+        self.retry_policy = RetryPolicy(max_retries=max_retries, controller=AimdController(max_workers))
+        self.sent = 0
+        self.failed = 0
+        self.rerouted = 0
+        self.in_flight = 0 # Số ID đã giao, chưa có kết quả
+        self.error_rate = 0.0
+        self.disabled_reason = None
+        self._seen_throttles = 0
+        self._current_weight = 0.0
+
+    def acquire_quota(self):
+        if self.rate_limiter:
+            self.rate_limiter.acquire(GMAIL_SEND_QUOTA_COST)
+
+    @property
+    def available(self):
+        if self.disabled_reason:
+            return False
+        return self.remaining is None or self.remaining - self.in_flight > 0
+
+    @property
+    def status(self):
+        if self.disabled_reason:
+            return 'disabled'
+        if not self.available:
+            return 'quota_exhausted'
+        return 'active'
+
+
+class SenderPool:
+    """
+    Chia các ID của 1 job cho nhiều tài khoản gửi (vượt quota ngày / tốc độ của 1 tài khoản)
+    - assign(): chọn tài khoản theo smooth weighted round-robin, trọng số =
+      quota ngày còn lại × (1 - tỉ lệ lỗi gần đây) → tài khoản còn nhiều quota, ít lỗi nhận nhiều ID hơn
+    - Tài khoản bị lỗi đăng nhập / hết quota ngày thì bị loại (disable), ID được gửi lại bằng tài khoản khác
+    - on_sent(email): gọi sau mỗi email gửi thành công (vd: cộng số email đã gửi trong ngày)
+    """
+
+    def __init__(self, accounts, on_sent=None):
+        self.accounts = list(accounts)
+        self.on_sent = on_sent
+        self._lock = threading.Lock()
+
+    def _weight(self, account):
+        if account.remaining is None:
+            quota = UNLIMITED_WEIGHT
+        else:
+            quota = account.remaining - account.in_flight
+        return quota * max(MIN_HEALTH, 1.0 - account.error_rate)
+
+    def assign(self, exclude=()):
+        """Chọn tài khoản gửi cho 1 ID (giữ trước 1 quota) → SenderAccount, None nếu không còn tài khoản nào"""
+        with self._lock:
+            candidates = [a for a in self.accounts if a.available and a not in exclude]
+            if not candidates:
+                return None
+            weights = {a.email: self._weight(a) for a in candidates}
+            total = sum(weights.values())
+            for account in candidates:
+                account._current_weight += weights[account.email]
+            chosen = max(candidates, key=lambda a: a._current_weight)
+            chosen._current_weight -= total
+            chosen.in_flight += 1
+            return chosen
+
+    def cancel(self, account):
+        """Trả lại ID đã giao nhưng chưa gửi (vd: lỗi tạo message) — không tính vào thống kê"""
+        with self._lock:
+            account.in_flight -= 1
+
+    def release(self, account, success, rerouted=False):
+        """Báo kết quả gửi 1 ID bằng account (rerouted: ID được chuyển sang tài khoản khác)"""
+        with self._lock:
+            account.in_flight -= 1
+            controller = account.retry_policy.controller
+            throttles = controller.throttle_count - account._seen_throttles
+            account._seen_throttles = controller.throttle_count
+            # Mỗi lần bị rate limit cũng tính là 1 lỗi
+            for _ in range(throttles):
+                account.error_rate += ERROR_RATE_ALPHA * (1.0 - account.error_rate)
+            account.error_rate += ERROR_RATE_ALPHA * ((0.0 if success else 1.0) - account.error_rate)
+            if success:
+                account.sent += 1
+                if account.remaining is not None:
+                    account.remaining -= 1
+            elif rerouted:
+                account.rerouted += 1
+            else:
+                account.failed += 1
+        if success and self.on_sent:
+            try:
+                self.on_sent(account.email)
+            except Exception as e:
+                print(f"⚠️ Sender pool: cannot record usage for {account.email}: {e}")
+
+    def disable(self, account, reason):
+        with self._lock:
+            if account.disabled_reason is None:
+                account.disabled_reason = reason
+                print(f"⚠️ Sender pool: {account.email} disabled ({reason})")
+
+    def snapshot(self):
+        """Tiến độ từng tài khoản (lưu vào status của job)"""
+        with self._lock:
+            return [
+                {
+                    'email': a.email,
+                    'sent': a.sent,
+                    'failed': a.failed,
+                    'rerouted': a.rerouted,
+                    'remaining': a.remaining,
+                    'error_rate': round(a.error_rate, 3),
+                    'status': a.status,
+                    'error': a.disabled_reason,
+                }
+                for a in self.accounts
+            ]
+
+    def summary(self):
+        return "; ".join(
+            f"{a.email}: {a.sent} sent, {a.failed} failed, {a.rerouted} rerouted ({a.status}), "
+            f"{a.retry_policy.summary()}"
+            for a in self.accounts
+        )
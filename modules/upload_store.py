@@ -0,0 +1,498 @@
+import os
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+# Dung lượng tối đa của kho upload (MB) & thời gian giữ thư mục upload không dùng tới (giờ)
+UPLOAD_STORE_MAX_MB = int(os.environ.get('UPLOAD_STORE_MAX_MB', 1024))
+UPLOAD_TTL_HOURS = float(os.environ.get('UPLOAD_TTL_HOURS', 24))
+# Thư mục đang được job dùng thì không bị dọn trong khoảng thời gian này
+UPLOAD_PIN_SECONDS = int(os.environ.get('UPLOAD_PIN_SECONDS', 6 * 3600))
+# Kích thước mỗi phần (chunk) khi upload file lớn theo từng phần (MB)
+UPLOAD_CHUNK_MB = int(os.environ.get('UPLOAD_CHUNK_MB', 8))
+
+# Đọc / ghi file theo từng khối 1 MB
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """File upload lớn hơn quota của kho / kho không còn đủ chỗ"""
+
+
+class UploadStore:
+    """
+    Kho file upload dùng chung cho mọi worker (trên đĩa local)
+    - blobs/<hash>: nội dung file, lưu theo SHA-256 → file giống nhau chỉ lưu 1 lần
+    - folders/<folder_id>/<tên file>: hard link tới blob (giữ nguyên tên file để đối chiếu Mã ID)
+    - Index trong SQLite: dùng được từ nhiều process gunicorn / worker
+    - Dọn dẹp: thư mục quá UPLOAD_TTL_HOURS không dùng, và xóa thư mục ít dùng nhất (LRU)
+      khi tổng dung lượng (blob + upload đang dở) vượt quota; thư mục đang được job dùng (pin) không bị xóa
+    - Upload theo từng phần (begin_upload → write_chunk → complete_upload): các phần gửi song song,
+      phần nào đã nhận thì không cần gửi lại; file .zip được giải nén (.xlsx) vào thư mục
+    """
+
+    def __init__(self, root, max_bytes=UPLOAD_STORE_MAX_MB * 1024 * 1024, ttl_seconds=UPLOAD_TTL_HOURS * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.folder_dir = os.path.join(root, 'folders')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for path in (self.blob_dir, self.folder_dir, self.tmp_dir):
+            os.makedirs(path, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " hash TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS folders ("
+            " folder_id TEXT PRIMARY KEY,"
+            " owner TEXT,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " pinned_until REAL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS folder_files ("
+            " folder_id TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " PRIMARY KEY (folder_id, filename))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS folder_files_hash ON folder_files (hash)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " upload_id TEXT PRIMARY KEY,"
+            " folder_id TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " chunk_size INTEGER NOT NULL,"
+            " sha256 TEXT,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS upload_chunks ("
+            " upload_id TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " PRIMARY KEY (upload_id, idx))"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite3'), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _blob_path(self, file_hash):
+        return os.path.join(self.blob_dir, file_hash[:2], file_hash)
+
+    def _folder_path(self, folder_id):
+        return os.path.join(self.folder_dir, folder_id)
+
+    def create_folder(self, owner=None):
+        """Tạo thư mục upload mới → folder_id"""
+        folder_id = f"up_{uuid.uuid4().hex}"
+        os.makedirs(self._folder_path(folder_id))
+        now = time.time()
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO folders (folder_id, owner, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (folder_id, owner, now, now)
+        ))
+        return folder_id
+
+    def add_file(self, folder_id, filename, stream):
+        """
+        Lưu 1 file vào thư mục upload (đọc stream theo từng khối, tính SHA-256 cùng lúc)
+        File đã có trong kho (cùng nội dung) thì chỉ tạo link, không lưu thêm bản mới
+        File mới tính vào quota như upload theo từng phần (UploadTooLarge nếu kho không đủ chỗ)
+        Trả về hash của file
+        """
+        filename = clean_filename(filename)
+        temp_path, file_hash, size = self._spool(stream)
+        try:
+            if size > self.max_bytes:
+                raise UploadTooLarge(f"File too large: {size // (1024 * 1024)} MB (max {self.max_bytes // (1024 * 1024)} MB)")
+            if not os.path.exists(self._blob_path(file_hash)):
+                self.cleanup(reserve=size, keep=folder_id) # Dọn bớt thư mục cũ (LRU) để có chỗ cho file mới
+            self._link_blob(folder_id, filename, file_hash, size, temp_path, check_quota=True)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return file_hash
+
+    def _spool(self, stream):
+        """Ghi stream ra file tạm trong tmp/ → (đường dẫn, SHA-256, số byte)"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(COPY_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest(), size
+
+    def add_zip(self, folder_id, stream):
+        """Lưu file .zip (stream) vào thư mục upload: giải nén các file .xlsx → list tên file"""
+        temp_path, _, _ = self._spool(stream)
+        try:
+            return self.extract_zip(folder_id, temp_path)
+        finally:
+            os.remove(temp_path)
+
+    def extract_zip(self, folder_id, zip_path):
+        """
+        Giải nén các file .xlsx trong zip vào thư mục upload (đọc từng file theo khối, không
+        giải nén cả file vào RAM); bỏ qua thư mục con (chỉ lấy tên file) → list tên file
+        2 file trùng tên (ở các thư mục con khác nhau) → ValueError, không file nào bị ghi đè
+        """
+        added = []
+        with zipfile.ZipFile(zip_path) as zf:
+            members = [
+                info for info in zf.infolist()
+                if not info.is_dir()
+                and info.filename.lower().endswith('.xlsx')
+                and not info.filename.startswith('__MACOSX/')
+                and not os.path.basename(info.filename).startswith('~$')
+            ]
+            seen = {}
+            for info in members:
+                filename = clean_filename(info.filename)
+                if filename in seen:
+                    raise ValueError(f"Duplicate file name in ZIP: {seen[filename]} / {info.filename}")
+                seen[filename] = info.filename
+            total = sum(info.file_size for info in members)
+            if total > self.max_bytes:
+                raise ValueError(f"ZIP content too large: {total // (1024 * 1024)} MB")
+            for info in members:
+                with zf.open(info) as member:
+                    filename = os.path.basename(info.filename)
+                    self.add_file(folder_id, filename, member)
+                    added.append(filename)
+        return added
+
+    def begin_upload(self, folder_id, filename, size, sha256=None, chunk_size=UPLOAD_CHUNK_MB * 1024 * 1024):
+        """
+        Bắt đầu upload 1 file theo từng phần → {'upload_id', 'chunk_size', 'chunk_count', 'received', 'complete'}
+        - Đã có upload dở của cùng file (tên + kích thước) → dùng lại, trả về các phần đã nhận (resume)
+        - sha256 (nếu có) trùng file đã có trong kho → link luôn, không cần gửi nội dung
+        """
+        filename = clean_filename(filename)
+        size = int(size)
+        if size < 0:
+            raise ValueError(f"Invalid file size: {size}")
+        if size > self.max_bytes:
+            raise UploadTooLarge(f"File too large: {size // (1024 * 1024)} MB (max {self.max_bytes // (1024 * 1024)} MB)")
+
+        sha256 = sha256.lower() if sha256 else None
+        if sha256 and not filename.lower().endswith('.zip') and self._link_blob(folder_id, filename, sha256, size):
+            return {'upload_id': None, 'chunk_size': chunk_size, 'chunk_count': 0, 'received': [], 'complete': True}
+
+        def begin(conn):
+            if conn.execute("SELECT 1 FROM folders WHERE folder_id = ?", (folder_id,)).fetchone() is None:
+                raise KeyError(f"Upload folder not found: {folder_id}")
+            row = conn.execute(
+                "SELECT upload_id, chunk_size FROM uploads WHERE folder_id = ? AND filename = ? AND size = ?",
+                (folder_id, filename, size)
+            ).fetchone()
+            if row is not None:
+                received = [r[0] for r in conn.execute(
+                    "SELECT idx FROM upload_chunks WHERE upload_id = ? ORDER BY idx", (row[0],)
+                )]
+                return row[0], row[1], received
+            # File tạm được tạo đủ kích thước ngay → tính vào quota từ lúc bắt đầu upload
+            if self._usage(conn) + size > self.max_bytes:
+                raise UploadTooLarge("Upload store is full - please try again later")
+            upload_id = f"ul_{uuid.uuid4().hex}"
+            # File tạm đủ kích thước → các phần ghi song song vào đúng vị trí
+            with open(self._part_path(upload_id), 'wb') as f:
+                f.truncate(size)
+            conn.execute(
+                "INSERT INTO uploads (upload_id, folder_id, filename, size, chunk_size, sha256, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (upload_id, folder_id, filename, size, chunk_size, sha256, time.time())
+            )
+            conn.execute("UPDATE folders SET last_used = ? WHERE folder_id = ?", (time.time(), folder_id))
+            return upload_id, chunk_size, []
+
+        self.cleanup(reserve=size, keep=folder_id) # Dọn bớt thư mục cũ (LRU) để có chỗ cho file mới
+        upload_id, chunk_size, received = self._transaction(begin)
+        return {
+            'upload_id': upload_id,
+            'chunk_size': chunk_size,
+            'chunk_count': chunk_count(size, chunk_size),
+            'received': received,
+            'complete': False,
+        }
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.tmp_dir, f"{upload_id}.part")
+
+    def _get_upload(self, upload_id):
+        row = self._connect().execute(
+            "SELECT folder_id, filename, size, chunk_size, sha256 FROM uploads WHERE upload_id = ?", (upload_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"Upload not found: {upload_id}")
+        return {'folder_id': row[0], 'filename': row[1], 'size': row[2], 'chunk_size': row[3], 'sha256': row[4]}
+
+    def write_chunk(self, upload_id, index, stream):
+        """Ghi phần thứ index (đọc stream theo khối) → số phần đã nhận; phần thiếu/thừa byte bị từ chối"""
+        upload = self._get_upload(upload_id)
+        count = chunk_count(upload['size'], upload['chunk_size'])
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid chunk index: {index}")
+        offset = index * upload['chunk_size']
+        expected = min(upload['chunk_size'], upload['size'] - offset)
+
+        written = 0
+        fd = os.open(self._part_path(upload_id), os.O_WRONLY)
+        try:
+            while written <= expected:
+                block = stream.read(min(COPY_BLOCK_SIZE, expected - written + 1))
+                if not block:
+                    break
+                if written + len(block) > expected:
+                    raise ValueError(f"Chunk {index} is larger than {expected} bytes")
+                os.pwrite(fd, block, offset + written)
+                written += len(block)
+        finally:
+            os.close(fd)
+        if written != expected:
+            raise ValueError(f"Chunk {index} incomplete: {written}/{expected} bytes")
+
+        def mark(conn):
+            conn.execute("INSERT OR IGNORE INTO upload_chunks (upload_id, idx) VALUES (?, ?)", (upload_id, index))
+            return conn.execute("SELECT COUNT(*) FROM upload_chunks WHERE upload_id = ?", (upload_id,)).fetchone()[0]
+        return self._transaction(mark)
+
+    def upload_status(self, upload_id):
+        """Các phần đã nhận của 1 upload (để client gửi tiếp phần còn thiếu)"""
+        upload = self._get_upload(upload_id)
+        received = [row[0] for row in self._connect().execute(
+            "SELECT idx FROM upload_chunks WHERE upload_id = ? ORDER BY idx", (upload_id,)
+        )]
+        upload['chunk_count'] = chunk_count(upload['size'], upload['chunk_size'])
+        upload['received'] = received
+        return upload
+
+    def complete_upload(self, upload_id):
+        """
+        Kết thúc upload khi đã nhận đủ các phần: kiểm tra SHA-256 (nếu client gửi), lưu vào kho
+        → list tên file đã thêm vào thư mục (file .zip: các file .xlsx đã giải nén)
+        """
+        status = self.upload_status(upload_id)
+        missing = sorted(set(range(status['chunk_count'])) - set(status['received']))
+        if missing:
+            raise ValueError(f"Upload incomplete: missing {len(missing)} chunk(s)")
+
+        part_path = self._part_path(upload_id)
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                digest.update(block)
+        file_hash = digest.hexdigest()
+        if status['sha256'] and status['sha256'] != file_hash:
+            self._discard_upload(upload_id)
+            raise ValueError(f"Checksum mismatch for {status['filename']}")
+
+        if status['filename'].lower().endswith('.zip'):
+            # Bỏ giữ chỗ của file .zip trước khi giải nén: các file .xlsx tự tính quota khi thêm vào kho
+            zip_path = f"{part_path}.zip"
+            os.replace(part_path, zip_path)
+            self._discard_upload(upload_id)
+            try:
+                return self.extract_zip(status['folder_id'], zip_path)
+            finally:
+                os.remove(zip_path)
+        try:
+            self._link_blob(status['folder_id'], status['filename'], file_hash, status['size'], part_path)
+        finally:
+            self._discard_upload(upload_id)
+        return [status['filename']]
+
+    def _discard_upload(self, upload_id):
+        self._transaction(lambda conn: self._remove_upload(conn, upload_id))
+
+    def _link_blob(self, folder_id, filename, file_hash, size, temp_path=None, check_quota=False):
+        """
+        Ghi blob (nếu chưa có) và link vào thư mục — trong 1 transaction để không đụng lúc dọn dẹp
+        temp_path=None: chỉ link blob đã có & do cùng owner upload trước đó → False nếu không có
+        check_quota: blob mới vượt quota → UploadTooLarge (upload theo từng phần đã giữ chỗ từ begin_upload)
+        """
+        blob_path = self._blob_path(file_hash)
+        target = os.path.join(self._folder_path(folder_id), filename)
+
+        def link(conn):
+            folder = conn.execute("SELECT owner FROM folders WHERE folder_id = ?", (folder_id,)).fetchone()
+            if folder is None:
+                raise KeyError(f"Upload folder not found: {folder_id}")
+            if temp_path is None:
+                owned = conn.execute(
+                    "SELECT 1 FROM folder_files ff JOIN folders f ON f.folder_id = ff.folder_id "
+                    "WHERE ff.hash = ? AND f.owner IS ? LIMIT 1",
+                    (file_hash, folder[0])
+                ).fetchone()
+                if owned is None or not os.path.exists(blob_path):
+                    return False
+            elif not os.path.exists(blob_path):
+                if check_quota and self._usage(conn) + size > self.max_bytes:
+                    raise UploadTooLarge("Upload store is full - please try again later")
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_path, blob_path)
+            conn.execute("INSERT OR IGNORE INTO blobs (hash, size) VALUES (?, ?)", (file_hash, size))
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(blob_path, target)
+            except OSError:
+                shutil.copyfile(blob_path, target) # File system không hỗ trợ hard link
+            conn.execute(
+                "INSERT OR REPLACE INTO folder_files (folder_id, filename, hash) VALUES (?, ?, ?)",
+                (folder_id, filename, file_hash)
+            )
+            conn.execute("UPDATE folders SET last_used = ? WHERE folder_id = ?", (time.time(), folder_id))
+            return True
+
+        return self._transaction(link)
+
+    def get_folder(self, folder_id):
+        """Đường dẫn thư mục upload (cập nhật thời điểm dùng), None nếu không có / đã bị dọn"""
+        if not folder_id:
+            return None
+        updated = self._transaction(lambda conn: conn.execute(
+            "UPDATE folders SET last_used = ? WHERE folder_id = ?", (time.time(), folder_id)
+        ).rowcount)
+        path = self._folder_path(folder_id)
+        return path if updated and os.path.isdir(path) else None
+
+    def pin(self, folder_id, seconds=UPLOAD_PIN_SECONDS):
+        """Giữ thư mục không bị dọn trong lúc job dùng"""
+        now = time.time()
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE folders SET pinned_until = ?, last_used = ? WHERE folder_id = ?",
+            (now + seconds, now, folder_id)
+        ))
+
+    def unpin(self, folder_id):
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE folders SET pinned_until = NULL, last_used = ? WHERE folder_id = ?",
+            (time.time(), folder_id)
+        ))
+
+    def usage(self):
+        """Tổng dung lượng (byte): blob (mỗi nội dung chỉ tính 1 lần) + file tạm của các upload đang dở"""
+        return self._usage(self._connect())
+
+    @staticmethod
+    def _usage(conn):
+        blobs = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        pending = conn.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+        return blobs + pending
+
+    def cleanup(self, reserve=0, keep=None):
+        """
+        Xóa upload dở không ghi thêm phần nào quá TTL, thư mục hết hạn (TTL) & thư mục ít dùng nhất
+        khi vượt quota (reserve: số byte cần giữ chỗ thêm, keep: thư mục không xóa) → trả về list folder_id đã xóa
+        """
+        def evict(conn):
+            now = time.time()
+            for upload_id, in conn.execute("SELECT upload_id FROM uploads").fetchall():
+                part_path = self._part_path(upload_id)
+                if not os.path.exists(part_path) or now - os.path.getmtime(part_path) > self.ttl_seconds:
+                    self._remove_upload(conn, upload_id)
+            removable = conn.execute(
+                "SELECT folder_id, last_used FROM folders "
+                "WHERE pinned_until IS NULL OR pinned_until < ? ORDER BY last_used",
+                (now,)
+            ).fetchall()
+            usage = self._usage(conn)
+            # Thư mục đang có upload dở chỉ bị xóa khi hết hạn (không xóa vì quota giữa lúc đang upload)
+            uploading = set(row[0] for row in conn.execute("SELECT DISTINCT folder_id FROM uploads"))
+            removed = []
+            for folder_id, last_used in removable:
+                expired = now - last_used > self.ttl_seconds
+                if not expired and usage + reserve <= self.max_bytes:
+                    break
+                if folder_id == keep or (not expired and folder_id in uploading):
+                    continue
+                usage -= self._remove_folder(conn, folder_id)
+                removed.append(folder_id)
+            return removed
+        return self._transaction(evict)
+
+    def _remove_upload(self, conn, upload_id):
+        """Xóa upload dở (index + file tạm) → số byte đã giữ chỗ"""
+        row = conn.execute("SELECT size FROM uploads WHERE upload_id = ?", (upload_id,)).fetchone()
+        conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+        conn.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+        try:
+            os.remove(self._part_path(upload_id))
+        except FileNotFoundError:
+            pass
+        return row[0] if row else 0
+
+    def _remove_folder(self, conn, folder_id):
+        """Xóa thư mục + upload dở + các blob không còn thư mục nào dùng → trả về số byte giải phóng"""
+        hashes = [row[0] for row in conn.execute(
+            "SELECT DISTINCT hash FROM folder_files WHERE folder_id = ?", (folder_id,)
+        )]
+        conn.execute("DELETE FROM folder_files WHERE folder_id = ?", (folder_id,))
+        conn.execute("DELETE FROM folders WHERE folder_id = ?", (folder_id,))
+        freed = 0
+        upload_ids = [row[0] for row in conn.execute("SELECT upload_id FROM uploads WHERE folder_id = ?", (folder_id,))]
+        for upload_id in upload_ids:
+            freed += self._remove_upload(conn, upload_id)
+        shutil.rmtree(self._folder_path(folder_id), ignore_errors=True)
+        for file_hash in hashes:
+            if conn.execute("SELECT 1 FROM folder_files WHERE hash = ? LIMIT 1", (file_hash,)).fetchone():
+                continue
+            row = conn.execute("SELECT size FROM blobs WHERE hash = ?", (file_hash,)).fetchone()
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (file_hash,))
+            try:
+                os.remove(self._blob_path(file_hash))
+            except FileNotFoundError:
+                pass
+            freed += row[0] if row else 0
+        return freed
+
+
+def clean_filename(filename):
+    """Chỉ giữ tên file (bỏ đường dẫn), báo lỗi nếu tên không hợp lệ"""
+    filename = os.path.basename((filename or '').replace('\\', '/'))
+    if not filename or filename in ('.', '..'):
+        raise ValueError(f"Invalid file name: {filename!r}")
+    return filename
+
+
+def chunk_count(size, chunk_size):
+    """Số phần của file size byte (file rỗng: 0 phần)"""
+    return (size + chunk_size - 1) // chunk_size
@@ -155,25 +155,21 @@ document.addEventListener("DOMContentLoaded", () => {
       const formData = new FormData(splitForm);
 
       try {
-        const response = await fetch('/split', {
+        // Tách file chạy nền trên server, theo dõi tiến độ bằng job_id
+        const response = await fetch('/start_split', {
           method: 'POST',
           body: formData
         });
 
-        if (response.ok) {
-          const blob = await response.blob();
-          const url = window.URL.createObjectURL(blob);
-          const a = document.createElement('a');
-          a.href = url;
-          a.download = 'tach_file.zip';
-          a.click();
-          hideLoading();
-          alert('✅ Tách file thành công!');
-        } else {
-          const error = await response.text();
+        const result = await response.json();
+
+        if (!response.ok || result.error) {
           hideLoading();
-          alert('❌ ' + error);
+          alert('❌ ' + (result.error || `Server error ${response.status}`));
+          return;
         }
+
+        await pollSplitStatus(result.job_id);
       } catch (error) {
         hideLoading();
         alert('❌ Lỗi: ' + error.message);
@@ -181,49 +177,321 @@ document.addEventListener("DOMContentLoaded", () => {
     });
   }
 
+  // ==========================================
+  // JOB PROGRESS (SSE, fallback polling)
+  // ==========================================
+  function isJobFinished(status) {
+    return status.status !== "processing" || status.resumable;
+  }
+
+  // Theo dõi job: server đẩy tiến độ qua /progress_stream (SSE) khi có thay đổi.
+  // Trình duyệt không hỗ trợ / mất stream → quay về polling /check_status.
+  // Trả về Promise với status cuối cùng (completed / failed / resumable).
+  function watchJob(jobId, onProgress, pollInterval = 2000) {
+    return new Promise((resolve, reject) => {
+      const finish = (status) => {
+        if (isJobFinished(status)) {
+          resolve(status);
+          return true;
+        }
+        onProgress(status);
+        return false;
+      };
+
+      const poll = () => {
+        const intervalId = setInterval(async () => {
+          try {
+            const statusResponse = await fetch(`/check_status/${jobId}`);
+            const status = await statusResponse.json();
+            if (!statusResponse.ok) {
+              clearInterval(intervalId);
+              reject(new Error(status.error || `Server error ${statusResponse.status}`));
+              return;
+            }
+            if (finish(status)) {
+              clearInterval(intervalId);
+            }
+          } catch (error) {
+            clearInterval(intervalId);
+            reject(error);
+          }
+        }, pollInterval);
+      };
+
+      if (!window.EventSource) {
+        poll();
+        return;
+      }
+
+      const source = new EventSource(`/progress_stream/${jobId}`);
+      source.onmessage = (event) => {
+        if (finish(JSON.parse(event.data))) {
+          source.close();
+        }
+      };
+      source.onerror = () => {
+        // CONNECTING: trình duyệt tự kết nối lại; CLOSED: stream hỏng → polling
+        if (source.readyState === EventSource.CLOSED) {
+          poll();
+        }
+      };
+    });
+  }
+
+  function formatEta(seconds) {
+    if (seconds === null || seconds === undefined) return "";
+    const total = Math.round(seconds);
+    const minutes = Math.floor(total / 60);
+    const secs = String(total % 60).padStart(2, "0");
+    return ` · còn ~${minutes}:${secs}`;
+  }
+
+  // ==========================================
+  // WATCH SPLIT STATUS
+  // ==========================================
+  async function pollSplitStatus(jobId) {
+    try {
+      const status = await watchJob(jobId, (status) => {
+        if (status.total > 0) {
+          showLoading(`Đang tách file... ${status.progress}/${status.total}${formatEta(status.eta_seconds)}`);
+        }
+      }, 1000);
+
+      hideLoading();
+      if (status.status === "completed") {
+        window.location.href = `/download_split/${jobId}`;
+        alert('✅ Tách file thành công!' + (status.warning ? '\n' + status.warning : ''));
+      } else {
+        alert('❌ ' + (status.error || "Tách file thất bại!"));
+      }
+    } catch (error) {
+      console.error("Watch error:", error);
+      hideLoading();
+      alert('❌ Mất kết nối.');
+    }
+  }
+
   // ==========================================
   // EMAIL FORM - UPLOAD FOLDER
   // ==========================================
   const excelFilesInput = document.getElementById('excel-files');
   let uploadedFolderId = null;
 
+  // Số phần (chunk) gửi song song & số lần thử lại mỗi phần
+  const UPLOAD_PARALLEL = 4;
+  const UPLOAD_CHUNK_RETRIES = 3;
+  // Folder của lần upload bị lỗi giữa chừng → chọn lại file thì chỉ gửi tiếp phần còn thiếu
+  let resumeFolderId = null;
+
+  async function postJson(url, data) {
+    const response = await fetch(url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(data || {})
+    });
+    const result = await response.json();
+    if (!response.ok || result.error) {
+      throw new Error(result.error || `HTTP ${response.status}`);
+    }
+    return result;
+  }
+
+  async function sha256Hex(file) {
+    // Chỉ tính hash cho file nhỏ (file đã upload trước đó thì server không cần nhận lại)
+    if (!window.crypto || !crypto.subtle || file.size > 32 * 1024 * 1024) return null;
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+  }
+
+  async function putChunk(uploadId, index, blob) {
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const response = await fetch(`/upload_chunk/${uploadId}/${index}`, {
+          method: 'PUT',
+          headers: { 'Content-Type': 'application/octet-stream' },
+          body: blob
+        });
+        if (response.ok) return;
+        const result = await response.json().catch(() => ({}));
+        if (response.status < 500 || attempt >= UPLOAD_CHUNK_RETRIES) {
+          throw new Error(result.error || `HTTP ${response.status}`);
+        }
+      } catch (error) {
+        if (attempt >= UPLOAD_CHUNK_RETRIES) throw error;
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+    }
+  }
+
+  async function uploadFiles(files, onProgress) {
+    const folderId = resumeFolderId || (await postJson('/upload_folder/start')).folder_id;
+    resumeFolderId = folderId;
+
+    // Đăng ký từng file → danh sách phần còn thiếu
+    const uploads = [];
+    const chunks = [];
+    let totalBytes = 0;
+    let sentBytes = 0;
+    let fileCount = 0;
+    for (const file of files) {
+      const info = await postJson(`/upload_folder/${folderId}/files`, {
+        filename: file.name,
+        size: file.size,
+        sha256: await sha256Hex(file)
+      });
+      totalBytes += file.size;
+      if (info.complete) {
+        sentBytes += file.size;
+        fileCount += 1;
+        continue;
+      }
+      const upload = { file, uploadId: info.upload_id, remaining: 0, done: false };
+      const received = new Set(info.received);
+      for (let index = 0; index < info.chunk_count; index++) {
+        const startByte = index * info.chunk_size;
+        const blob = file.slice(startByte, Math.min(startByte + info.chunk_size, file.size));
+        if (received.has(index)) {
+          sentBytes += blob.size;
+        } else {
+          upload.remaining += 1;
+          chunks.push({ upload, index, blob });
+        }
+      }
+      uploads.push(upload);
+    }
+    onProgress(sentBytes, totalBytes);
+
+    const completeUpload = async (upload) => {
+      const result = await postJson(`/upload_chunk/${upload.uploadId}/complete`);
+      upload.done = true;
+      fileCount += result.file_count;
+    };
+
+    // Gửi các phần song song; file nào đủ phần thì complete ngay
+    let next = 0;
+    const runSlot = async () => {
+      while (next < chunks.length) {
+        const { upload, index, blob } = chunks[next++];
+        await putChunk(upload.uploadId, index, blob);
+        sentBytes += blob.size;
+        onProgress(sentBytes, totalBytes);
+        upload.remaining -= 1;
+        if (upload.remaining === 0) await completeUpload(upload);
+      }
+    };
+    await Promise.all(Array.from({ length: UPLOAD_PARALLEL }, runSlot));
+
+    // File không còn phần nào phải gửi (file rỗng / đã nhận đủ từ lần trước)
+    for (const upload of uploads) {
+      if (!upload.done) await completeUpload(upload);
+    }
+
+    resumeFolderId = null;
+    return { folderId, fileCount };
+  }
+
   if (excelFilesInput) {
     excelFilesInput.addEventListener('change', async (e) => {
-      const files = e.target.files;
-      if (!files || files.length === 0) {
-        uploadedFolderId = null;
+      const files = Array.from(e.target.files || []).filter(
+        file => file.name.endsWith('.xlsx') || file.name.toLowerCase().endsWith('.zip')
+      );
+      uploadedFolderId = null;
+      if (files.length === 0) {
         return;
       }
 
       showLoading(`Đang tải ${files.length} file...`);
 
-      const formData = new FormData();
-      for (let file of files) {
-        formData.append('files', file);
-      }
-
       try {
-        const response = await fetch('/upload_folder', {
-          method: 'POST',
-          body: formData
+        const result = await uploadFiles(files, (sent, total) => {
+          const percent = total > 0 ? Math.round(sent / total * 100) : 100;
+          showLoading(`Đang tải ${files.length} file... ${percent}% (${(sent / 1048576).toFixed(1)}/${(total / 1048576).toFixed(1)} MB)`);
         });
-
-        const result = await response.json();
-
-        if (result.success) {
-          uploadedFolderId = result.folder_id;
-          hideLoading();
-        } else {
-          hideLoading();
-          alert('❌ ' + (result.error || 'Upload lỗi'));
+        uploadedFolderId = result.folderId;
+        hideLoading();
+        if (result.fileCount === 0) {
+          alert('⚠️ Không có file .xlsx nào được tải lên');
         }
       } catch (error) {
         hideLoading();
-        alert('❌ ' + error.message);
+        alert('❌ Upload lỗi: ' + error.message + '\nChọn lại file để tải tiếp phần còn thiếu.');
       }
     });
   }
 
+  // ==========================================
+  // TÀI KHOẢN GỬI (POOL)
+  // ==========================================
+  const senderAccountsBox = document.getElementById('sender-accounts');
+
+  async function loadSenderAccounts() {
+    if (!senderAccountsBox) return;
+    try {
+      const response = await fetch('/sender_accounts');
+      if (!response.ok) return;
+      const result = await response.json();
+      senderAccountsBox.innerHTML = '';
+      for (const account of result.accounts) {
+        const label = document.createElement('label');
+        label.className = 'checkbox-label';
+        const checkbox = document.createElement('input');
+        checkbox.type = 'checkbox';
+        checkbox.name = 'sender_accounts';
+        checkbox.value = account.email;
+        checkbox.checked = account.email === result.primary;
+        label.appendChild(checkbox);
+        label.appendChild(document.createTextNode(
+          ` ${account.email} (còn ${account.remaining}/${account.daily_limit} email hôm nay)`
+        ));
+        senderAccountsBox.appendChild(label);
+      }
+    } catch (error) {
+      console.warn('Cannot load sender accounts', error);
+    }
+  }
+
+  loadSenderAccounts();
+
+  // ==========================================
+  // DANH SÁCH EMAIL ĐÃ TẢI LÊN (dùng lại, không cần upload lại file)
+  // ==========================================
+  const contactListSelect = document.getElementById('contact-list');
+  const contactListGroup = document.getElementById('contact-list-group');
+  const emailFileInput = document.getElementById('email-file');
+
+  async function loadContactLists(selectedId) {
+    if (!contactListSelect) return;
+    try {
+      const response = await fetch('/contact_lists');
+      if (!response.ok) return;
+      const result = await response.json();
+      contactListSelect.innerHTML = '<option value="">-- Tải lên file mới --</option>';
+      for (const item of result.contact_lists) {
+        const option = document.createElement('option');
+        option.value = item.list_id;
+        option.textContent = item.rows === null ? item.filename : `${item.filename} (${item.rows} dòng)`;
+        contactListSelect.appendChild(option);
+      }
+      contactListSelect.value = selectedId || '';
+      contactListGroup.style.display = result.contact_lists.length ? 'block' : 'none';
+      updateEmailFileRequired();
+    } catch (error) {
+      console.warn('Cannot load contact lists', error);
+    }
+  }
+
+  function updateEmailFileRequired() {
+    if (emailFileInput && contactListSelect) {
+      emailFileInput.required = !contactListSelect.value;
+    }
+  }
+
+  if (contactListSelect) {
+    contactListSelect.addEventListener('change', updateEmailFileRequired);
+  }
+
+  loadContactLists();
+
   // ==========================================
   // EMAIL FORM SUBMIT
   // ==========================================
@@ -253,7 +521,12 @@ document.addEventListener("DOMContentLoaded", () => {
     downloadBtn.style.display = "none";
 
     const formData = new FormData(emailForm);
+    // File đính kèm đã upload theo từng phần (folder_id) → không gửi lại trong request này
+    formData.delete('files');
     formData.append('folder_id', uploadedFolderId);
+    if (contactListSelect && contactListSelect.value) {
+      formData.delete('email_file');
+    }
 
     try {
       const response = await fetch("/send_emails", {
@@ -263,6 +536,10 @@ document.addEventListener("DOMContentLoaded", () => {
 
       const result = await response.json();
 
+      if (result.contact_list_id) {
+        loadContactLists(result.contact_list_id);
+      }
+
       if (!response.ok || result.error) {
         showError("❌ Lỗi: " + (result.error || `Server error ${response.status}`));
         resetEmailForm();
@@ -288,38 +565,70 @@ document.addEventListener("DOMContentLoaded", () => {
   }
 
   // ==========================================
-  // POLLING EMAIL STATUS
+  // WATCH EMAIL STATUS
   // ==========================================
   async function pollEmailStatus(jobId) {
-    let intervalId = setInterval(async () => {
-      try {
-        const statusResponse = await fetch(`/check_status/${jobId}`);
-        const status = await statusResponse.json();
-
-        if (status.status === "processing") {
-          updateProgress(status);
-        } else if (status.status === "completed") {
-          clearInterval(intervalId);
-          completeEmailSending(jobId);
-        } else if (status.status === "failed") {
-          clearInterval(intervalId);
-          showError("❌ Gửi email thất bại! " + (status.error || ""));
-          resetEmailForm();
-        }
-      } catch (error) {
-        console.error("Polling error:", error);
-        clearInterval(intervalId);
-        showError("❌ Mất kết nối.");
+    let status;
+    try {
+      status = await watchJob(jobId, updateProgress);
+    } catch (error) {
+      console.error("Watch error:", error);
+      showError("❌ Mất kết nối.");
+      resetEmailForm();
+      return;
+    }
+
+    if (status.resumable) {
+      // Job dừng giữa chừng (lỗi / server restart) → cho phép gửi tiếp các ID chưa gửi
+      const message = `⚠️ Gửi email bị dừng ở ${status.progress}/${status.total}. ${status.error || ""}\nTiếp tục gửi các email còn lại?`;
+      if (confirm(message)) {
+        await resumeEmailJob(jobId);
+      } else {
+        showError("❌ Gửi email thất bại! " + (status.error || ""));
+        resetEmailForm();
+      }
+    } else if (status.status === "completed") {
+      completeEmailSending(jobId);
+    } else {
+      showError("❌ Gửi email thất bại! " + (status.error || ""));
+      resetEmailForm();
+    }
+  }
+
+  async function resumeEmailJob(jobId) {
+    try {
+      const response = await fetch(`/resume_job/${jobId}`, { method: "POST" });
+      const result = await response.json();
+
+      if (!response.ok || result.error) {
+        showError("❌ Lỗi: " + (result.error || `Server error ${response.status}`));
         resetEmailForm();
+        return;
       }
-    }, 2000);
+
+      progressText.textContent = "Đang gửi tiếp...";
+      await pollEmailStatus(jobId);
+    } catch (error) {
+      showError("❌ Lỗi kết nối: " + error.message);
+      resetEmailForm();
+    }
   }
 
   function updateProgress(status) {
     const progress = status.total > 0 ? Math.round((status.progress / status.total) * 100) : 0;
     progressFill.style.width = progress + "%";
     progressFill.textContent = progress + "%";
-    progressText.textContent = `Đã gửi ${status.progress}/${status.total} email...`;
+    let text = `Đã gửi ${status.progress}/${status.total} email...`;
+    if (status.counts) {
+      text += ` (✅ ${status.counts.success} · ❌ ${status.counts.failed} · ⏭️ ${status.counts.skipped})`;
+    }
+    if (status.accounts) {
+      text += '\n' + status.accounts.map(account => {
+        const state = account.status === 'active' ? '' : ` [${account.status === 'disabled' ? 'lỗi' : 'hết quota'}]`;
+        return `👤 ${account.email}: ✅ ${account.sent} · ❌ ${account.failed}${state}`;
+      }).join('\n');
+    }
+    progressText.textContent = text + formatEta(status.eta_seconds);
   }
 
   function completeEmailSending(jobId) {
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from modules.email_template import EmailTemplate, validate_templates, format_value
+
+
+def test_render_fields_and_escaped_braces():
+    template = EmailTemplate("Chào {ten_npp}, {{không phải biến}} - {Doanh số} ({ten_npp})")
+    assert template.fields == ['ten_npp', 'Doanh số']
+    assert template.columns == ['Doanh số']
+    assert template.render({'ten_npp': 'A', 'Doanh số': 12.0}) == "Chào A, {không phải biến} - 12 (A)"
+
+
+def test_render_html_escapes_values():
+    template = EmailTemplate("<b>{Ghi chú}</b>", html=True)
+    assert template.render({'Ghi chú': '<script>'}) == "<b>&lt;script&gt;</b>"
+
+
+def test_format_value():
+    assert format_value(None) == ""
+    assert format_value(float('nan')) == ""
+    assert format_value(3.5) == "3.5"
+    assert format_value(datetime(2025, 1, 2)) == "02/01/2025"
+    assert format_value(datetime(2025, 1, 2, 8, 30)) == "02/01/2025 08:30"
+
+
+def test_validate_templates_accepts_columns_and_builtins():
+    templates = [EmailTemplate("{ma_npp} - {Khu vực}"), EmailTemplate("{so_file} file, {ngay}")]
+    # Header có khoảng trắng / kiểu số vẫn khớp theo tên đã strip
+    validate_templates(templates, [' Khu vực ', 2025])
+
+
+def test_validate_templates_reports_missing_fields():
+    templates = [EmailTemplate("{Khu vực}"), EmailTemplate("{Khu vuc} {Khu vực} {email}")]
+    with pytest.raises(ValueError) as excinfo:
+        validate_templates(templates, ['Mã', 'Email'])
+    message = str(excinfo.value)
+    assert '{Khu vực}, {Khu vuc}' in message
+    assert '{email}' not in message.split('(')[0]
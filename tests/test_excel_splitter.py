@@ -0,0 +1,129 @@
+import io
+import zipfile
+from datetime import datetime
+
+import openpyxl
+import pytest
+from openpyxl.styles import Font, PatternFill, Border, Side
+
+from modules import excel_splitter
+from modules.excel_splitter import (
+    read_split_options, prepare_split, split_excel_to_file, generate_excel_files,
+    read_sheet_parser, read_sheet_values, SplitError
+)
+
+CODES = ['NPP001', 'NPP002', 'NPP003']
+
+
+def make_workbook(rows=60):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Data'
+    ws['A1'] = 'BÁO CÁO'
+    ws['A1'].font = Font(bold=True, size=16)
+    ws.merge_cells('A1:E1')
+    for col_idx, header in enumerate(['STT', 'MaNPP', 'TenNPP', 'Ngay', 'Tien'], 1):
+        cell = ws.cell(2, col_idx, header)
+        cell.font = Font(bold=True)
+        cell.fill = PatternFill('solid', start_color='4472C4')
+        cell.border = Border(bottom=Side(style='thin'))
+    ws.column_dimensions['C'].width = 30
+    ws.row_dimensions[2].height = 28
+    for row_idx in range(3, 3 + rows):
+        code = CODES[row_idx % len(CODES)]
+        ws.cell(row_idx, 1, row_idx - 2)
+        ws.cell(row_idx, 2, code)
+        ws.cell(row_idx, 3, f"Cong ty {code}")
+        ws.cell(row_idx, 4, datetime(2025, 1, 1 + row_idx % 28)).number_format = 'DD/MM/YYYY'
+        ws.cell(row_idx, 5, row_idx * 1000.5).number_format = '#,##0.00'
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def split_options(**overrides):
+    form = dict(sheet_name='Data', template_end_row='2', start_row='3', end_row='1000',
+                split_column='MaNPP', name_col='TenNPP')
+    form.update(overrides)
+    return read_split_options(form, 'Bao cao.xlsx')
+
+
+def dump_sheet(data):
+    ws = openpyxl.load_workbook(io.BytesIO(data)).active
+    cells = [
+        (cell.coordinate, cell.value, cell.font.b, cell.fill.fgColor.rgb, cell.number_format,
+         getattr(cell.border.bottom, 'style', None))
+        for row in ws.iter_rows() for cell in row
+    ]
+    return {
+        'cells': cells,
+        'merged': sorted(str(r) for r in ws.merged_cells.ranges),
+        'widths': {k: v.width for k, v in ws.column_dimensions.items() if v.width},
+        'heights': {k: v.height for k, v in ws.row_dimensions.items() if v.height},
+    }
+
+
+def test_split_output_matches_source_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(excel_splitter, 'SPLIT_MAX_WORKERS', 1)
+    source_bytes = make_workbook()
+    zip_path = str(tmp_path / 'out.zip')
+    result = split_excel_to_file(source_bytes, split_options(), zip_path)
+    assert result == {'file_count': 3, 'warning': None}
+
+    source = openpyxl.load_workbook(io.BytesIO(source_bytes)).active
+    expected = {}
+    for row in source.iter_rows(min_row=3, values_only=True):
+        expected.setdefault(row[1], []).append(list(row))
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert sorted(zf.namelist()) == [f"{code}-Cong ty {code}-Baocao.xlsx" for code in CODES]
+        for code in CODES:
+            ws = openpyxl.load_workbook(io.BytesIO(zf.read(f"{code}-Cong ty {code}-Baocao.xlsx"))).active
+            assert [list(row) for row in ws.iter_rows(min_row=3, values_only=True)] == expected[code]
+            assert ws['A1'].value == 'BÁO CÁO' and ws['A1'].font.b
+            assert [str(r) for r in ws.merged_cells.ranges] == ['A1:E1']
+            assert ws['B2'].fill.fgColor.rgb == '004472C4'
+            assert ws['B2'].border.bottom.style == 'thin'
+            assert ws['D3'].number_format == 'DD/MM/YYYY'
+            assert ws.column_dimensions['C'].width == 30
+            assert ws.row_dimensions[2].height == 28
+
+
+def test_split_column_range(tmp_path, monkeypatch):
+    monkeypatch.setattr(excel_splitter, 'SPLIT_MAX_WORKERS', 1)
+    zip_path = str(tmp_path / 'out.zip')
+    split_excel_to_file(make_workbook(), split_options(start_col='B', end_col='C'), zip_path)
+    with zipfile.ZipFile(zip_path) as zf:
+        ws = openpyxl.load_workbook(io.BytesIO(zf.read(zf.namelist()[0]))).active
+    assert ws.max_column == 2
+    assert [cell.value for cell in ws[2]] == ['MaNPP', 'TenNPP']
+    assert ws.column_dimensions['B'].width == 30
+
+
+def test_parallel_output_equals_sequential(monkeypatch):
+    monkeypatch.setattr(excel_splitter, 'SPLIT_PARALLEL_MIN_FILES', 1)
+    template, file_jobs = prepare_split(make_workbook(), split_options())
+    sequential = {name: dump_sheet(data) for name, data in generate_excel_files(template, file_jobs, 1)}
+    parallel = {name: dump_sheet(data) for name, data in generate_excel_files(template, file_jobs, 2)}
+    assert parallel == sequential
+
+
+def test_values_only_fallback_keeps_values_and_reports_warning(tmp_path, monkeypatch):
+    monkeypatch.setattr(excel_splitter, 'SPLIT_MAX_WORKERS', 1)
+    source_bytes = make_workbook()
+    ws = openpyxl.load_workbook(io.BytesIO(source_bytes), read_only=True)['Data']
+    parsed = read_sheet_parser(ws, 2, 3, 1000)
+    ws = openpyxl.load_workbook(io.BytesIO(source_bytes), read_only=True)['Data']
+    values = read_sheet_values(ws, 2, 3, 1000)
+    assert [(i, [v for v, _ in cells]) for i, cells in values['data_rows']] == \
+        [(i, [v for v, _ in cells]) for i, cells in parsed['data_rows']]
+
+    monkeypatch.setattr(excel_splitter, 'WorkSheetParser', None)
+    result = split_excel_to_file(source_bytes, split_options(), str(tmp_path / 'out.zip'))
+    assert result['file_count'] == 3
+    assert 'merged cells' in result['warning']
+
+
+def test_missing_split_column():
+    with pytest.raises(SplitError):
+        prepare_split(make_workbook(), split_options(split_column='KhongCo'))
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from modules.job_queue import JobQueue, JobWorker, JobExists, JobInterrupted
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.sqlite3'))
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_enqueue_rejects_existing_job(queue):
+    queue.enqueue('j1', 'send', 'alice', {'n': 1})
+    with pytest.raises(JobExists):
+        queue.enqueue('j1', 'send', 'bob', {'n': 2})
+    assert queue.get('j1')['user_key'] == 'alice'
+
+
+def test_claim_and_finish(queue):
+    queue.enqueue('j1', 'send', 'alice', {'n': 1})
+    job_id, kind, payload, attempt = queue.claim('w1')
+    assert (job_id, kind, payload, attempt) == ('j1', 'send', {'n': 1}, 1)
+    assert queue.claim('w1') is None
+    assert queue.owns('j1', 'w1', attempt)
+    assert queue.finish('j1', 'done', 'w1', attempt)
+    assert queue.get('j1')['state'] == 'done'
+
+
+def test_claim_limits_running_jobs_per_user(queue):
+    queue.enqueue('a1', 'send', 'alice', {})
+    queue.enqueue('a2', 'send', 'alice', {})
+    queue.enqueue('b1', 'send', 'bob', {})
+    assert queue.claim('w1', max_running_per_user=1)[0] == 'a1'
+    # a2 chờ tới khi a1 xong, job của user khác được chạy trước
+    assert queue.claim('w1', max_running_per_user=1)[0] == 'b1'
+    assert queue.claim('w1', max_running_per_user=1) is None
+
+
+def test_requeue_only_finished_jobs_of_same_user(queue):
+    queue.enqueue('j1', 'send', 'alice', {'n': 1})
+    assert not queue.requeue('j1', 'alice', {'n': 2}) # Đang chờ
+    attempt = queue.claim('w1')[3]
+    assert not queue.requeue('j1', 'alice', {'n': 2}) # Đang chạy
+    queue.finish('j1', 'failed', 'w1', attempt)
+    assert not queue.requeue('j1', 'bob', {'n': 2})
+    assert queue.requeue('j1', 'alice', {'n': 2})
+    job_id, _, payload, attempt = queue.claim('w2')
+    assert (job_id, payload, attempt) == ('j1', {'n': 2}, 2)
+
+
+def test_stale_attempt_cannot_finish_or_release_new_run(queue):
+    queue.enqueue('j1', 'send', 'alice', {})
+    first = queue.claim('w1')[3]
+    assert queue.requeue_stale(stale_seconds=3600, job_timeout=0) == ['j1']
+    second = queue.claim('w1')[3]
+    assert second == first + 1
+    assert not queue.finish('j1', 'done', 'w1', first)
+    assert not queue.release('j1', 'w1', first)
+    assert queue.heartbeat('w1', [('j1', first), ('j1', second)]) == ['j1']
+    assert queue.get('j1')['state'] == 'running'
+    assert queue.finish('j1', 'done', 'w1', second)
+
+
+def test_requeue_stale_after_lost_heartbeat(queue):
+    queue.enqueue('j1', 'send', 'alice', {})
+    queue.claim('w1')
+    assert queue.requeue_stale(stale_seconds=3600, job_timeout=3600) == []
+    time.sleep(0.01)
+    assert queue.requeue_stale(stale_seconds=0, job_timeout=3600) == ['j1']
+    assert queue.get('j1')['state'] == 'queued'
+
+
+def test_worker_runs_handlers_and_records_result(queue):
+    def ok(job_id, payload, claim):
+        pass
+
+    def failed(job_id, payload, claim):
+        return 'failed'
+
+    def crash(job_id, payload, claim):
+        raise RuntimeError('boom')
+
+    worker = JobWorker(queue, {'ok': ok, 'failed': failed, 'crash': crash}, concurrency=1, poll_interval=0.02)
+    queue.enqueue('ok', 'ok', 'a', {})
+    queue.enqueue('failed', 'failed', 'b', {})
+    queue.enqueue('crash', 'crash', 'c', {})
+    worker.start()
+    try:
+        assert wait_until(lambda: all(queue.get(j)['state'] in ('done', 'failed') for j in ('ok', 'failed', 'crash')))
+    finally:
+        worker.shutdown(timeout=2)
+    assert [queue.get(j)['state'] for j in ('ok', 'failed', 'crash')] == ['done', 'failed', 'failed']
+
+
+def test_worker_shutdown_releases_interrupted_job(queue):
+    started = threading.Event()
+
+    def cooperative(job_id, payload, claim):
+        started.set()
+        while not claim.stop_requested():
+            time.sleep(0.02)
+        raise JobInterrupted('stopping')
+
+    worker = JobWorker(queue, {'coop': cooperative}, concurrency=1, poll_interval=0.02)
+    queue.enqueue('j1', 'coop', 'alice', {})
+    worker.start()
+    assert started.wait(5)
+    worker.shutdown(timeout=2)
+    assert queue.get('j1')['state'] == 'queued'
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from modules.send_pipeline import run_send_pipeline, PipelineStopped
+
+
+def send_all(items):
+    return [(task, True, None) for task, _ in items]
+
+
+def test_every_task_finished_once():
+    finished = []
+    lock = threading.Lock()
+
+    def finish(task, success, error):
+        with lock:
+            finished.append((task, success))
+
+    run_send_pipeline(range(50), lambda task: f"msg-{task}", send_all, finish, n_senders=4, group_size=3)
+    assert sorted(finished) == [(task, True) for task in range(50)]
+
+
+def test_build_and_send_errors_are_reported_per_task():
+    outcomes = {}
+
+    def build(task):
+        if task == 1:
+            raise ValueError('bad file')
+        return task
+
+    def send(items):
+        if any(task == 2 for task, _ in items):
+            raise RuntimeError('network')
+        return send_all(items)
+
+    def finish(task, success, error):
+        outcomes[task] = (success, error)
+
+    run_send_pipeline(range(4), build, send, finish, n_senders=1)
+    assert outcomes == {0: (True, None), 1: (False, 'bad file'), 2: (False, 'network'), 3: (True, None)}
+
+
+def test_finish_error_stops_pipeline_and_is_raised():
+    sent = []
+
+    def send(items):
+        sent.extend(task for task, _ in items)
+        return send_all(items)
+
+    def finish(task, success, error):
+        if task == 3:
+            raise IOError('checkpoint write failed')
+
+    # queue nhỏ: producer phải chờ → kiểm tra pipeline không bị treo khi các thread gửi đã dừng
+    with pytest.raises(IOError, match='checkpoint write failed'):
+        run_send_pipeline(range(1000), lambda task: task, send, finish, n_senders=2, queue_size=2)
+    assert len(sent) < 1000
+
+
+def test_should_stop_raises_pipeline_stopped():
+    sent = []
+
+    def send(items):
+        sent.extend(task for task, _ in items)
+        return send_all(items)
+
+    with pytest.raises(PipelineStopped):
+        run_send_pipeline(range(1000), lambda task: task, send, lambda *outcome: None,
+                          n_senders=2, queue_size=2, should_stop=lambda: len(sent) >= 5)
+    assert len(sent) < 1000
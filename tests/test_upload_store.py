@@ -0,0 +1,86 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from modules.upload_store import UploadStore, UploadTooLarge
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(str(tmp_path / 'uploads'), max_bytes=1000, ttl_seconds=3600)
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_same_content_stored_once(store):
+    folder_a = store.create_folder('alice')
+    folder_b = store.create_folder('alice')
+    first = store.add_file(folder_a, 'A1-X.xlsx', io.BytesIO(b'x' * 400))
+    second = store.add_file(folder_b, 'A2-Y.xlsx', io.BytesIO(b'x' * 400))
+    assert first == second
+    assert store.usage() == 400
+    assert os.listdir(store.get_folder(folder_b)) == ['A2-Y.xlsx']
+
+
+def test_add_file_enforces_quota(store):
+    folder = store.create_folder('alice')
+    store.pin(folder)
+    store.add_file(folder, 'a.xlsx', io.BytesIO(b'a' * 600))
+    with pytest.raises(UploadTooLarge):
+        store.add_file(folder, 'b.xlsx', io.BytesIO(b'b' * 600))
+    with pytest.raises(UploadTooLarge):
+        store.add_file(folder, 'c.xlsx', io.BytesIO(b'c' * 1001))
+    assert store.usage() == 600
+    assert os.listdir(store.tmp_dir) == []
+
+
+def test_add_file_evicts_least_recently_used_folder(store):
+    old = store.create_folder('alice')
+    store.add_file(old, 'a.xlsx', io.BytesIO(b'a' * 600))
+    new = store.create_folder('alice')
+    store.add_file(new, 'b.xlsx', io.BytesIO(b'b' * 600))
+    assert store.get_folder(old) is None
+    assert store.usage() == 600
+
+
+def test_chunked_upload_reserves_quota(store):
+    folder = store.create_folder('alice')
+    upload = store.begin_upload(folder, 'big.xlsx', 700)
+    with pytest.raises(UploadTooLarge):
+        store.begin_upload(folder, 'other.xlsx', 400)
+    store.write_chunk(upload['upload_id'], 0, io.BytesIO(b'z' * 700))
+    assert store.complete_upload(upload['upload_id']) == ['big.xlsx']
+    assert store.usage() == 700
+
+
+def test_begin_upload_links_known_hash_without_content(store):
+    folder = store.create_folder('alice')
+    file_hash = store.add_file(folder, 'a.xlsx', io.BytesIO(b'a' * 100))
+    other = store.create_folder('alice')
+    result = store.begin_upload(other, 'copy.xlsx', 100, sha256=file_hash)
+    assert result['complete']
+    # Hash của file thuộc user khác không được dùng để lấy nội dung
+    stranger = store.create_folder('bob')
+    assert not store.begin_upload(stranger, 'copy.xlsx', 100, sha256=file_hash)['complete']
+
+
+def test_zip_extracts_xlsx_members(store):
+    folder = store.create_folder('alice')
+    data = make_zip({'sub/A1-X.xlsx': b'1', 'A2-Y.xlsx': b'2', 'notes.txt': b'x', '__MACOSX/A1-X.xlsx': b'm'})
+    assert sorted(store.add_zip(folder, io.BytesIO(data))) == ['A1-X.xlsx', 'A2-Y.xlsx']
+
+
+def test_zip_with_duplicate_names_rejected(store):
+    folder = store.create_folder('alice')
+    data = make_zip({'north/A1-X.xlsx': b'1', 'south/A1-X.xlsx': b'2'})
+    with pytest.raises(ValueError, match='Duplicate file name'):
+        store.add_zip(folder, io.BytesIO(data))
+    assert os.listdir(store.get_folder(folder)) == []
@@ -0,0 +1,47 @@
+"""
+Worker chạy job gửi email / tách file từ hàng đợi (job_storage/jobs.sqlite3)
+
+Cách chạy (cùng máy / cùng thư mục job_storage với web):
+    python worker.py
+    WORKER_CONCURRENCY=4 python worker.py
+
+Web (app.py) chỉ đưa job vào hàng đợi; có thể chạy nhiều worker process cùng lúc.
+- SIGTERM / SIGINT: không lấy job mới, chờ job đang chạy dừng tối đa WORKER_SHUTDOWN_SECONDS giây;
+  job gửi email dừng sớm & được trả lại hàng đợi (chạy tiếp từ checkpoint, không gửi trùng)
+- Slot chạy job bị chết bất thường → thoát với mã lỗi để process manager (Procfile / systemd) restart
+"""
+import signal
+import sys
+import threading
+
+# Chu kỳ kiểm tra các slot của worker còn sống (giây)
+WORKER_CHECK_SECONDS = 5
+
+
+def main():
+    # Import trong main(): process con của pool tách file (forkserver / spawn) import lại worker.py
+    # như __main__ → không được kéo theo app.py (Flask, SQLite, worker...)
+    from app import create_job_worker
+    
+    worker = create_job_worker()
+    stopped = threading.Event()
+
+    def handle_stop(signum, frame):
+        print(f"⚠️ [Worker {worker.worker_id}] Stopping (signal {signum})...")
+        worker.stop()
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    worker.start()
+    while not stopped.wait(WORKER_CHECK_SECONDS):
+        if not worker.alive():
+            print(f"❌ [Worker {worker.worker_id}] Job slot died - exiting for restart")
+            worker.shutdown(timeout=0)
+            sys.exit(1)
+    worker.shutdown()
+
+
+if __name__ == '__main__':
+    main()